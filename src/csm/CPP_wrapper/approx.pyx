@@ -4,18 +4,11 @@ import numpy as np
 import scipy.optimize
 cimport numpy as np
 from csm.calculations.constants import MAX_DOUBLE
-from csm.calculations.basic_calculations import create_rotation_matrix, check_timeout
+from csm.calculations.basic_calculations import create_rotation_matrix
 
 cdef class Vector3D
 cdef class Matrix3D
 
-cdef array_distance(double *a, double *b):
-    return sqrt(
-        (a[0]-b[0])*(a[0]-b[0])
-        +(a[1]-b[1])*(a[1]-b[1])
-        +(a[2]-b[2])*(a[2]-b[2]))
-
-
 cdef class DistanceMatrix:
     cdef int group_size
     cdef double[:,::1] mv_distances  # Make sure this is a C-order memoryview
@@ -25,7 +18,7 @@ cdef class DistanceMatrix:
     def __init__(self, group_size):
         self.group_size = group_size
         # ##print("Creating DistanceMatrix for group of size ", self.group_size)
-        self.mv_distances = np.ones((group_size, group_size), order="c") * MAX_DOUBLE
+        self.mv_distances = np.full((group_size, group_size), MAX_DOUBLE, order="c")
         self._allowed_rows = np.zeros(group_size, dtype='long')
         self._allowed_cols = np.zeros(group_size, dtype='long')
         # ##print("DistanceMatrix created")
@@ -51,16 +44,17 @@ cdef class DistanceMatrix:
         cdef long *allowed_rows = &self._allowed_rows[0]
         cdef long *allowed_cols = &self._allowed_cols[0]
 
-        for i in range(self.group_size):
-            if self._allowed_rows[i]:
-                row_ptr = &self.mv_distances[i,0]
-                for j in range(self.group_size):
-                    if self._allowed_cols[j]:
-                        tmp = row_ptr[j]
-                        if tmp < min:
-                            min = tmp
-                            min_i = i
-                            min_j = j
+        with nogil:
+            for i in range(self.group_size):
+                if allowed_rows[i]:
+                    row_ptr = &self.mv_distances[i,0]
+                    for j in range(self.group_size):
+                        if allowed_cols[j]:
+                            tmp = row_ptr[j]
+                            if tmp < min:
+                                min = tmp
+                                min_i = i
+                                min_j = j
         return (min_i, min_j)
 
 
@@ -143,96 +137,136 @@ def get_atom_to_matrix_indices(atom_indices, atom_to_matrix_indices):
         i+=1
     return atom_to_matrix_indices
 
-cdef fill_distance_matrix(len_group, cycle, chain_group, chain_perm, Vector3DHolder rotated_holder, Vector3DHolder Q_holder, long[:] matrix_indices):
-    cdef double *a
-    cdef double *b
+cdef void _fill_distance_block(double[:, ::1] distances, double[:, ::1] rotated, double[:, ::1] Q,
+                               long[:] row_atoms, long[:] col_atoms, long[:] matrix_indices) noexcept nogil:
+    cdef Py_ssize_t i, j
+    cdef long row_atom, col_atom, row
+    cdef double dx, dy, dz
+    for i in range(row_atoms.shape[0]):
+        row_atom = row_atoms[i]
+        row = matrix_indices[row_atom]
+        for j in range(col_atoms.shape[0]):
+            col_atom = col_atoms[j]
+            dx = rotated[col_atom, 0] - Q[row_atom, 0]
+            dy = rotated[col_atom, 1] - Q[row_atom, 1]
+            dz = rotated[col_atom, 2] - Q[row_atom, 2]
+            distances[row, matrix_indices[col_atom]] = sqrt(dx * dx + dy * dy + dz * dz)
+
+def fill_distance_block(double[:, ::1] distances, double[:, ::1] rotated, double[:, ::1] Q,
+                        long[:] row_atoms, long[:] col_atoms, long[:] matrix_indices):
+    """
+    Sets distances[matrix_indices[r], matrix_indices[c]] to the distance between the rotated atom c and the atom r,
+    for every atom r of row_atoms and c of col_atoms, without the GIL
+    :param rotated: the rotated coordinates of the molecule, C-contiguous
+    :param Q: the coordinates of the molecule, C-contiguous
+    """
+    with nogil:
+        _fill_distance_block(distances, rotated, Q, row_atoms, col_atoms, matrix_indices)
+
+cdef class ApproxPlan:
+    """
+    The parts of building a permutation from a direction that depend on the molecule and the chain permutation but not
+    on the direction, so that they are built once and reused by every iteration of every direction:
+    - Q, a C-contiguous copy of the coordinates
+    - groups, the atoms of each equivalence group of each cycle of the chain permutation (which are the rows and
+      columns of the group's distance matrix) and its blocks: pairs of arrays of the atoms of a chain and of the chain
+      it is permuted to
+    - matrix_indices, the index of each atom in the distance matrix of its group
+    """
+    cdef readonly Q
+    cdef readonly list groups
+    cdef readonly matrix_indices
+
+    def __init__(self, molecule, chain_perm, Q=None):
+        """
+        :param Q: the C-contiguous coordinates of the molecule, to share them between its plans
+        """
+        if Q is None:
+            Q = np.ascontiguousarray(molecule.Q, dtype=np.float64)
+        self.Q = Q
+        self.groups = []
+        self.matrix_indices = np.ones(len(molecule), dtype='long') * -1
+        # permutation is built by "group": equivalence class, and valid cycle within chain perm
+        # every atom is in the group of exactly one cycle, so the matrix indices of the groups don't overlap
+        for cycle in cycle_builder(chain_perm):
+            for chains_in_group in molecule.groups_with_internal_chains:
+                try:
+                    atom_indices = get_atom_indices(cycle, chains_in_group)
+                except KeyError:  # chaingroup does not have chains belonging to current cycle
+                    continue
+                get_atom_to_matrix_indices(atom_indices, self.matrix_indices)
+                blocks = [(np.array(chains_in_group[chain_index], dtype='long'),
+                           np.array(chains_in_group[chain_perm[chain_index]], dtype='long'))
+                          for chain_index in cycle]
+                self.groups.append((atom_indices, blocks))
+
+cdef fill_distance_matrix(len_group, blocks, double[:, ::1] rotated, double[:, ::1] Q, long[:] matrix_indices):
     cdef DistanceMatrix distances = DistanceMatrix(len_group)
-    cdef vector[int] from_chain
-    cdef vector[int] to_chain
-    cdef int from_chain_index
-    cdef int to_chain_index
+    cdef long[:] from_chain
+    cdef long[:] to_chain
     cdef int i
-    cdef int j
-
-
-    for chain_index in cycle: # Use an iterator
-        # Todo: Convert from_chain and to_chain into vector[ints]
-        from_chain = list_to_vector_int(chain_group[chain_index])
-        to_chain = list_to_vector_int(chain_group[chain_perm[chain_index]])
-        for i in range(from_chain.size()):
-            from_chain_index = from_chain[i]
-            for j in range(to_chain.size()):
-                to_chain_index = to_chain[j]
-                a = rotated_holder.get_vector(from_chain_index)
-                b = Q_holder.get_vector(to_chain_index)
-                distance = array_distance(a,b)
-                distances.add(matrix_indices[to_chain_index], matrix_indices[from_chain_index], distance)
+
+    # each block is the distances between the rotated atoms of a chain (the columns) and the atoms of the chain it
+    # is permuted to (the rows)
+    for from_chain, to_chain in blocks:
+        if from_chain.shape[0] == 0 or to_chain.shape[0] == 0:
+            continue
+        with nogil:
+            _fill_distance_block(distances.mv_distances, rotated, Q, to_chain, from_chain, matrix_indices)
+        for i in range(to_chain.shape[0]):
+            distances._allowed_rows[matrix_indices[to_chain[i]]] = 1
+        for i in range(from_chain.shape[0]):
+            distances._allowed_cols[matrix_indices[from_chain[i]]] = 1
     return distances
 
-def approximate_perm_classic(op_type, op_order, molecule, dir, chain_perm):
-    #print("Inside estimate_perm, dir=%s" % dir)
+def approximate_perm_classic(op_type, op_order, molecule, dir, chain_perm, deadline=None, plan=None):
+    """
+    :param plan: the ApproxPlan of the molecule and chain_perm, which is built when not given
+    """
+    if plan is None:
+        plan = ApproxPlan(molecule, chain_perm)
     # create rotation matrix
     rotation_mat = create_rotation_matrix(1, op_type, op_order, dir)
     # run rotation matrix on atoms
-    rotated = (rotation_mat @ molecule.Q.T).T
-    cdef Vector3DHolder rotated_holder = Vector3DHolder(rotated)
-    cdef Vector3DHolder Q_holder = Vector3DHolder(molecule.Q)
-    cdef long[:] atom_to_matrix_indices = np.ones(len(molecule), dtype='long') * -1
+    cdef double[:, ::1] Q = plan.Q
+    cdef double[:, ::1] rotated = np.ascontiguousarray((rotation_mat @ plan.Q.T).T)
     # empty permutation:
     perm = [-1] * len(molecule)
 
-    #permutation is built by "group": equivalence class, and valid cycle within chain perm (then valid exchange w/n cycle)
-    for cycle in cycle_builder(chain_perm):
-        check_timeout()
-        # Todo: Convert cycle into a vector[int]
-        for chains_in_group in molecule.groups_with_internal_chains:
-            #1. create the group of atom indices we will be building a distance matrix with
-            try:
-                current_atom_indices=get_atom_indices(cycle, chains_in_group)
-            except KeyError: #chaingroup does not have chains belonging to current cycle
-                continue #continue to next chain group
-            atom_to_matrix_indices=get_atom_to_matrix_indices(current_atom_indices, atom_to_matrix_indices)
-
-            #2. within that group, go over legal switches and add their distance to the matrix
-            distances=fill_distance_matrix(len(current_atom_indices), cycle, chains_in_group, chain_perm, rotated_holder, Q_holder, atom_to_matrix_indices)
-
-            #3. call the perm builder on the group
-            perm = perm_builder(op_type, op_order, current_atom_indices, distances, perm)
-            #(4. either continue to next group or finish)
-    #print(perm)
+    for current_atom_indices, blocks in plan.groups:
+        # a group can take long, so the clock is read for each of them
+        if deadline is not None:
+            deadline.check_now()
+        #1. within the group, go over legal switches and add their distance to the matrix
+        distances=fill_distance_matrix(len(current_atom_indices), blocks, rotated, Q, plan.matrix_indices)
+
+        #2. call the perm builder on the group
+        perm = perm_builder(op_type, op_order, current_atom_indices, distances, perm)
+        #(3. either continue to next group or finish)
     return perm
 
 
-def approximate_perm_hungarian(op_type, op_order, molecule, dir, chain_perm):
-    #print("Inside estimate_perm, dir=%s" % dir)
+def approximate_perm_hungarian(op_type, op_order, molecule, dir, chain_perm, plan=None):
+    """
+    :param plan: the ApproxPlan of the molecule and chain_perm, which is built when not given
+    """
+    if plan is None:
+        plan = ApproxPlan(molecule, chain_perm)
     # create rotation matrix
     rotation_mat = create_rotation_matrix(1, op_type, op_order, dir)
     # run rotation matrix on atoms
-    rotated = (rotation_mat @ molecule.Q.T).T
-    cdef Vector3DHolder rotated_holder = Vector3DHolder(rotated)
-    cdef Vector3DHolder Q_holder = Vector3DHolder(molecule.Q)
-    cdef long[:] atom_to_matrix_indices = np.ones(len(molecule), dtype='long') * -1
+    cdef double[:, ::1] Q = plan.Q
+    cdef double[:, ::1] rotated = np.ascontiguousarray((rotation_mat @ plan.Q.T).T)
     # empty permutation:
     perm = [-1] * len(molecule)
 
-    #permutation is built by "group": equivalence class, and valid cycle within chain perm (then valid exchange w/n cycle)
-    for cycle in cycle_builder(chain_perm):
-        # Todo: Convert cycle into a vector[int]
-        for chains_in_group in molecule.groups_with_internal_chains:
-            #1. create the group of atom indices we will be building a distance matrix with
-            try:
-                current_atom_indices=get_atom_indices(cycle, chains_in_group)
-            except KeyError: #chaingroup does not have chains belonging to current cycle
-                continue #continue to next chain group
-            atom_to_matrix_indices=get_atom_to_matrix_indices(current_atom_indices, atom_to_matrix_indices)
-
-            #2. within that group, go over legal switches and add their distance to the matrix
-            distances=fill_distance_matrix(len(current_atom_indices), cycle, chains_in_group, chain_perm, rotated_holder, Q_holder, atom_to_matrix_indices)
-
-            #3. call the perm builder on the group
-            perm = hungarian_perm_builder(op_type, op_order, current_atom_indices, distances, perm)
-            #(4. either continue to next group or finish)
-    #print(perm)
+    for current_atom_indices, blocks in plan.groups:
+        #1. within the group, go over legal switches and add their distance to the matrix
+        distances=fill_distance_matrix(len(current_atom_indices), blocks, rotated, Q, plan.matrix_indices)
+
+        #2. call the perm builder on the group
+        perm = hungarian_perm_builder(op_type, op_order, current_atom_indices, distances, perm)
+        #(3. either continue to next group or finish)
     return perm
 
 @cython.boundscheck(False)
@@ -1,5 +1,6 @@
 import math
 import numpy as np
+from csm.calculations import constants
 cdef class Vector3D
 cdef class Matrix3D
 
@@ -38,62 +39,151 @@ cdef Matrix3D outer_product_sum(a, b):
             out[i][j]=a[i]*b[j] + b[i]*a[j]
     return Matrix3D.buffer_copy(out)
 
+# the doubles stored per pair of atoms: a 3x3 outer product sum, a cross product and an inner product
+cdef enum:
+    DOUBLES_PER_PAIR = 13
+
+
 cdef class Cache:
     """
     A class that stores the results of cross, outer, and inner products of two vectors.
-    Specifically, it stores all the combinations within each equivalence class.
-    These results can then be retrieved from dictionaries rather than recalculated each time.
-    Cannot be used on larger molecules.
+    Specifically, it stores all the combinations within each equivalence class, in dense arrays: the pairs of each
+    equivalence class are a contiguous block, addressed by the local indices of the two atoms within their class.
+    Equivalence classes are cached from the smallest up for as long as the arrays fit in max_memory bytes,
+    the products of atoms in the remaining classes are calculated on the fly.
     """
-    cdef _cross
-    cdef _outer
-    cdef _inner
-    cdef _mol
-    def __init__(self, mol):
-        self._cross= {}
-        self._outer = {}
-        self._inner={}
-        self._mol=mol
-        cdef int i, j
-        for group in mol.equivalence_classes:
-            for i in group:
-                for j in group:
-                    self._cross[(i,j)]= cross_product(mol.Q[i],mol.Q[j])
-                    self._inner[(i,j)]= inner_product(mol.Q[i],mol.Q[j])
-                    self._outer[(i,j)]= outer_product_sum(mol.Q[i],mol.Q[j])
+    cdef double[:, ::1] _Q
+    cdef double[:, :, ::1] _outer
+    cdef double[:, ::1] _cross
+    cdef double[::1] _inner
+    cdef long[::1] _group      # the equivalence class of each atom
+    cdef long[::1] _local      # the index of each atom within its equivalence class
+    cdef long[::1] _offset     # the start of the block of each atom's class, -1 if the class is not cached
+    cdef long[::1] _size       # the size of each atom's class
+    cdef public long cached_pairs
+    cdef public long uncached_groups
+
+    def __init__(self, mol, max_memory=None):
+        """
+        :param mol: the molecule
+        :param max_memory: the memory budget of the cache in bytes, the default is constants.CACHE_MAX_MEMORY
+        """
+        if max_memory is None:
+            max_memory = constants.CACHE_MAX_MEMORY
+        self._Q = np.ascontiguousarray(mol.Q, dtype=np.float64)
+        n = len(mol.Q)
+        group_of = np.zeros(n, dtype=np.int_)
+        local = np.zeros(n, dtype=np.int_)
+        offset = -np.ones(n, dtype=np.int_)
+        size = np.zeros(n, dtype=np.int_)
+        groups = [np.array(group, dtype=np.int_) for group in mol.equivalence_classes]
+        for g, group in enumerate(groups):
+            group_of[group] = g
+            local[group] = np.arange(len(group))
+            size[group] = len(group)
+
+        max_pairs = max_memory // (DOUBLES_PER_PAIR * 8)
+        self.cached_pairs = 0
+        self.uncached_groups = 0
+        for group in sorted(groups, key=len):
+            if self.cached_pairs + len(group) ** 2 > max_pairs:
+                self.uncached_groups += 1
+                continue
+            offset[group] = self.cached_pairs
+            self.cached_pairs += len(group) ** 2
+
+        outer = np.empty((self.cached_pairs, 3, 3))
+        cross = np.empty((self.cached_pairs, 3))
+        inner = np.empty(self.cached_pairs)
+        Q = np.asarray(self._Q)
+        for group in groups:
+            start = offset[group[0]]
+            if start == -1:
+                continue
+            end = start + len(group) ** 2
+            a = Q[group][:, np.newaxis, :]
+            b = Q[group][np.newaxis, :, :]
+            outer_ab = a[..., :, np.newaxis] * b[..., np.newaxis, :]
+            outer[start:end] = (outer_ab + np.swapaxes(outer_ab, -1, -2)).reshape(-1, 3, 3)
+            cross[start:end] = np.cross(a, b).reshape(-1, 3)
+            inner[start:end] = np.einsum('ijk,ijk->ij', a, b).reshape(-1)
+
+        self._outer = outer
+        self._cross = cross
+        self._inner = inner
+        self._group = group_of
+        self._local = local
+        self._offset = offset
+        self._size = size
+
+    cdef inline long _pair_index(Cache self, int i, int j) noexcept nogil:
+        if self.cached_pairs == 0 or self._offset[i] == -1 or self._group[i] != self._group[j]:
+            return -1
+        return self._offset[i] + self._local[i] * self._size[i] + self._local[j]
+
+    cdef double add_pair(Cache self, int i, int j, double (*A)[3], double a_mult, double *B, double b_mult) noexcept nogil:
+        """
+        The equivalent of A += a_mult * outer_product_sum(i, j), B += b_mult * cross(i, j), on the buffers of A and B
+        :return: inner_product(i, j)
+        """
+        cdef long index = self._pair_index(i, j)
+        cdef int k, l
+        cdef double *a
+        cdef double *b
+        if index != -1:
+            for k in range(3):
+                for l in range(3):
+                    A[k][l] += a_mult * self._outer[index, k, l]
+                B[k] += b_mult * self._cross[index, k]
+            return self._inner[index]
+
+        a = &self._Q[i, 0]
+        b = &self._Q[j, 0]
+        for k in range(3):
+            for l in range(3):
+                A[k][l] += a_mult * (a[k] * b[l] + b[k] * a[l])
+        B[0] += b_mult * (a[1] * b[2] - a[2] * b[1])
+        B[1] += b_mult * (a[2] * b[0] - a[0] * b[2])
+        B[2] += b_mult * (a[0] * b[1] - a[1] * b[0])
+        return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+    cdef double _inner_product(Cache self, int i, int j) noexcept nogil:
+        cdef long index = self._pair_index(i, j)
+        cdef double *a
+        cdef double *b
+        if index != -1:
+            return self._inner[index]
+        a = &self._Q[i, 0]
+        b = &self._Q[j, 0]
+        return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
 
     cpdef double inner_product(Cache self, int i, int j):
-        try:
-            return self._inner[(i,j)]
-        except KeyError:
-            return inner_product(self._mol.Q[i],self._mol.Q[j])
+        return self._inner_product(i, j)
 
     cpdef Matrix3D outer_product_sum(Cache self, int i, int j):
-        try:
-            return self._outer[(i,j)]
-        except KeyError:
-            return outer_product_sum(self._mol.Q[i],self._mol.Q[j])
+        cdef long index = self._pair_index(i, j)
+        cdef double out[3][3]
+        cdef int k, l
+        if index != -1:
+            for k in range(3):
+                for l in range(3):
+                    out[k][l] = self._outer[index, k, l]
+            return Matrix3D.buffer_copy(out)
+        return outer_product_sum(self._Q[i], self._Q[j])
 
     cpdef Vector3D cross(Cache self, int i, int j):
-        try:
-            return self._cross[(i,j)]
-        except KeyError:
-            return cross_product(self._mol.Q[i],self._mol.Q[j])
+        cdef long index = self._pair_index(i, j)
+        if index != -1:
+            return Vector3D.buffer_copy(&self._cross[index, 0])
+        return cross_product(self._Q[i], self._Q[j])
 
 
 cdef class FakeCache(Cache):
     """
     A class that inherits from Cache, and can return the same calculations, but does not actually cache anything.
-    Can be safely used on larger molecules.
+    Can be safely used on larger molecules. It allocates nothing, every product is calculated from the coordinates.
     """
     def __init__(self, mol):
-        self._mol=mol
-
-    cpdef double inner_product(FakeCache self, int i, int j):
-        return inner_product(self._mol.Q[i],self._mol.Q[j])
-
-    cpdef Matrix3D outer_product_sum(FakeCache self, int i, int j):
-        return outer_product_sum(self._mol.Q[i],self._mol.Q[j])
-
-    cpdef Vector3D cross(FakeCache self, int i, int j):
-        return cross_product(self._mol.Q[i],self._mol.Q[j])
\ No newline at end of file
+        self._Q = np.ascontiguousarray(mol.Q, dtype=np.float64)
+        self.cached_pairs = 0
+        self.uncached_groups = len(mol.equivalence_classes)
@@ -5,7 +5,7 @@
 # Measures and the Chirality Measure (Pinsky et al - 2008)
 #
 
-from libc.math cimport fabs
+from libc.math cimport fabs, sqrt
 
 import numpy as np
 cimport numpy as np
@@ -119,6 +119,66 @@ cdef PolynomialRoots(double coeffs[7], complex *roots):
         roots[i] = complex(zeror[i], zeroi[i])
 
 
+# The solvers get_lambda_max can use for the largest real root of the polynomial:
+# numpy - np.roots, the eigenvalues of the companion matrix
+# newton - a bracketed Newton iteration on the secular equation, see secular_lambda_max
+# (rpoly, the Jenkins-Traub solver in FastCPPUtils/rpoly.c, is not one of them: it misses the largest root when it
+# is close to a double root, with relative errors of up to 1e-1)
+ROOT_SOLVERS = ('numpy', 'newton')
+cdef enum:
+    SOLVER_NUMPY = 0
+    SOLVER_NEWTON = 1
+    NEWTON_MAX_ITERATIONS = 100
+cdef int root_solver = SOLVER_NUMPY
+
+
+def set_root_solver(solver):
+    global root_solver
+    if solver not in ROOT_SOLVERS:
+        raise ValueError("Unknown root solver %s, expected one of %s" % (solver, ", ".join(ROOT_SOLVERS)))
+    root_solver = ROOT_SOLVERS.index(solver)
+
+
+def get_root_solver():
+    return ROOT_SOLVERS[root_solver]
+
+
+cdef double secular_lambda_max(double *lambdas, double *m_t_B_2):
+    # The polynomial of equation 13 is prod (x - l_i)^2 - sum b_i prod_{j!=i} (x - l_j)^2, so beyond the largest
+    # eigenvalue L its roots are those of the secular equation f(x) = sum b_i / (x - l_i)^2 - 1 = 0.
+    # f decreases from +inf (or from f(L) when the b of L is zero) to -1 on (L, inf) and f(L + sqrt(sum b)) <= 0,
+    # so the largest root is the only one in (L, L + sqrt(sum b)], or L itself when f(L) <= 0.
+    # f is convex there, so Newton converges to it; steps that leave the bracket are replaced by bisection.
+    cdef double lo = lambdas[0], hi, x, new_x, f, df, d, total = 0
+    cdef int i, iteration
+    for i in range(3):
+        if lambdas[i] > lo:
+            lo = lambdas[i]
+        total += m_t_B_2[i]
+    hi = lo + sqrt(total)
+    x = hi
+    for iteration in range(NEWTON_MAX_ITERATIONS):
+        f = -1
+        df = 0
+        for i in range(3):
+            d = x - lambdas[i]
+            f += m_t_B_2[i] / (d * d)
+            df -= 2 * m_t_B_2[i] / (d * d * d)
+        if f > 0:
+            lo = x
+        elif f < 0:
+            hi = x
+        else:
+            return x
+        new_x = x - f / df
+        if not (lo < new_x < hi):
+            new_x = (lo + hi) / 2
+        if fabs(new_x - x) <= 1e-15 * (1 + fabs(x)):
+            return new_x
+        x = new_x
+    return x
+
+
 cpdef get_lambda_max(Vector3D lambdas, Vector3D m_t_B_2, log=False):
     cdef double coeffs[7]
     #cdef double rounded_coeffs[7]
@@ -144,6 +204,9 @@ cpdef get_lambda_max(Vector3D lambdas, Vector3D m_t_B_2, log=False):
             print("m_t_B_2 is zero, returning the maximum lambda as is ", str(lambda_max))
         return lambda_max
 
+    if root_solver == SOLVER_NEWTON:
+        return secular_lambda_max(lambdas.buf, m_t_B_2.buf)
+
     build_polynomial(lambdas, m_t_B_2, coeffs)
 
     roots=np.roots(coeffs)
@@ -186,6 +249,208 @@ cpdef calc_ref_plane_prochirality(int op_order, CalcState calc_state, np.ndarray
     csm = fabs(100 * (1.0 - csm / op_order))
     return csm, dir, None, None
 
+def calc_ref_plane_prochirality_batch(int op_order, np.ndarray A, np.ndarray CSM,
+                                      np.ndarray[DTYPE_t, ndim=1, mode="c"] v1,
+                                      np.ndarray[DTYPE_t, ndim=1, mode="c"] v2):
+    """
+    The batched counterpart of calc_ref_plane_prochirality, for a block of permutations, in one C loop
+    :param A: n x 3 x 3 array of the permutations' A matrices
+    :param CSM: array of the permutations' n preliminary CSM values
+    :return: an array of n CSM values and an n x 3 array of directions
+    """
+    cdef int n = len(CSM)
+    cdef int k, index
+    cdef double[:, :, ::1] A_view = np.ascontiguousarray(A, dtype=np.float64)
+    cdef double[::1] CSM_view = np.ascontiguousarray(CSM, dtype=np.float64)
+    cdef double vectors[2][2]
+    cdef double lambdas[2]
+    csms = np.zeros(n)
+    dirs = np.zeros((n, 3))
+    cdef double[::1] csms_view = csms
+    cdef double[:, ::1] dirs_view = dirs
+    for k in range(n):
+        fastcpp.GetEigens2D(<double (*)[3]> &A_view[k, 0, 0], <double *>v1.data, <double *>v2.data,
+                            <double (*)[2]>vectors, <double *>lambdas)
+        index = 0
+        if lambdas[0] < lambdas[1]:
+            index = 1
+        dirs_view[k, 0] = vectors[index][0]
+        dirs_view[k, 1] = vectors[index][1]
+        csms_view[k] = fabs(100 * (1.0 - (CSM_view[k] + lambdas[index] / 2) / op_order))
+    return csms, dirs
+
+cpdef double calc_csm_lower_bound(int op_order, CalcState calc_state):
+    """
+    Returns a lower bound on the CSM of any permutation that completes the partial permutation of calc_state.
+    The closed cycles contribute at most CSM + lambda_max(A) / 2 + |B| to the overlap that calc_ref_plane maximizes,
+    and each atom outside the closed cycles adds at most its squared norm per operation (Cauchy-Schwarz).
+    """
+    cdef Matrix3D m = Matrix3D.zero()
+    cdef Vector3D lambdas = Vector3D.zero()
+    cdef double lambda_max, b_norm, overlap, csm
+    cdef int i
+    fastcpp.GetEigens(calc_state.A.buf, m.buf, lambdas.buf)
+    lambda_max = lambdas.buf[0]
+    for i in range(1, 3):
+        if lambdas.buf[i] > lambda_max:
+            lambda_max = lambdas.buf[i]
+    b_norm = sqrt(calc_state.B.buf[0] * calc_state.B.buf[0] +
+                  calc_state.B.buf[1] * calc_state.B.buf[1] +
+                  calc_state.B.buf[2] * calc_state.B.buf[2])
+
+    overlap = calc_state.CSM + lambda_max / 2 + b_norm + (op_order - 1) * calc_state.remaining_norm
+    csm = 100 * (1.0 - overlap / op_order)
+    if csm < 0:
+        return 0.0
+    return csm
+
+def build_polynomials(np.ndarray lambdas, np.ndarray m_t_B_2):
+    """
+    The vectorized counterpart of build_polynomial: the coefficients of the polynomials of many permutations.
+    :param lambdas: n x 3 array of eigenvalues
+    :param m_t_B_2: n x 3 array
+    :return: n x 7 array of coefficients, the first column is for x^6
+    """
+    l0, l1, l2 = lambdas[:, 0], lambdas[:, 1], lambdas[:, 2]
+    b0, b1, b2 = m_t_B_2[:, 0], m_t_B_2[:, 1], m_t_B_2[:, 2]
+    coeffs = np.empty((len(lambdas), 7))
+    coeffs[:, 0] = 1.0
+    coeffs[:, 1] = -2 * (l0 + l1 + l2)
+    coeffs[:, 2] = l0 * l0 + l1 * l1 + l2 * l2 - b0 - b1 - b2 + 4 * (l0 * l1 + l0 * l2 + l1 * l2)
+    coeffs[:, 3] = -8 * l0 * l1 * l2 + \
+                   2 * (b0 * l1 + b0 * l2 + b1 * l0 + b1 * l2 + b2 * l0 + b2 * l1 -
+                        l0 * l2 * l2 - l0 * l0 * l1 - l0 * l0 * l2 - l0 * l1 * l1 - l1 * l1 * l2 - l1 * l2 * l2)
+    coeffs[:, 4] = 4 * (l0 * l1 * l2 * (l0 + l1 + l2) - (b2 * l0 * l1 + b1 * l0 * l2 + b0 * l2 * l1)) - \
+                   b0 * (l1 * l1 + l2 * l2) - b1 * (l0 * l0 + l2 * l2) - b2 * (l0 * l0 + l1 * l1) + \
+                   l0 * l0 * l1 * l1 + l1 * l1 * l2 * l2 + l0 * l0 * l2 * l2
+    coeffs[:, 5] = 2 * (b0 * l1 * l2 * (l1 + l2) + b1 * l0 * l2 * (l0 + l2) + b2 * l0 * l1 * (l0 + l1)) - \
+                   2 * (l0 * l1 * l1 * l2 * l2 + l0 * l0 * l1 * l2 * l2 + l0 * l0 * l1 * l1 * l2)
+    coeffs[:, 6] = -b0 * l1 * l1 * l2 * l2 - b1 * l0 * l0 * l2 * l2 - b2 * l0 * l0 * l1 * l1 + \
+                   l0 * l0 * l1 * l1 * l2 * l2
+    return coeffs
+
+
+def calc_ref_plane_batch(int op_order, bool is_op_cs, np.ndarray A, np.ndarray B, np.ndarray CSM):
+    """
+    The batched counterpart of calc_ref_plane, for a block of permutations. The eigen decompositions are done by
+    GetEigens in one C loop, so they (and the signs of the eigenvectors) are exactly those of calc_ref_plane,
+    and the polynomial roots and the directions of all the permutations are calculated by single numpy calls.
+    :param A: n x 3 x 3 array of the permutations' A matrices
+    :param B: n x 3 array of the permutations' B vectors
+    :param CSM: array of the permutations' n preliminary CSM values
+    :return: an array of n CSM values and an n x 3 array of directions
+    """
+    cdef int n = len(CSM)
+    cdef int k
+    cdef double[:, :, ::1] A_view = np.ascontiguousarray(A, dtype=np.float64)
+    lambdas = np.zeros((n, 3))
+    m = np.zeros((n, 3, 3))
+    cdef double[:, ::1] lambdas_view = lambdas
+    cdef double[:, :, ::1] m_view = m
+    with nogil:
+        for k in range(n):
+            fastcpp.GetEigens(<double (*)[3]> &A_view[k, 0, 0], <double (*)[3]> &m_view[k, 0, 0], &lambdas_view[k, 0])
+    # the rows of m are the eigenvectors
+    m_t_B = np.einsum('kij,kj->ki', m, B)
+    m_t_B_2 = m_t_B * m_t_B
+
+    # when m_t_B_2 is all zeros lambda_max is the maximal eigenvalue, otherwise it is the maximal real root of
+    # the polynomial (see get_lambda_max)
+    lambda_max = lambdas.max(axis=1)
+    has_B = np.any(m_t_B_2 >= ZERO_IM_PART_MAX, axis=1)
+    cdef double[:, ::1] m_t_B_2_view
+    cdef double[::1] lambda_max_view
+    if has_B.any() and root_solver == SOLVER_NEWTON:
+        m_t_B_2_view = np.ascontiguousarray(m_t_B_2)
+        lambda_max_view = lambda_max
+        for k in range(n):
+            if has_B[k]:
+                lambda_max_view[k] = secular_lambda_max(&lambdas_view[k, 0], &m_t_B_2_view[k, 0])
+        has_B[:] = False
+    if has_B.any():
+        coeffs = build_polynomials(lambdas[has_B], m_t_B_2[has_B])
+        # the roots are the eigenvalues of the companion matrices, as in np.roots
+        companion = np.zeros((len(coeffs), 6, 6))
+        companion[:, 0, :] = -coeffs[:, 1:]
+        companion[:, np.arange(1, 6), np.arange(5)] = 1.0
+        roots = np.linalg.eigvals(companion)
+        real_roots = np.where(np.abs(roots.imag) < ZERO_IM_PART_MAX, roots.real, -MAX_DOUBLE)
+        lambda_max[has_B] = real_roots.max(axis=1)
+
+    # the direction, as in calculate_dir
+    diffs = lambdas - lambda_max[:, np.newaxis]
+    rows = np.arange(n)
+    if is_op_cs or op_order == 2:
+        dirs = m[rows, np.argmin(np.abs(diffs), axis=1)]
+        m_max_B = np.zeros(n)
+    else:
+        is_close = np.abs(diffs) < 1e-5
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.where(is_close, 0.0, m_t_B / diffs)
+        dirs = np.einsum('kj,kji->ki', weights, m)
+        # error safety: an eigenvalue too close to lambda_max gives its eigenvector as the direction
+        any_close = is_close.any(axis=1)
+        dirs[any_close] = m[rows[any_close], np.argmax(is_close, axis=1)[any_close]]
+        m_max_B = np.einsum('ki,ki->k', dirs, B)
+
+    csm = CSM + (lambda_max - m_max_B) / 2
+    csm = np.abs(100 * (1.0 - csm / op_order))
+    return csm, dirs
+
+
+cdef class CalcStateBuffer:
+    """
+    Collects the A, B, CSM and permutation of completed permutations, so that their reference planes can be
+    calculated together by calc_ref_plane_batch
+    """
+    cdef public np.ndarray A
+    cdef public np.ndarray B
+    cdef public np.ndarray CSM
+    cdef public np.ndarray perms
+    cdef double[:, :, :] _A
+    cdef double[:, :] _B
+    cdef double[:] _CSM
+    cdef long[:, :] _perms
+    cdef public int size
+    cdef public int capacity
+
+    def __init__(self, int capacity, int molecule_size):
+        self.capacity = capacity
+        self.size = 0
+        self.A = np.zeros((capacity, 3, 3))
+        self.B = np.zeros((capacity, 3))
+        self.CSM = np.zeros(capacity)
+        self.perms = np.zeros((capacity, molecule_size), dtype='long')
+        self._A = self.A
+        self._B = self.B
+        self._CSM = self.CSM
+        self._perms = self.perms
+
+    cpdef bool add(CalcStateBuffer self, CalcState calc_state):
+        """
+        Copies calc_state into the buffer. Returns True when the buffer is full
+        """
+        cdef int i, j
+        cdef int k = self.size
+        for i in range(3):
+            for j in range(3):
+                self._A[k, i, j] = calc_state.A.buf[i][j]
+            self._B[k, i] = calc_state.B.buf[i]
+        self._CSM[k] = calc_state.CSM
+        for i in range(calc_state.molecule_size):
+            self._perms[k, i] = calc_state.perms.get_perm_value(1, i)
+        self.size += 1
+        return self.size == self.capacity
+
+    def calculate(CalcStateBuffer self, int op_order, bool is_op_cs):
+        """
+        Calculates the CSMs and directions of the buffered permutations, and empties the buffer
+        """
+        cdef int size = self.size
+        self.size = 0
+        return calc_ref_plane_batch(op_order, is_op_cs, self.A[:size], self.B[:size], self.CSM[:size])
+
+
 cpdef are_equal(double x, double y):
     return abs(x-y) < 1e-9
 
@@ -238,7 +503,8 @@ cpdef calc_ref_plane(int op_order, bool is_op_cs, CalcState calc_state, bool
 
     cdef Matrix3D m = Matrix3D.zero()
     cdef Vector3D lambdas = Vector3D.zero()
-    fastcpp.GetEigens(calc_state.A.buf, m.buf, lambdas.buf)
+    with nogil:
+        fastcpp.GetEigens(calc_state.A.buf, m.buf, lambdas.buf)
 
     if log:
         print("m:")
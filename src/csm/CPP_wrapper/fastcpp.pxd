@@ -1,8 +1,9 @@
 
 cdef extern from "FastCPPUtils.h":
+    # rpoly keeps its state in globals, so it needs the GIL
     int rpoly(double *coeffs, int degree, double *zeror, double *zeroi);
-    void GetEigens(const double matrix[3][3], double eigenVectors[3][3], double eigenValues[3]);
+    void GetEigens(const double matrix[3][3], double eigenVectors[3][3], double eigenValues[3]) nogil;
     void GetEigens2D(const double matrix[3][3], double v1[3], double v2[3],
-                     double eigenVectors[2][2], double eigenValues[2]);
+                     double eigenVectors[2][2], double eigenValues[2]) nogil;
 
-    void GramSchmidt(double matrix[3][3]);
+    void GramSchmidt(double matrix[3][3]) nogil;
@@ -2,10 +2,9 @@
 import ctypes
 import random
 
-import datetime
 import numpy as np
 
-from csm.calculations.basic_calculations import check_timeout, CalculationTimeoutError
+from csm.calculations.basic_calculations import Deadline, CalculationTimeoutError
 cimport numpy as np
 cimport cython
 import math
@@ -94,6 +93,7 @@ cdef class CalcState:
     cdef public int op_order
     cdef public int molecule_size
     cdef public double CSM
+    cdef public double remaining_norm
 
     def __init__(self, int molecule_size, int op_order, allocate=True):
         self.op_order = op_order
@@ -109,13 +109,15 @@ cdef class CalcState:
             for i in range(1,op_order):
                 self.perms.set_perm(i, neg_perm)
             self.CSM=1.0
+            self.remaining_norm=0.0
 
     cpdef public CalcState copy(CalcState self):
         cdef CalcState copy = CalcState(self.molecule_size, self.op_order, None)
         copy.A = self.A.copy()
         copy.B = self.B.copy()
         copy.perms = self.perms.copy()
-        copy.CSM=np.copy(self.CSM)
+        copy.CSM=self.CSM
+        copy.remaining_norm=self.remaining_norm
         #copy.perm=self.perm
         return copy
 
@@ -134,9 +136,12 @@ cdef class PermInProgress:
     cdef public long[:] q
     cdef int truecount
     cdef int falsecount
+    # true when the permchecker is a TruePermChecker, so that _switch does not need to ask it
+    cdef bint _always_legal
 
     def __init__(self, mol, op_order, op_type, permchecker=TruePermChecker):
         self.permchecker = permchecker(mol)
+        self._always_legal = type(self.permchecker) is TruePermChecker
         self.molecule_size =len(mol.atoms)
         self.state = CalcState(len(mol.atoms), op_order, True)
         self.op_order=op_order
@@ -146,7 +151,23 @@ cdef class PermInProgress:
         self.falsecount=0
 
     cpdef switch(PermInProgress self, int origin, int destination):
-        if self.permchecker.is_legal(self, origin, destination):
+        return self._switch(origin, destination)
+
+    cpdef unswitch(PermInProgress self, int origin, int destination):
+        self._unswitch(origin, destination)
+
+    cpdef close_cycle(self, group):
+        self.state.perm=self.p
+        return None
+
+    cpdef unclose_cycle(self, old_state):
+        pass
+
+    # The C level versions of switch, unswitch, close_cycle and unclose_cycle, for the Cython permuters. The cycle is
+    # given as a buffer of atoms, and the state close_cycle returns is a checkpoint number
+    @cython.profile(False)
+    cdef bint _switch(PermInProgress self, int origin, int destination) except -1:
+        if self._always_legal or self.permchecker.is_legal(self, origin, destination):
             self.p[origin]=destination
             self.q[destination]=origin
             self.truecount+=1
@@ -154,15 +175,16 @@ cdef class PermInProgress:
         self.falsecount+=1
         return False
 
-    cpdef unswitch(PermInProgress self, int origin, int destination):
+    @cython.profile(False)
+    cdef inline void _unswitch(PermInProgress self, int origin, int destination):
         self.p[origin]= -1
         self.q[destination] = -1
 
-    cpdef close_cycle(self, group):
-        self.state.perm=self.p
-        return None
+    cdef long _close_cycle(PermInProgress self, long *atoms, int num_atoms) except -1:
+        # the permuters set the permutation of the state when they yield it
+        return 0
 
-    cpdef unclose_cycle(self,  CalcState old_state):
+    cdef void _unclose_cycle(PermInProgress self, long checkpoint):
         pass
 
     property truecount:
@@ -179,14 +201,33 @@ cdef class PreCalcPIP(PermInProgress):
     cdef public double[:] costheta
     cdef public double[:] sintheta
     cdef double[:] multiplier
+    # The undo log: the (operation, atom, previous value) of every perms entry set by partial_calculate
+    cdef long[:, ::1] _undo_log
+    cdef int _undo_size
+    # A checkpoint for each closed cycle: the size of the undo log and A, B, CSM and remaining_norm before closing
+    cdef int[::1] _checkpoint_undo_size
+    cdef double[:, ::1] _checkpoint_values
+    cdef int _num_checkpoints
+    # the atoms of the cycle partial_calculate adds, as a C buffer for _add_cycle
+    cdef long[::1] _cycle_atoms
     def __init__(self, mol, op_order, op_type, permchecker=TruePermChecker, use_cache=True):
         super().__init__(mol, op_order, op_type, permchecker)
-        if use_cache: #and len(mol)<SomeNumber:
+        if use_cache:
+            # classes that do not fit in the cache's memory budget are calculated on the fly
             self.cache = Cache(mol)
         else:
             self.cache=FakeCache(mol)
 
         self.sintheta, self.costheta, self.multiplier= self._precalculate(op_type, op_order)
+        # The squared norm of the atoms that are not yet in a closed cycle, used for bounding the final CSM
+        self.state.remaining_norm=np.sum(np.square(mol.Q))
+        # the undo log and checkpoints are allocated by the first close_cycle, apply_cycle does not need them
+        self._undo_log = None
+        self._checkpoint_undo_size = None
+        self._checkpoint_values = None
+        self._undo_size = 0
+        self._num_checkpoints = 0
+        self._cycle_atoms = np.zeros(self.molecule_size, dtype=np.int_)
 
     cdef _precalculate(PreCalcPIP self, op_type, int op_order):
         cdef bool is_improper = op_type != 'CN'
@@ -209,34 +250,125 @@ cdef class PreCalcPIP(PermInProgress):
         return sintheta, costheta, multiplier
 
     cpdef close_cycle(self, group):
-        old_state = self.state.copy()
+        """
+        Adds the cycle to the calculation state
+        :return: a checkpoint that unclose_cycle restores the state to. Checkpoints are restored last in, first out,
+        restoring a checkpoint discards the ones taken after it
+        """
+        cdef int num_atoms = 0
+        for index in group:
+            self._cycle_atoms[num_atoms] = index
+            num_atoms += 1
+        return self._close_cycle(&self._cycle_atoms[0], num_atoms)
+
+    cpdef apply_cycle(self, group):
+        """
+        Adds the cycle to the calculation state without a checkpoint, for permutations that are never restored
+        """
         self.partial_calculate(group, self.cache)
-        return old_state
 
-    cpdef unclose_cycle(self,  CalcState old_state):
-        self.state = old_state
+    cpdef unclose_cycle(self, old_state):
+        self._unclose_cycle(old_state)
+
+    @cython.profile(False)
+    cdef long _close_cycle(PreCalcPIP self, long *atoms, int num_atoms) except -1:
+        cdef int k = self._num_checkpoints
+        cdef int i, j
+        cdef double csm = self.state.CSM
+        cdef double remaining_norm = self.state.remaining_norm
+        if self._undo_log is None:
+            # Every atom is in one closed cycle at most, so there are at most molecule_size cycles to undo
+            self._undo_log = np.zeros((self.molecule_size * self.op_order, 3), dtype=np.int_)
+            self._checkpoint_undo_size = np.zeros(self.molecule_size + 1, dtype=np.intc)
+            self._checkpoint_values = np.zeros((self.molecule_size + 1, 14))
+        if k > self.molecule_size or self._undo_size + num_atoms * self.op_order > self._undo_log.shape[0]:
+            raise ValueError("Closed more cycles than the molecule has atoms")
+        self._checkpoint_undo_size[k] = self._undo_size
+        for i in range(3):
+            for j in range(3):
+                self._checkpoint_values[k, 3 * i + j] = self.state.A.buf[i][j]
+            self._checkpoint_values[k, 9 + i] = self.state.B.buf[i]
+        self._checkpoint_values[k, 12] = csm
+        self._checkpoint_values[k, 13] = remaining_norm
+        self._num_checkpoints += 1
+        # the permuters calling close_cycle check for timeouts themselves
+        self._add_cycle(self.cache, atoms, num_atoms, self.state.perms.buffer, self.state.A.buf, self.state.B.buf,
+                        &csm, &remaining_norm)
+        self.state.CSM = csm
+        self.state.remaining_norm = remaining_norm
+        # checkpoints start at 1, so they are always true
+        return k + 1
+
+    @cython.profile(False)
+    cdef void _unclose_cycle(PreCalcPIP self, long checkpoint):
+        cdef int k = checkpoint - 1
+        cdef int i, j
+        cdef long[:, ::1] log = self._undo_log
+        while self._undo_size > self._checkpoint_undo_size[k]:
+            self._undo_size -= 1
+            self.state.perms.set_perm_value(log[self._undo_size, 0], log[self._undo_size, 1], log[self._undo_size, 2])
+        for i in range(3):
+            for j in range(3):
+                self.state.A.buf[i][j] = self._checkpoint_values[k, 3 * i + j]
+            self.state.B.buf[i] = self._checkpoint_values[k, 9 + i]
+        self.state.CSM = self._checkpoint_values[k, 12]
+        self.state.remaining_norm = self._checkpoint_values[k, 13]
+        self._num_checkpoints = k
+
+    cpdef double lower_bound(PreCalcPIP self):
+        """
+        A lower bound on the CSM of every permutation that can be completed from this one
+        """
+        return calc_csm_lower_bound(self.state.op_order, self.state)
 
     cdef partial_calculate(PreCalcPIP self, group, Cache cache):
-        #print("entered partial calculate")
-        cdef int iop
-        cdef int j
-        cdef int index, permuted_index
+        cdef long[::1] atoms = self._cycle_atoms
+        cdef int num_atoms = 0
+        cdef double csm = self.state.CSM
+        cdef double remaining_norm = self.state.remaining_norm
+        for index in group:
+            atoms[num_atoms] = index
+            num_atoms += 1
+        # the permuters calling close_cycle check for timeouts themselves
+        self._add_cycle(cache, &atoms[0], num_atoms, self.state.perms.buffer, self.state.A.buf, self.state.B.buf,
+                        &csm, &remaining_norm)
+        self.state.CSM = csm
+        self.state.remaining_norm = remaining_norm
+
+    @cython.profile(False)
+    cdef void _add_cycle(PreCalcPIP self, Cache cache, long *atoms, int num_atoms, long *perms, double (*A)[3],
+                         double *B, double *csm, double *remaining_norm) noexcept nogil:
+        """
+        Adds the cycle of the atoms to the permutations in perms, and its terms to A, B, the CSM and the remaining norm,
+        logging the previous values of perms for unclose_cycle while there are checkpoints to restore.
+        It works on raw buffers, without the GIL.
+        """
+        cdef bint log_undo = self._num_checkpoints > 0
+        cdef int iop, k
+        cdef long index, permuted_index
         cdef double dists
-        for iop in range(1, self.state.op_order):
-            check_timeout()
-            dists=0.0
-            for index in group:
-                permuted_index= self.state.perms.get_perm_value(iop - 1, self.p[index])
-                #1: permute the iopth perm in index j:
-                self.state.perms.set_perm_value(iop,index, permuted_index)
+        cdef int molecule_size = self.molecule_size
+        for k in range(num_atoms):
+            remaining_norm[0] -= cache._inner_product(atoms[k], atoms[k])
+        for iop in range(1, self.op_order):
+            dists = 0.0
+            for k in range(num_atoms):
+                index = atoms[k]
+                permuted_index = perms[(iop - 1) * molecule_size + self.p[index]]
+                #1: permute the iopth perm in index j, logging the previous value for unclose_cycle:
+                if log_undo:
+                    self._undo_log[self._undo_size, 0] = iop
+                    self._undo_log[self._undo_size, 1] = index
+                    self._undo_log[self._undo_size, 2] = perms[iop * molecule_size + index]
+                    self._undo_size += 1
+                perms[iop * molecule_size + index] = permuted_index
                 #2: A+= self.multiplier[iop] * cache.outer_product_sum(index, permuted_index)
-                self.state.A.add_mul(cache.outer_product_sum(index, permuted_index), self.multiplier[iop])
                 #3: B+=self.sintheta[iop]*cache.cross(index, permuted_index)
-                self.state.B.add_mul(cache.cross(index, permuted_index), self.sintheta[iop])
-                #4:
-                dists += cache.inner_product(index, permuted_index)
+                #4: dists+=cache.inner_product(index, permuted_index)
+                dists += cache.add_pair(index, permuted_index, A, self.multiplier[iop], B, self.sintheta[iop])
+
+            csm[0] += self.costheta[iop] * dists
 
-            self.state.CSM += self.costheta[iop] * dists
 
 
 
@@ -244,6 +376,61 @@ cdef class PreCalcPIP(PermInProgress):
 
 
 
+cdef class AutomorphismFilter:
+    """
+    Permutations that are conjugate by an automorphism of the molecule have the same CSM.
+    The filter accepts a permutation only if no conjugate of it is lexicographically smaller, comparing the indices in
+    the given order, so that only one permutation out of each such set needs to be measured.
+    A partial permutation is rejected as soon as the indices it fixes decide the comparison, which rejects its whole
+    subtree. The permuters give the order in which they fix the atoms, so that the fixed indices make up a prefix.
+    """
+    cdef long[:, :] automorphisms
+    cdef long[:, :] inverses
+    cdef long[:] order
+    cdef int num_automorphisms
+    cdef int molecule_size
+    cdef public int skipped
+
+    def __init__(self, automorphisms, molecule_size, order=None):
+        """
+        :param automorphisms: the automorphisms of the molecule
+        :param molecule_size: the number of atoms
+        :param order: the order in which the indices are compared, default is by index
+        """
+        identity = np.arange(molecule_size)
+        automorphisms = [g for g in automorphisms if not np.array_equal(g, identity)]
+        self.num_automorphisms = len(automorphisms)
+        self.molecule_size = molecule_size
+        self.automorphisms = np.array(automorphisms, dtype='long').reshape(self.num_automorphisms, molecule_size)
+        self.inverses = np.array([np.argsort(g) for g in automorphisms], dtype='long').reshape(self.num_automorphisms, molecule_size)
+        if order is None:
+            order = identity
+        self.order = np.array(order, dtype='long')
+        self.skipped = 0
+
+    cpdef bool is_canonical(AutomorphismFilter self, long[:] perm):
+        """
+        Whether perm, which may be partial (-1 at the indices it does not fix yet), can still be canonical.
+        A partial permutation is rejected only if every completion of it has a smaller conjugate: the first index in
+        the order where the conjugate differs from it is fixed in both, and there the conjugate is smaller
+        """
+        cdef int k, j, i, source
+        cdef long conjugate
+        for k in range(self.num_automorphisms):
+            for j in range(self.molecule_size):
+                i = self.order[j]
+                # the conjugate g*p*g^-1, at index i
+                source = self.inverses[k, i]
+                if perm[i] == -1 or perm[source] == -1:
+                    break
+                conjugate = self.automorphisms[k, perm[source]]
+                if conjugate < perm[i]:
+                    self.skipped += 1
+                    return False
+                if conjugate > perm[i]:
+                    break
+        return True
+
 
 cdef class CythonPermuter:
     cdef _groups
@@ -255,23 +442,33 @@ cdef class CythonPermuter:
     cdef next_cycle
     cdef mol
     cdef choose_cycle
-    cdef timeout
-    cdef start_time
+    cdef public deadline
+    cdef AutomorphismFilter _filter
 
-    def __init__(self, mol, op_order, op_type, keep_structure, precalculate=True, timeout=300):
+    def __init__(self, mol, op_order, op_type, keep_structure, precalculate=True, timeout=300, automorphisms=None,
+                 deadline=None):
         """
         :param mol:
         :param op_order:
         :param op_type:
         :param keep_structure:
         :param precalculate: false when we want perms WITHOUT csm (eg chainperm)
-        :param timeout:
+        :param timeout: the number of seconds before timing out, when no deadline is given
+        :param automorphisms: automorphisms of the molecule. when given, only one permutation out of each set of
+        permutations conjugate by them is returned
+        :param deadline: the Deadline of the calculation
         """
         self.count=0
+        self._filter=None
         self.mol=mol
         self._groups = mol.equivalence_classes
+        if automorphisms:
+            # the atoms are fixed group by group, each cycle starting at the first free atom of its group
+            self._filter=AutomorphismFilter(automorphisms, len(mol), [index for group in self._groups for index in group])
         self.choose_cycle=keep_structure
-        self.timeout=timeout
+        if deadline is None:
+            deadline=Deadline(timeout)
+        self.deadline=deadline
         if keep_structure:
             perm_checker=StructurePermChecker
         else:
@@ -281,7 +478,6 @@ cdef class CythonPermuter:
         else:
             perm_class=PermInProgress
 
-        self.start_time=datetime.datetime.now()
         self._pip = perm_class(mol, op_order, op_type, perm_checker)
         self._cycle_lengths = (1, op_order)
         if op_type == 'SN':
@@ -315,14 +511,17 @@ cdef class CythonPermuter:
             curr_atom<---curr_atom
             """
             #check if we've timed out:
-            check_timeout(self.start_time, self.timeout)
+            self.deadline.check()
             # Check if this can be a complete cycle
             if cycle_length in self._cycle_lengths:
                 # Yes it can, attempt to close it
                 if pip.switch(curr_atom, cycle_head):  # complete the cycle (close ends of necklace)
                     built_cycle.append(cycle_head)
                     saved_state=pip.close_cycle(built_cycle)
-                    if not remainder:  # perm has been completed
+                    if self._filter is not None and not self._filter.is_canonical(pip.p):
+                        # every permutation in this subtree has a smaller conjugate
+                        pass
+                    elif not remainder:  # perm has been completed
                         yield pip
                     else:
                         # cycle has been completed, start a new cycle with remaining atoms
@@ -377,6 +576,276 @@ cdef class CythonPermuter:
     property falsecount:
         def __get__(self):
             return self._pip.falsecount
+    property skipped:
+        def __get__(self):
+            if self._filter is None:
+                return 0
+            return self._filter.skipped
+
+
+# The stages of a frame in CythonStackPermuter's explicit stack
+cdef enum:
+    STAGE_ENTER = 0
+    STAGE_CLOSED = 1
+    STAGE_EXTEND = 2
+# The move of a frame that closed its cycle, in CythonStackPermuter's paths. The moves that extend the cycle are the
+# positions of the added atoms in their group
+cdef enum:
+    MOVE_CLOSE = -1
+# How many steps CythonStackPermuter takes between timeout checks
+cdef enum:
+    TIMEOUT_CHECK_INTERVAL = 1024
+
+cdef class CythonStackPermuter(CythonPermuter):
+    """
+    Enumerates the same permutations as CythonPermuter, in the same order, but walks the permutation tree
+    with an explicit stack over typed arrays instead of recursive generators.
+    Each frame of the stack stands for one call of CythonPermuter._group_recursive_permute: the atom it added
+    to the current cycle, the depth of the frame that started the cycle, the cycle's length and the group.
+    """
+    cdef long[::1] _group_atoms
+    cdef long[::1] _group_starts
+    cdef long[::1] _free
+    cdef int _num_groups
+    cdef long[::1] _path
+    cdef long[::1] _head_depth
+    cdef long[::1] _cycle_length
+    cdef long[::1] _group
+    cdef long[::1] _stage
+    cdef long[::1] _next_pos
+    cdef long[::1] _child
+    # the checkpoint close_cycle returned for the cycle closed at each depth
+    cdef long[::1] _saved_states
+    # the atoms of the cycle being closed, in the order close_cycle expects them
+    cdef long[::1] _cycle
+    cdef long[::1] _used
+    cdef long[::1] _allowed_length
+    # the pip calculates the permutation of its state when it closes the cycles
+    cdef bint _precalculated
+    cdef list _adjacent
+    cdef bint _keep_structure
+    cdef int _depth
+    cdef long _steps
+    # the move each frame made to push the frame above it
+    cdef long[::1] _moves
+    # the paths of the work unit and the paths leading to them, or None
+    cdef set _unit_branches
+    cdef int _split_depth
+    # while split() runs, the paths it returns
+    cdef list _split_paths
+
+    def __init__(self, mol, op_order, op_type, keep_structure, precalculate=True, timeout=300, automorphisms=None,
+                 work_unit=None, split_depth=2, deadline=None):
+        """
+        :param work_unit: some of the paths that split() returns. when given, only the branches on them are explored,
+        so that permuters given all of the paths together enumerate every permutation exactly once
+        :param split_depth: the depth of the stack at which the tree is split into work units
+        """
+        super().__init__(mol, op_order, op_type, keep_structure, precalculate, timeout, automorphisms, deadline)
+        cdef int size = len(mol)
+        cdef int length
+        groups = self._groups
+        self._num_groups = len(groups)
+        self._group_atoms = np.array([index for group in groups for index in group], dtype='long')
+        self._group_starts = np.cumsum([0] + [len(group) for group in groups], dtype='long')
+        self._free = np.zeros(self._num_groups, dtype='long')
+        self._path = np.zeros(size, dtype='long')
+        self._head_depth = np.zeros(size, dtype='long')
+        self._cycle_length = np.zeros(size, dtype='long')
+        self._group = np.zeros(size, dtype='long')
+        self._stage = np.zeros(size, dtype='long')
+        self._next_pos = np.zeros(size, dtype='long')
+        self._child = np.zeros(size, dtype='long')
+        self._saved_states = np.zeros(size, dtype='long')
+        self._cycle = np.zeros(size, dtype='long')
+        self._precalculated = precalculate
+        self._used = np.zeros(size, dtype='long')
+        self._allowed_length = np.zeros(self._max_length + 1, dtype='long')
+        for length in self._cycle_lengths:
+            self._allowed_length[length] = 1
+        self._adjacent = [atom.adjacent for atom in mol.atoms]
+        self._keep_structure = keep_structure
+        self._depth = -1
+        self._steps = 0
+        self._moves = np.zeros(size, dtype='long')
+        self._unit_branches = None
+        if work_unit is not None:
+            self._unit_branches = {tuple(path[:depth]) for path in work_unit for depth in range(len(path) + 1)}
+        self._split_depth = split_depth
+        self._split_paths = None
+
+    @cython.profile(False)
+    cdef int _choose_cycle_head(self, int group):
+        """
+        The first free atom of the group, or when keeping the structure, the first one with a placed neighbor
+        """
+        cdef int pos, atom, neighbor
+        cdef int first = -1
+        for pos in range(self._group_starts[group], self._group_starts[group + 1]):
+            atom = self._group_atoms[pos]
+            if self._used[atom]:
+                continue
+            if first == -1:
+                first = atom
+                if not self._keep_structure or self._free[group] == 1:
+                    return first
+            for neighbor in self._adjacent[atom]:
+                if self._pip.p[neighbor] != -1:
+                    return atom
+        return first
+
+    @cython.profile(False)
+    cdef void _push(self, int atom, int head_depth, int cycle_length, int group):
+        cdef int depth = self._depth + 1
+        self._path[depth] = atom
+        self._head_depth[depth] = depth if head_depth == -1 else head_depth
+        self._cycle_length[depth] = cycle_length
+        self._group[depth] = group
+        self._stage[depth] = STAGE_ENTER
+        self._child[depth] = -1
+        self._used[atom] = 1
+        self._free[group] -= 1
+        self._depth = depth
+
+    @cython.profile(False)
+    cdef void _pop(self):
+        cdef int depth = self._depth
+        self._used[self._path[depth]] = 0
+        self._free[self._group[depth]] += 1
+        self._depth = depth - 1
+
+    @cython.profile(False)
+    cdef void _push_cycle_head(self, int group):
+        self._push(self._choose_cycle_head(group), -1, 1, group)
+
+    @cython.profile(False)
+    cdef int _build_cycle(self, int depth):
+        """
+        Fills _cycle with the cycle that ends at the given depth, and returns its length
+        """
+        cdef int i
+        cdef int head_depth = self._head_depth[depth]
+        cdef int length = 0
+        for i in range(head_depth + 1, depth + 1):
+            self._cycle[length] = self._path[i]
+            length += 1
+        self._cycle[length] = self._path[head_depth]
+        return length + 1
+
+    cdef tuple _branch_path(self, int length):
+        """
+        The path of the branch reached by the moves of the first length frames
+        """
+        cdef int i
+        return tuple([self._moves[i] for i in range(length)])
+
+    cdef bool _owns_branch(self, int length):
+        """
+        Whether the branch reached by the moves of the first length frames, which is no deeper than split_depth,
+        belongs to the work unit
+        """
+        return self._unit_branches is None or self._branch_path(length) in self._unit_branches
+
+    @cython.profile(False)
+    cdef bool _next_perm(self) except *:
+        """
+        Advances the stack to the next complete permutation. Returns False when there are none left
+        """
+        cdef int depth, curr, head, group, pos, atom, length
+        cdef PermInProgress pip = self._pip
+        while self._depth >= 0:
+            self._steps += 1
+            if self._steps % TIMEOUT_CHECK_INTERVAL == 0:
+                self.deadline.check_now()
+            depth = self._depth
+            curr = self._path[depth]
+            head = self._path[self._head_depth[depth]]
+            group = self._group[depth]
+
+            if self._stage[depth] == STAGE_ENTER:
+                if depth <= self._split_depth:
+                    if self._split_paths is not None and depth == self._split_depth:
+                        self._split_paths.append(self._branch_path(depth))
+                        self._pop()
+                        continue
+                    if not self._owns_branch(depth):
+                        self._pop()
+                        continue
+                self._stage[depth] = STAGE_EXTEND
+                self._next_pos[depth] = self._group_starts[group]
+                # Check if this can be a complete cycle, and attempt to close it
+                if self._allowed_length[self._cycle_length[depth]] and pip._switch(curr, head):
+                    self._stage[depth] = STAGE_CLOSED
+                    length = self._build_cycle(depth)
+                    self._saved_states[depth] = pip._close_cycle(&self._cycle[0], length)
+                    self._moves[depth] = MOVE_CLOSE
+                    if self._filter is not None and not self._filter.is_canonical(pip.p):
+                        # every permutation in this subtree has a smaller conjugate
+                        pass
+                    elif self._free[group] > 0:
+                        self._push_cycle_head(group)
+                    elif group + 1 < self._num_groups:
+                        self._push_cycle_head(group + 1)
+                    elif self._split_paths is not None:
+                        # a permutation completed above split_depth
+                        self._split_paths.append(self._branch_path(depth + 1))
+                    elif depth >= self._split_depth or self._owns_branch(depth + 1):
+                        return True
+                continue
+
+            if self._stage[depth] == STAGE_CLOSED:
+                pip._unclose_cycle(self._saved_states[depth])
+                pip._unswitch(curr, head)
+                self._stage[depth] = STAGE_EXTEND
+                # go on to extending the cycle in the same step
+
+            # STAGE_EXTEND: try to extend the partial cycle with each of the free atoms in turn
+            if self._child[depth] != -1:
+                pip._unswitch(curr, self._child[depth])
+                self._child[depth] = -1
+            if self._cycle_length[depth] < self._max_length:
+                for pos in range(self._next_pos[depth], self._group_starts[group + 1]):
+                    atom = self._group_atoms[pos]
+                    if self._used[atom]:
+                        continue
+                    if pip._switch(curr, atom):
+                        self._next_pos[depth] = pos + 1
+                        self._child[depth] = atom
+                        self._moves[depth] = pos
+                        self._push(atom, self._head_depth[depth], self._cycle_length[depth] + 1, group)
+                        break
+                else:
+                    self._pop()
+            else:
+                self._pop()
+        return False
+
+    def permute(self):
+        cdef int group
+        self._depth = -1
+        self._used[:] = 0
+        for group in range(self._num_groups):
+            self._free[group] = self._group_starts[group + 1] - self._group_starts[group]
+        self._push_cycle_head(0)
+        while self._next_perm():
+            self.count+=1
+            if not self._precalculated:
+                self._pip.state.perm=self._pip.p
+            yield self._pip.state
+
+    def split(self):
+        """
+        The paths (the moves of the frames along the way) of the branches at split_depth, and of the permutations
+        completed above it. Only the frames up to split_depth are walked, and the subtrees of the paths are enumerated
+        separately by permuters given them as their work_unit
+        """
+        self._split_paths = []
+        try:
+            for state in self.permute():
+                pass
+            return self._split_paths
+        finally:
+            self._split_paths = None
 
 
 class SinglePermPermuter:
@@ -385,7 +854,7 @@ class SinglePermPermuter:
         def __init__(self, mol, perm, op_order, op_type):
             super().__init__(mol, op_order, op_type, TruePermChecker, use_cache=False)
             self.p=perm
-            self.close_cycle(perm)
+            self.apply_cycle(perm)
             self.state.perm=perm
 
     def __init__(self, perm, mol, op_order, op_type):
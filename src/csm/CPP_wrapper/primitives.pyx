@@ -250,13 +250,13 @@ cdef class PermsHolder:
         memcpy(copy.buffer, self.buffer, self.buf_size)
         return copy
 
-    cdef inline _get_index(PermsHolder self, int op_order, int offset):
+    cdef inline long _get_index(PermsHolder self, int op_order, int offset) noexcept nogil:
         return (op_order * self.molecule_size + offset)
 
-    cdef public inline long get_perm_value(PermsHolder self, int op_order, int offset):
+    cdef public inline long get_perm_value(PermsHolder self, int op_order, int offset) noexcept nogil:
         return self.buffer[self._get_index(op_order, offset)]
 
-    cdef public inline void set_perm_value(PermsHolder self, int op_order, int offset, int value):
+    cdef public inline void set_perm_value(PermsHolder self, int op_order, int offset, int value) noexcept nogil:
         self.buffer[self._get_index(op_order, offset)] = value
 
     def _check_indices(PermsHolder self, indices):
@@ -3,7 +3,7 @@ This module is for all the calculations that power the CSM calculation
 """
 from csm.calculations.approx.approximators import ApproxCalculation, ParallelApprox
 from csm.calculations.approx.dirs import DirectionChooser
-from csm.calculations.exact_calculations import ExactCalculation
+from csm.calculations.exact_calculations import ExactCalculation, ParallelExact
 from csm.calculations.trivial_calculations import TrivialCalculation
 
 # approx=approx_calculation
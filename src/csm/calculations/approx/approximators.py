@@ -2,44 +2,125 @@
 the classes used for running the approximate algorithm
 '''
 
-import datetime
 import multiprocessing
+import multiprocessing.pool
+import threading
 
 import numpy as np
 
 from csm.calculations.approx.perm_builders import _OptionalLogger, _HungarianPermBuilder, _GreedyPermBuilder, \
     _ManyChainsPermBuilder, _StructuredPermBuilder
-from csm.calculations.approx.statistics import SingleDirectionStatistics, ApproxStatistics
-from csm.calculations.basic_calculations import CalculationTimeoutError, check_timeout
+from csm.calculations.approx.statistics import SingleDirectionStatistics, SentDirectionStatistics, ApproxStatistics, \
+    MERGED_STOP_REASON
+from csm.calculations.basic_calculations import CalculationTimeoutError, Deadline, init_pool_deadline
 from csm.calculations.basic_calculations import now, run_time
-from csm.calculations.constants import MAX_DOUBLE, CSM_THRESHOLD
+from csm.calculations.constants import MAX_DOUBLE, CSM_THRESHOLD, DIRECTION_MERGE_TOLERANCE
 from csm.calculations.data_classes import CSMState, CSMResult, BaseCalculation
 from csm.calculations.exact_calculations import ExactCalculation
 
 from csm.input_output.formatters import csm_log as print
 
-
-
+# The _ApproxWorker of a process of ParallelApprox's pool, set by the pool initializer
+_approx_worker = None
+
+
+def _init_approx_worker(approx_worker, cancelled):
+    global _approx_worker
+    init_pool_deadline(cancelled)
+    _approx_worker = approx_worker
+
+
+class _PermMemo:
+    '''
+    The results of the permutations already measured by a calculation. Different start directions often converge to the
+    same permutation, and iterations revisit them, so each permutation is only measured once per operation.
+    '''
+    def __init__(self):
+        self._results = {}
+
+    def calculate(self, operation, molecule, perm):
+        '''
+        :return: the result of perm, and whether it was already measured
+        '''
+        key = (operation.op_code, np.asarray(perm, dtype=np.int64).tobytes())
+        try:
+            return self._results[key], True
+        except KeyError:
+            result = self._results[key] = ExactCalculation.exact_calculation_for_approx(operation, molecule, perm=perm)
+            return result, False
+
+
+class _ConvergedDirections:
+    '''
+    The directions that the converged paths of a calculation's start directions went through, for each operation and
+    chain permutation. A path that reaches one of them goes on as the earlier path did, so it is stopped there and its
+    start direction is merged into the earlier one. d and -d are the same axis (or plane normal).
+    '''
+    def __init__(self, tolerance=DIRECTION_MERGE_TOLERANCE):
+        self._tolerance = tolerance
+        self._dirs = {}
+        # in a pool of threads, the threads add to the same directions
+        self._lock = threading.Lock()
+
+    def add(self, operation, chain_perm, dirs):
+        key = (operation.op_code, tuple(chain_perm))
+        dirs = np.array(dirs, dtype=np.float64).reshape(-1, 3)
+        with self._lock:
+            known = self._dirs.get(key)
+            self._dirs[key] = dirs if known is None else np.vstack((known, dirs))
+
+    def __getstate__(self):
+        # locks aren't pickled, each process of a pool has its own
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def contains(self, operation, chain_perm, dir):
+        known = self._dirs.get((operation.op_code, tuple(chain_perm)))
+        if known is None:
+            return False
+        dir = np.asarray(dir, dtype=np.float64)
+        distances = np.minimum(np.linalg.norm(known - dir, axis=1), np.linalg.norm(known + dir, axis=1))
+        return bool(np.any(distances <= self._tolerance))
 
 
 class SingleDirApproximator(_OptionalLogger):
     def __init__(self, operation, molecule, perm_from_dir_builder, log_func=None, timeout=100,
-                 max_iterations=50, chain_perms=None, callback_function=None, close_func=None):
+                 max_iterations=50, chain_perms=None, callback_function=None, close_func=None, deadline=None,
+                 perm_memo=None, converged_dirs=None, symmetric_index=None):
         self._log_func = log_func
+        # the memo of the calculation, shared by all its directions
+        if perm_memo is None:
+            perm_memo = _PermMemo()
+        self.perm_memo = perm_memo
+        # the paths of the directions that already converged, also shared by all the directions
+        if converged_dirs is None:
+            converged_dirs = _ConvergedDirections()
+        self.converged_dirs = converged_dirs
+        # in ParallelApprox, the index of the first direction found to have the symmetry, and the index of the
+        # direction being approximated
+        self.symmetric_index = symmetric_index
+        self.direction_index = 0
+        # the deadline of the calculation, or a new one timing out after timeout seconds
+        if deadline is None:
+            deadline = Deadline(timeout)
+        self.deadline = deadline
         self._molecule = molecule
         self._op_type = operation.type
         self._op_order = operation.order
         self._operation = operation
         self.max_iterations = max_iterations
-        self.perm_from_dir_builder = perm_from_dir_builder(operation, molecule, log_func, timeout)
+        self.perm_from_dir_builder = perm_from_dir_builder(operation, molecule, log_func, deadline)
         if not chain_perms:
             self._chain_permutations = self.perm_from_dir_builder.get_chain_perms()
         else:
             self._chain_permutations=chain_perms
-        self.timeout = timeout
         self.callback_function = callback_function
         self.close_func = close_func
-        self.start = datetime.datetime.now()
 
 
     def _create_perm_from_dir(self, dir, chain_perm):
@@ -51,29 +132,44 @@ class SingleDirApproximator(_OptionalLogger):
         best = CSMState(molecule=self._molecule, op_type=self._op_type, op_order=self._op_order, csm=MAX_DOUBLE)
         self._log("Calculating for initial direction: ", dir)
         for chain_perm in self._chain_permutations:
+            if self._cancelled():
+                statistics.stop_reason = "Cancelled"
+                break
             if len(self._chain_permutations) > 1:
                 self._log("\tCalculating for chain permutation ", chain_perm)
             best_for_chain_perm = old_results = CSMState(molecule=self._molecule, op_type=self._op_type,
                                                          op_order=self._op_order,
                                                          csm=MAX_DOUBLE, dir=dir)
+            # the directions the permutations were built from, and whether they ended in a converged direction
+            path = [dir]
+            converged = False
             i = 0
             while True:
-                check_timeout(self.start, self.timeout)
+                self.deadline.check_now()
+                if self._cancelled():
+                    statistics.stop_reason = "Cancelled"
+                    self._log("\t\tStopping because another direction found the symmetry")
+                    break
                 i += 1
 
                 self._log("\t\titeration", i, ":")
 
                 try:
                     perm = self._create_perm_from_dir(old_results.dir, chain_perm)
-                    interim_results = ExactCalculation.exact_calculation_for_approx(self._operation,
-                                                                                    self._molecule, perm=perm)
+                    interim_results, memoized = self.perm_memo.calculate(self._operation, self._molecule, perm)
+                    if memoized:
+                        statistics.memo_hits += 1
+                        self._log("\t\t\tthis permutation was already measured")
                     if self.callback_function:
+                        traced_results = old_results
+                        if getattr(self.callback_function, "traces_measured", False):
+                            traced_results = interim_results
                         curr_state = CSMState(molecule=self._molecule, 
                         op_order=self._op_order, 
                         op_type=self._op_type, 
-                        csm=old_results.csm,
+                        csm=traced_results.csm,
                         perm=perm, 
-                        dir=old_results.dir)
+                        dir=traced_results.dir)
                         curr_state.serial = i
                         
                         self.callback_function(curr_state)
@@ -116,13 +212,24 @@ class SingleDirApproximator(_OptionalLogger):
                 if abs(np.linalg.norm(interim_results.dir - old_results.dir)) <= 0:
                     statistics.stop_reason = "No change in direction"
                     self._log("\t\tStopping because the direction has not changed")
+                    converged = True
                     break
                 if interim_results.csm >= old_results.csm:  # We found a worse CSM
                     statistics.stop_reason = "No improvement in CSM"
                     self._log("\t\tStopping because CSM did not improve (worse or equal)")
+                    converged = True
+                    break
+                if self.converged_dirs.contains(self._operation, chain_perm, interim_results.dir):
+                    statistics.stop_reason = MERGED_STOP_REASON
+                    self._log("\t\tStopping because the direction is on the path of a converged direction")
+                    converged = True
                     break
 
                 old_results = interim_results
+                path.append(interim_results.dir)
+
+            if converged:
+                self.converged_dirs.add(self._operation, chain_perm, path)
 
             if best_for_chain_perm.csm < best.csm:
                 best = best_for_chain_perm
@@ -132,12 +239,78 @@ class SingleDirApproximator(_OptionalLogger):
         statistics.end_clock()
         return best, statistics
 
+    def _cancelled(self):
+        # in ParallelApprox, whether a direction before this one has already found the symmetry
+        return self.symmetric_index is not None and self.symmetric_index.value < self.direction_index
+
+
+class _ApproxWorker:
+    """
+    What a process of ParallelApprox's pool needs to approximate from a start direction: the molecule, the perm builder,
+    the index of the first direction found to have the symmetry, shared by the processes, and a memo of the
+    permutations the process measured. It is sent to each process once, when the pool starts, so the tasks are only the
+    directions. In a pool of threads, the threads share one worker.
+    """
+    def __init__(self, molecule, perm_builder, chain_perms, deadline, symmetric_index):
+        self.molecule = molecule
+        self.perm_builder = perm_builder
+        self.chain_perms = chain_perms
+        self.deadline = deadline
+        self.symmetric_index = symmetric_index
+        self._perm_memo = _PermMemo()
+        self._converged_dirs = _ConvergedDirections()
+        self._approximators = {}
+
+    def approximator(self, operation, max_iterations):
+        # the approximators, and the chain permutations of their perm builders, are kept for the following directions.
+        # Each thread has its own, since the perm builders keep state between calls
+        key = (operation.op_code, max_iterations, threading.get_ident())
+        try:
+            return self._approximators[key]
+        except KeyError:
+            approximator = self._approximators[key] = SingleDirApproximator(operation, self.molecule,
+                                                                            self.perm_builder,
+                                                                            max_iterations=max_iterations,
+                                                                            chain_perms=self.chain_perms,
+                                                                            deadline=self.deadline,
+                                                                            perm_memo=self._perm_memo,
+                                                                            converged_dirs=self._converged_dirs,
+                                                                            symmetric_index=self.symmetric_index)
+            return approximator
+
+    def approximate_direction(self, task):
+        """
+        Approximates from one start direction
+        :return: the index of the direction, and its csm, perm and dir and the dictionary of its statistics, or None if
+        a direction before it has already found the symmetry
+        """
+        index, dir, operation, max_iterations = task
+        approximator = self.approximator(operation, max_iterations)
+        approximator.direction_index = index
+        if approximator._cancelled():
+            return index, None
+        result, statistics = approximator.calculate(dir)
+        if result.csm < CSM_THRESHOLD:
+            # the directions after this one can stop
+            with self.symmetric_index.get_lock():
+                self.symmetric_index.value = min(self.symmetric_index.value, index)
+        perm = list(result.perm) if result.perm is not None else None
+        return index, (result.csm, perm, result.dir, statistics.to_dict())
+
+
+def _approximate_direction(task):
+    # approximates from one start direction, in a process of ParallelApprox's pool
+    return _approx_worker.approximate_direction(task)
+
 
 class ApproxCalculation(BaseCalculation, _OptionalLogger):
     def __init__(self, operation, molecule, direction_chooser, approx_algorithm='hungarian',
-                 log_func=None, selective=False, num_selected=10, chain_perms=None, callback_func=None, close_func=None, *args, **kwargs):
+                 log_func=None, selective=False, num_selected=10, chain_perms=None, callback_func=None, close_func=None,
+                 ops_pool_size=None, deadline=None, *args, **kwargs):
 
-        super().__init__(operation, molecule)
+        super().__init__(operation, molecule, ops_pool_size=ops_pool_size, deadline=deadline)
+        if ops_pool_size and (log_func or callback_func):
+            raise ValueError("Cannot log or output permutations when calculating operations in parallel")
 
         if log_func==None:
             log_func=self._empty_log
@@ -165,6 +338,8 @@ class ApproxCalculation(BaseCalculation, _OptionalLogger):
         self.statistics={}
         self.chain_perms=chain_perms
         self._max_iterations = 30
+        self._perm_memo = _PermMemo()
+        self._converged_dirs = _ConvergedDirections()
         self.callback_func = callback_func
         self.close_func = close_func
 
@@ -172,15 +347,30 @@ class ApproxCalculation(BaseCalculation, _OptionalLogger):
         return
 
     def calculate(self, timeout=100, *args, **kwargs):
-        self.timeout = timeout
         overall_stats = {}
         best_result = super().calculate(timeout)
         overall_stats["runtime"] = run_time(self.start_time)
+        overall_stats["perm memo hit rate"] = self._memo_hit_rate()
+        overall_stats["merged starts"] = sum(ApproxStatistics.num_merged(op_statistics)
+                                             for op_statistics in self.statistics.values())
         self.result = CSMResult(best_result, self.operation, overall_stats=overall_stats,
                                 ongoing_stats={"approx": self.statistics})
         return self.result
 
-    def _calculate(self, operation, timeout):
+    def _memo_hit_rate(self):
+        # the fraction of the measured permutations that were found in the memo, over the directions of all operations
+        evaluations = hits = 0
+        for op_statistics in self.statistics.values():
+            for direction_dict in op_statistics:
+                evaluations += direction_dict["stats"].get("num iterations", 0)
+                hits += direction_dict["stats"].get("memo hits", 0)
+        if not evaluations:
+            return 0.0
+        return hits / evaluations
+
+    def _calculate(self, operation, deadline):
+        # the statistics of each operation start over, so that they only count its own directions
+        self._single_statistics = ApproxStatistics(self._initial_directions)
 
         if operation.type == 'CI' or (operation.type == 'SN' and operation.order == 2):
             dir = [1.0, 0.0, 0.0]
@@ -189,33 +379,40 @@ class ApproxCalculation(BaseCalculation, _OptionalLogger):
             else:
                 op_msg = 'CI'
             self._log("Operation %s - using just one direction: %s" % (op_msg, dir))
-            best_result = self._calculate_for_directions(operation, [dir], 1)
+            best_result = self._calculate_for_directions(operation, [dir], 1, deadline)
         else:
             if self.selective:
-                self._calculate_for_directions(operation, self._initial_directions, 1)
+                self._calculate_for_directions(operation, self._initial_directions, 1, deadline)
                 best_dirs = []
                 sorted_csms = sorted(self._single_statistics.directions_arr)
                 for item in sorted_csms[:self.num_selected]:
                     best_dirs.append(item.start_dir)
                     self._log("Running again on the", self.num_selected, "best directions")
-                best_result = self._calculate_for_directions(operation, best_dirs, self._max_iterations)
+                best_result = self._calculate_for_directions(operation, best_dirs, self._max_iterations, deadline)
 
             else:
-                best_result = self._calculate_for_directions(operation, self._initial_directions, self._max_iterations)
+                best_result = self._calculate_for_directions(operation, self._initial_directions, self._max_iterations,
+                                                             deadline)
 
 
 
         self.statistics[operation.op_code]=self._single_statistics.to_dict()
         return best_result
 
-    def _calculate_for_directions(self, operation, dirs, max_iterations):
+    def _combine_statistics(self, statistics):
+        for op_statistics in statistics:
+            self.statistics.update(op_statistics)
+
+    def _calculate_for_directions(self, operation, dirs, max_iterations, deadline):
         best = CSMState(molecule=self.molecule, op_type=operation.type, op_order=operation.order, csm=MAX_DOUBLE,
                         num_invalid=MAX_DOUBLE)
         single_dir_approximator = SingleDirApproximator(operation, self.molecule,
                                                         self.perm_builder, self._log,
-                                                        self.timeout, max_iterations=max_iterations, chain_perms=self.chain_perms,
+                                                        max_iterations=max_iterations, chain_perms=self.chain_perms,
                                                         callback_function=self.callback_func,
-                                                        close_func = self.close_func)
+                                                        close_func = self.close_func, deadline=deadline,
+                                                        perm_memo=self._perm_memo,
+                                                        converged_dirs=self._converged_dirs)
         for dir in dirs:
             best_result_for_dir, statistics = single_dir_approximator.calculate(dir)
             self._single_statistics[dir] = statistics
@@ -231,51 +428,103 @@ class ApproxCalculation(BaseCalculation, _OptionalLogger):
 
 
 class ParallelApprox(ApproxCalculation):
+    '''
+    Approximates from the start directions in a pool of processes, which is kept for all the directions of the
+    calculation. Each process receives the molecule once, when the pool starts, and then only the directions, and
+    sends back the csm, perm and dir of each direction. As in ApproxCalculation, which stops at the first direction
+    that finds the symmetry, the directions after that one are cancelled, and the result is the best of the directions
+    up to it.
+    With threads=True the pool is of threads, which share the molecule and the memo. The distance matrices, assignments
+    and eigen decompositions run without the GIL, so the threads of the Hungarian and greedy approximators overlap.
+    '''
     def __init__(self, operation, molecule, direction_chooser,
-                 log_func=None, pool_size=0, *args, **kwargs):
+                 log_func=None, pool_size=0, threads=False, *args, **kwargs):
         if log_func is not None:
             raise ValueError("Cannot run logging on approx in parallel calculation")
+        self.threads = threads
         self.pool_size = pool_size
         if pool_size == 0:
-            self.pool_size = multiprocessing.cpu_count() - 1
+            self.pool_size = max(multiprocessing.cpu_count() - 1, 1)
+        self._pool = None
+        self._symmetric_index = None
+        # what the pool runs for each direction
+        self._approximate_direction = None
         super().__init__(operation, molecule, direction_chooser, *args, **kwargs)
 
-    def _calculate(self, operation, timeout):
+    def calculate(self, timeout=100, *args, **kwargs):
+        try:
+            return super().calculate(timeout, *args, **kwargs)
+        finally:
+            self._close_pool()
+
+    def _get_pool(self, deadline):
+        if self._pool is None:
+            self._symmetric_index = multiprocessing.Value('i', 0)
+            approx_worker = _ApproxWorker(self.molecule, self.perm_builder, self.chain_perms, deadline,
+                                          self._symmetric_index)
+            if self.threads:
+                # the threads share this process's worker, so nothing is set up in them
+                self._pool = multiprocessing.pool.ThreadPool(processes=self.pool_size)
+                self._approximate_direction = approx_worker.approximate_direction
+            else:
+                self._pool = multiprocessing.Pool(processes=self.pool_size, initializer=_init_approx_worker,
+                                                  initargs=(approx_worker, deadline.share()))
+                self._approximate_direction = _approximate_direction
+            print("Approximating across {} {}".format(self.pool_size, "threads" if self.threads else "processes"))
+        return self._pool
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _calculate(self, operation, deadline):
+        self._single_statistics = ApproxStatistics(self._initial_directions)
         if operation.type == 'CI' or (operation.type == 'SN' and operation.order == 2):
             raise ValueError("Please don't use parallel calculation for inversion")
         else:
             if self.selective:
                 self.max_iterations = 1
-                self._calculate_for_directions(operation, self._initial_directions)
+                self._calculate_for_directions(operation, self._initial_directions, deadline)
                 best_dirs = []
-                sorted_csms = sorted(self.statistics.directions_arr)
+                sorted_csms = sorted(self._single_statistics.directions_arr)
                 for item in sorted_csms[:self.num_selected]:
                     best_dirs.append(item.start_dir)
                 self.max_iterations = self._max_iterations
-                best_result = self._calculate_for_directions(operation, best_dirs)
+                best_result = self._calculate_for_directions(operation, best_dirs, deadline)
 
             else:
                 self.max_iterations = self._max_iterations
-                best_result = self._calculate_for_directions(operation, self._initial_directions)
+                best_result = self._calculate_for_directions(operation, self._initial_directions, deadline)
 
+        self.statistics[operation.op_code] = self._single_statistics.to_dict()
         return best_result
 
-    def _calculate_for_directions(self, operation, dirs):
-        pool = multiprocessing.Pool(processes=self.pool_size)
-        print("Approximating across {} processes".format(self.pool_size))
-        single_dir_approximator = SingleDirApproximator(operation, self.molecule,
-                                                        self.perm_builder, self._log,
-                                                        self.timeout, max_iterations=self.max_iterations, chain_perms=self.chain_perms)
-       
-        pool_outputs = pool.map(single_dir_approximator.calculate, dirs)
-        pool.close()
-        pool.join()
-        best_result = CSMState(csm=MAX_DOUBLE)
-        self.statistics = ApproxStatistics(dirs)
-        for (result, statistics) in pool_outputs:
-            dir = statistics.start_dir
-            self.statistics[dir] = statistics
-            if result.csm < best_result.csm:
-                best_result = result
+    def _calculate_for_directions(self, operation, dirs, deadline):
+        pool = self._get_pool(deadline)
+        # every direction of the previous call has returned, so none of them sees the reset
+        self._symmetric_index.value = len(dirs)
+
+        # the directions are collected as they complete. Once one of them reaches CSM_THRESHOLD, the directions after
+        # it return without finishing, and only those up to it, which all finish, are candidates. Ties go to the
+        # first direction, so the result is the same whatever order the directions complete in
+        outputs = [None] * len(dirs)
+        tasks = [(index, dir, operation, self.max_iterations) for index, dir in enumerate(dirs)]
+        for index, output in pool.imap_unordered(self._approximate_direction, tasks):
+            if output is None:
+                continue
+            outputs[index] = output
+            self._single_statistics[dirs[index]] = SentDirectionStatistics(dirs[index], output[3])
+        best_csm, best_perm = MAX_DOUBLE, None
+        for output in outputs[:self._symmetric_index.value + 1]:
+            if output is not None and output[0] < best_csm:
+                best_csm, best_perm = output[0], output[1]
+
+        # only the permutation of the best direction is sent back, and its result is measured again here
+        if best_perm is None:
+            best_result = CSMState(csm=MAX_DOUBLE)
+        else:
+            best_result, memoized = self._perm_memo.calculate(operation, self.molecule, best_perm)
         self.result = best_result
         return best_result
@@ -1,9 +1,7 @@
-import datetime
 import numpy as np
-import operator
 from csm.fast import CythonPermuter
-from csm.fast import approximate_perm_classic, munkres_wrapper
-from csm.calculations.basic_calculations import array_distance, check_perm_cycles, create_rotation_matrix
+from csm.fast import approximate_perm_classic, munkres_wrapper, fill_distance_block, ApproxPlan
+from csm.calculations.basic_calculations import check_perm_cycles, create_rotation_matrix
 from csm.calculations.constants import MAX_DOUBLE
 from csm.calculations.permuters import ConstraintsSelectedFromDistanceListPermuter, ConstraintsOrderedByDistancePermuter
 
@@ -20,14 +18,13 @@ class _OptionalLogger:
             self._log_func(*args)
 
 class _PermFromDirBuilder(_OptionalLogger):
-    def __init__(self, operation, molecule, log_func, timeout):
-        self.start_time = datetime.datetime.now()
+    def __init__(self, operation, molecule, log_func, deadline):
         self._log_func = log_func
         self._molecule = molecule
         self.operation = operation
         self._op_type = operation.type
         self._op_order = operation.order
-        self.timeout = timeout
+        self.deadline = deadline
         self._precalculate()
 
     def _precalculate(self):
@@ -54,6 +51,20 @@ class _ChainPermsPermBuilder(_PermFromDirBuilder):
 
     def _precalculate(self):
         self._chain_permutations = self._calc_chain_permutations()
+        self._Q = np.ascontiguousarray(self._molecule.Q, dtype=np.float64)
+        self._plans = {}
+
+    def _get_plan(self, chain_perm):
+        '''
+        Returns the ApproxPlan of chain_perm, which is built the first time it is needed and then reused by every
+        direction
+        '''
+        key = tuple(chain_perm)
+        try:
+            return self._plans[key]
+        except KeyError:
+            plan = self._plans[key] = ApproxPlan(self._molecule, chain_perm, self._Q)
+            return plan
 
 
 class _GreedyPermBuilder(_ChainPermsPermBuilder):
@@ -63,7 +74,8 @@ class _GreedyPermBuilder(_ChainPermsPermBuilder):
     '''
 
     def create_perm_from_dir(self, dir, chain_perm):
-        return approximate_perm_classic(self._op_type, self._op_order, self._molecule, dir, chain_perm)
+        return approximate_perm_classic(self._op_type, self._op_order, self._molecule, dir, chain_perm, self.deadline,
+                                        plan=self._get_plan(chain_perm))
 
 
 class _HungarianPermBuilder(_ChainPermsPermBuilder):
@@ -73,7 +85,8 @@ class _HungarianPermBuilder(_ChainPermsPermBuilder):
     '''
 
     def create_perm_from_dir(self, dir, chain_perm):
-        perm = self.approximate_perm_hungarian(self._op_type, self._op_order, self._molecule, dir, chain_perm)
+        perm = self.approximate_perm_hungarian(self._op_type, self._op_order, self._molecule, dir,
+                                               self._get_plan(chain_perm))
         perm = self.cookie_dough(perm)
         return perm
 
@@ -82,7 +95,7 @@ class _HungarianPermBuilder(_ChainPermsPermBuilder):
         def __init__(self, group_size):
             self.group_size = group_size
             # ##print("Creating DistanceMatrix for group of size ", self.group_size)
-            self.mv_distances = np.ones((group_size, group_size), order="c") * MAX_DOUBLE
+            self.mv_distances = np.full((group_size, group_size), MAX_DOUBLE, order="c")
             self._allowed_rows = np.zeros(group_size, dtype='long')
             self._allowed_cols = np.zeros(group_size, dtype='long')
             # ##print("DistanceMatrix created")
@@ -145,66 +158,21 @@ class _HungarianPermBuilder(_ChainPermsPermBuilder):
             ##print(self.mv_distances.base)
             pass
 
-    def cycle_builder(self, chain_perm):
-        """
-        the only thing this function does is build cycles ON THE BASIS OF CHAINPERM
-        if chain_perm has invalid cycles, this will return invalid cycles
-        :param chain_perm:
-        :return: a cycle in chain_perm
-        """
-        chainperm_copy = list(chain_perm)
-
-        ##print("chainperm_copy", chainperm_copy)
-
-        def recursive_cycle_builder(chain_head, index, cycle):
-            ##print(chain_head, index, cycle)
-            cycle.append(index)
-            chainperm_copy[index] = -1
-            if chain_perm[index] == chain_head:
-                ##print("yielding cycle", cycle)
-                yield cycle
-                cycle = []
-            else:
-                yield from recursive_cycle_builder(chain_head, chain_perm[index], cycle)
-
-        for i, val in enumerate(chainperm_copy):
-            ##print("I,val", i,val)
-            if val == -1:
-                continue
-            chainperm_copy[i] = -1
-            ##print("cycle head is", i)
-            yield from recursive_cycle_builder(i, i, [])
-        # find and return cycles
-        pass
-
-    def get_atom_indices(self, cycle, chain_group):
-        indices = []
-        for chain_index in cycle:
-            indices += chain_group[chain_index]
-        return indices
-
-    def get_atom_to_matrix_indices(self, atom_indices, atom_to_matrix_indices):
-        i = 0
-        for index in atom_indices:
-            atom_to_matrix_indices[index] = i
-            i += 1
-        return atom_to_matrix_indices
-
-    def fill_distance_matrix(self, len_group, cycle, chain_group, chain_perm, rotated_holder, Q_holder, matrix_indices):
+    def fill_distance_matrix(self, len_group, blocks, rotated, Q, matrix_indices):
+        '''
+        Fills the distance matrix a block at a time: each block of the ApproxPlan is the distances between the atoms of
+        a chain (the rows) and the rotated atoms of the chain it is permuted to (the columns)
+        :param rotated: the rotated coordinates of the molecule, C-contiguous
+        :param Q: the coordinates of the molecule, C-contiguous
+        '''
         distances = self.DistanceMatrix(len_group)
 
-        for chain_index in cycle:  # Use an iterator
-            # Todo: Convert from_chain and to_chain into vector[ints]
-            to_chain = chain_group[chain_index]
-            from_chain = chain_group[chain_perm[chain_index]]
-            for i in range(len(from_chain)):
-                from_chain_index = from_chain[i]
-                for j in range(len(to_chain)):
-                    to_chain_index = to_chain[j]
-                    a = rotated_holder[from_chain_index]
-                    b = Q_holder[to_chain_index]
-                    distance = array_distance(a, b)
-                    distances.add(matrix_indices[to_chain_index], matrix_indices[from_chain_index], distance)
+        for to_chain, from_chain in blocks:
+            if len(to_chain) == 0 or len(from_chain) == 0:
+                continue
+            fill_distance_block(distances.mv_distances, rotated, Q, to_chain, from_chain, matrix_indices)
+            distances._allowed_rows[matrix_indices[to_chain]] = 1
+            distances._allowed_cols[matrix_indices[from_chain]] = 1
         return distances
 
     def hungarian_perm_builder(self, op_type, op_order, group, distance_matrix, perm):
@@ -216,35 +184,24 @@ class _HungarianPermBuilder(_ChainPermsPermBuilder):
             perm[group[from_val]] = group[to_val]
         return perm
 
-    def approximate_perm_hungarian(self, op_type, op_order, molecule, dir, chain_perm):
+    def approximate_perm_hungarian(self, op_type, op_order, molecule, dir, plan):
         # print("Inside estimate_perm, dir=%s" % dir)
         # create rotation matrix
         rotation_mat = create_rotation_matrix(1, op_type, op_order, dir)
         # run rotation matrix on atoms
-        rotated = (rotation_mat @ molecule.Q.T).T
-        atom_to_matrix_indices = np.ones(len(molecule), dtype='long') * -1
+        rotated = np.ascontiguousarray((rotation_mat @ plan.Q.T).T)
         # empty permutation:
         perm = [-1] * len(molecule)
 
-        # permutation is built by "group": equivalence class, and valid cycle within chain perm (then valid exchange w/n cycle)
-        for cycle in self.cycle_builder(chain_perm):
-            # Todo: Convert cycle into a vector[int]
-            for chains_in_group in molecule.groups_with_internal_chains:
-                # 1. create the group of atom indices we will be building a distance matrix with
-                try:
-                    current_atom_indices = self.get_atom_indices(cycle, chains_in_group)
-                except KeyError:  # chaingroup does not have chains belonging to current cycle
-                    continue  # continue to next chain group
-                atom_to_matrix_indices = self.get_atom_to_matrix_indices(current_atom_indices, atom_to_matrix_indices)
-
-                # 2. within that group, go over legal switches and add their distance to the matrix
-                distances = self.fill_distance_matrix(len(current_atom_indices), cycle, chains_in_group, chain_perm,
-                                                      rotated,
-                                                      molecule.Q, atom_to_matrix_indices)
-
-                # 3. call the perm builder on the group
-                perm = self.hungarian_perm_builder(op_type, op_order, current_atom_indices, distances, perm)
-                # (4. either continue to next group or finish)
+        # the plan holds the groups: equivalence class, and valid cycle within chain perm
+        for current_atom_indices, blocks in plan.groups:
+            # 1. within the group, go over legal switches and add their distance to the matrix
+            distances = self.fill_distance_matrix(len(current_atom_indices), blocks, rotated, plan.Q,
+                                                  plan.matrix_indices)
+
+            # 2. call the perm builder on the group
+            perm = self.hungarian_perm_builder(op_type, op_order, current_atom_indices, distances, perm)
+            # (3. either continue to next group or finish)
         # print(perm)
         return perm
 
@@ -260,6 +217,13 @@ class _ManyChainsPermBuilder(_PermFromDirBuilder):
     permutations
     '''
 
+    def _precalculate(self):
+        super()._precalculate()
+        self._Q = np.ascontiguousarray(self._molecule.Q, dtype=np.float64)
+        # the internal groups of every chain as index arrays, so that their coordinates can be taken in one go
+        self._chain_groups = {chain: [np.array(group, dtype=np.int64) if group else None for group in groups]
+                              for chain, groups in self._molecule.chains_with_internal_groups.items()}
+
     def create_perm_from_dir(self, dir, chain_perm="dont care"):
 
         chain_len = len(self._molecule.chains[0])
@@ -269,6 +233,10 @@ class _ManyChainsPermBuilder(_PermFromDirBuilder):
                 raise ValueError("--many-chains currently expects all chains to be of same length")
 
         rotation_mat = create_rotation_matrix(1, self._op_type, self._op_order, dir)
+        # T is the symmetric translation appropriate to the given symmetric axis, applied to all the atoms at once
+        rotated = (rotation_mat @ self._Q.T).T
+        # the assignment found for each (fragment i, fragment j, group k), so that step C doesn't solve it again
+        assignments = {}
         perm = [-1] * len(self._molecule)
         # improved use chains algorithm:
         # for a given symmetric axis:
@@ -282,79 +250,95 @@ class _ManyChainsPermBuilder(_PermFromDirBuilder):
         for equivalent_chain_group in self._molecule.chain_equivalences:
             for i, frag_i in enumerate(equivalent_chain_group):
                 for j, frag_j in enumerate(equivalent_chain_group):
-                    fragment_distance_matrix[i, j] = self._get_fragment_distance(frag_i, frag_j, rotation_mat)
+                    fragment_distance_matrix[i, j] = self._get_fragment_distance(frag_i, frag_j, rotated,
+                                                                                 assignments)
 
         # Run the hungarian algorithm on Aij, and thereby find a permutation between the fragments
         indexes = munkres_wrapper(fragment_distance_matrix)
-        # C: rerun A3 on the relevant ijs
+        # C: reuse the A3 assignments of the relevant ijs
         for (i, j) in indexes:
             frag_i_groups = self._molecule.chains_with_internal_groups[i]
             frag_j_groups = self._molecule.chains_with_internal_groups[j]
             # D: put together into a full permutation
             for k, group_k in enumerate(frag_i_groups):
                 group_m = frag_j_groups[k]
-                indexes, group_distance_matrix = self._hungarian_on_groups(group_k, group_m, rotation_mat)
-                for (from_val, to_val) in indexes:
+                group_indexes, group_distance_matrix = self._get_group_assignment(i, j, k, rotated, assignments)
+                for (from_val, to_val) in group_indexes:
                     perm[group_k[from_val]] = group_m[to_val]
         return perm
 
-    def _get_fragment_distance(self, frag_i, frag_j, rotation_mat):
+    def _get_fragment_distance(self, frag_i, frag_j, rotated, assignments):
         total_distance = 0
-        frag_i_groups = self._molecule.chains_with_internal_groups[frag_i]
-        frag_j_groups = self._molecule.chains_with_internal_groups[frag_j]
         # A3: e = number of equivalence groups in fragment i, of size N1... Ne
         # 0>k>e
-        for k, group_k in enumerate(frag_i_groups):
-            group_m = frag_j_groups[k]
-            indexes, group_distance_matrix = self._hungarian_on_groups(group_k, group_m, rotation_mat)
+        for k in range(len(self._chain_groups[frag_i])):
+            indexes, group_distance_matrix = self._get_group_assignment(frag_i, frag_j, k, rotated, assignments)
             # and the result (=sum of matrix members on diagonal generalized that hungarian found) ????
             # we add to A[i,j]
             for (i, j) in indexes:
                 total_distance += group_distance_matrix[i, j]
         return total_distance
 
-    def _hungarian_on_groups(self, group_k, group_m, rotation_mat):
+    def _get_group_assignment(self, frag_i, frag_j, k, rotated, assignments):
+        key = (frag_i, frag_j, k)
+        try:
+            return assignments[key]
+        except KeyError:
+            result = assignments[key] = self._hungarian_on_groups(self._chain_groups[frag_i][k],
+                                                                  self._chain_groups[frag_j][k], rotated)
+            return result
+
+    def _hungarian_on_groups(self, group_k, group_m, rotated):
         # matrix B of size Nk x Nk
-        if not group_k:
+        if group_k is None:
             return [], []  # the way we built chains with internal groups, groups with no members are None
-        size = len(group_k)
-        group_distance_matrix = np.ones((size, size), order="c") * MAX_DOUBLE
-        # Vi..Vnk are the coordinate vectors of fragment i in equivalence class k
+        # Vi..Vnk are the rotated coordinate vectors of fragment i in equivalence class k
         # Wi..Wnk are the coordinate vectors of fragment j in equivalence class k
-        for a, index_v in enumerate(group_k):
-            for b, index_w in enumerate(group_m):
-                coord_v = self._molecule.Q[index_v]
-                coord_w = self._molecule.Q[index_w]
-                # T is the symmetric translation appropriate to the given symmetric axis
-                translated_v = rotation_mat @ coord_v
-                # in position a,b of matrix B we place the square of the distance between T(Va) and Wb
-                # in other words matrix B is a single block from the standard approx algorithm's distance matrix,
-                # specifically the block that matches fragments i, j and equivalence group k
-                distance = array_distance(translated_v, coord_w)
-                group_distance_matrix[a, b] = distance
+        # in position a,b of matrix B we place the distance between T(Va) and Wb
+        # in other words matrix B is a single block from the standard approx algorithm's distance matrix,
+        # specifically the block that matches fragments i, j and equivalence group k
+        diffs = rotated[group_k][:, np.newaxis, :] - self._Q[group_m][np.newaxis, :, :]
+        group_distance_matrix = np.sqrt(np.einsum('abx,abx->ab', diffs, diffs))
         # B: We run the hungarian algorithm on matrix B,
         indexes = munkres_wrapper(group_distance_matrix)
         return indexes, group_distance_matrix
 
 
 class _StructuredPermBuilder(_PermFromDirBuilder):
+    def _precalculate(self):
+        super()._precalculate()
+        # the equivalence classes as index arrays, an atom can only be placed on an atom of its own class
+        self._groups = [np.array(group, dtype=np.int64) for group in self._molecule.equivalence_classes]
+
     def create_perm_from_dir(self, dir, chain_perm="dontcare"):
         return self.build_perm_and_state_version_dict(self._op_type, self._op_order, self._molecule, dir)
 
+    def _group_distances(self, molecule, rotated):
+        '''
+        Yields each equivalence class with the matrix of distances between its atoms (the rows) and its rotated atoms
+        (the columns)
+        '''
+        for group in self._groups:
+            diffs = molecule.Q[group][:, np.newaxis, :] - rotated[group][np.newaxis, :, :]
+            distances = np.sqrt(diffs[:, :, 0] * diffs[:, :, 0]
+                                + diffs[:, :, 1] * diffs[:, :, 1]
+                                + diffs[:, :, 2] * diffs[:, :, 2])
+            yield group, distances
+
     def build_perm_and_state_version_list(self, op_type, op_order, molecule, dir):
         rotation_mat = create_rotation_matrix(1, op_type, op_order, dir)
         rotated = (rotation_mat @ molecule.Q.T).T
 
         distances_list = []
-        for index_a, a in enumerate(molecule.Q):
-            for index_b, b in enumerate(rotated):
-                if index_b in molecule.atoms[index_a].equivalency:
-                    distance = array_distance(a, b)
-                    distances_list.append(((index_a, index_b), distance))
+        for group, distances in self._group_distances(molecule, rotated):
+            indices = group.tolist()
+            for index_a, row in zip(indices, distances.tolist()):
+                distances_list.extend(((index_a, index_b), distance) for index_b, distance in zip(indices, row))
 
-        distances_list.sort(key=operator.itemgetter(1))
+        # ties are broken by the atoms, as they were when the pairs were listed atom by atom
+        distances_list.sort(key=lambda item: (item[1], item[0]))
         permuter = ConstraintsSelectedFromDistanceListPermuter(self._molecule, self._op_order, self._op_type,
-                                                              distances_list, timeout=30000)
+                                                              distances_list, deadline=self.deadline)
         state = permuter.permute().__next__()
         self._log("\t\t\t Permutation took ", permuter.run_time, "seconds to find")
         perm = state.perm
@@ -364,17 +348,20 @@ class _StructuredPermBuilder(_PermFromDirBuilder):
         rotation_mat = create_rotation_matrix(1, op_type, op_order, dir)
         rotated = (rotation_mat @ molecule.Q.T).T
 
+        # for each atom, its equivalent atoms and their distances, in order of distance
         distances_dict = {}
-        for index_a, a in enumerate(molecule.Q):
-            distances_dict[index_a] = {}
-            for index_b, b in enumerate(rotated):
-                if index_b in molecule.atoms[index_a].equivalency:
-                    distance = array_distance(a, b)
-                    distances_dict[index_a][index_b] = distance
+        for group, distances in self._group_distances(molecule, rotated):
+            order = np.argsort(distances, axis=1, kind='stable')
+            candidates = group[order]
+            candidate_distances = np.take_along_axis(distances, order, axis=1)
+            for index_a, row_candidates, row_distances in zip(group.tolist(), candidates.tolist(),
+                                                              candidate_distances.tolist()):
+                distances_dict[index_a] = dict(zip(row_candidates, row_distances))
 
         permuter_class = ConstraintsOrderedByDistancePermuter  # ConstraintsSelectedByDistancePermuter
-        permuter = permuter_class(self._molecule, self._op_order, self._op_type, distances_dict, perm_timeout=30000)
+        permuter = permuter_class(self._molecule, self._op_order, self._op_type, distances_dict,
+                                  deadline=self.deadline)
         state = permuter.permute().__next__()
         self._log("\t\t\tit took ", permuter.run_time, "seconds to find the permutation")
         perm = state.perm
-        return perm
\ No newline at end of file
+        return perm
@@ -4,6 +4,9 @@ from collections import OrderedDict
 from csm.calculations.constants import MAX_DOUBLE
 from csm.calculations.data_classes import CSMState, get_chain_perm_string
 
+# the stop reason of a start direction whose path reached the path of an earlier, converged direction
+MERGED_STOP_REASON = "Merged with a converged direction"
+
 
 class SingleDirectionStatistics:
     # per direction, we want to store:
@@ -16,6 +19,8 @@ class SingleDirectionStatistics:
 
         self.dirs = [] #kept for tests to prove algorithms different
         self._stop_reason = ""
+        # the iterations whose permutation was already measured
+        self.memo_hits = 0
         self.least_invalid = CSMState(csm=MAX_DOUBLE, num_invalid=MAX_DOUBLE)
 
     def append_sub_direction(self, result):
@@ -109,6 +114,7 @@ class SingleDirectionStatistics:
                 "end dir": list(self.end_dir),
                 "end csm": self.end_csm,
                 "num iterations": self.num_iterations,
+                "memo hits": self.memo_hits,
                 "run time": self.run_time,
                 "chain perm":self.chain_perm,
                 "validity":self.validity_dict,
@@ -122,6 +128,19 @@ class SingleDirectionStatistics:
             }
 
 
+class SentDirectionStatistics:
+    # the statistics of a direction approximated in another process, which sends back only their dictionary
+    def __init__(self, dir, stats_dict):
+        self.start_dir = dir
+        self._stats_dict = stats_dict
+
+    def __repr__(self):
+        return "stats for dir"+str(self.start_dir)
+
+    def to_dict(self):
+        return self._stats_dict
+
+
 class DirectionStatisticsContainer:
     def __init__(self, initial_directions):
         self.directions_dict = OrderedDict()
@@ -148,4 +167,11 @@ class DirectionStatisticsContainer:
 
 
 class ApproxStatistics(DirectionStatisticsContainer):
-    pass
+    @staticmethod
+    def num_merged(directions_list):
+        '''
+        :param directions_list: the statistics of the start directions of an operation, as returned by to_dict
+        :return: how many of the start directions were merged into an earlier, converged direction
+        '''
+        return sum(1 for direction_dict in directions_list
+                   if direction_dict["stats"].get("stop reason") == MERGED_STOP_REASON)
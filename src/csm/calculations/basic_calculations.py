@@ -1,8 +1,13 @@
 import math as m
+import multiprocessing
+import time
 from datetime import datetime
 
 import numpy as np
 
+from csm.calculations import constants
+from csm.calculations.constants import DEADLINE_CHECK_INTERVAL
+
 
 def now():
     return datetime.now()
@@ -20,15 +25,94 @@ class CalculationTimeoutError(TimeoutError):
         self.timeout_delta = timeout_delta
 
 
-def check_timeout(local_start=None, local_timeout=None):
-    from csm.calculations.constants import global_start_time, global_time_out
-    if local_start:
-        runtime = run_time(local_start)
-        if runtime > local_timeout:
-            raise CalculationTimeoutError(runtime)
-    g_runtime = run_time(global_start_time)
-    if g_runtime > global_time_out:
-        raise CalculationTimeoutError(g_runtime)
+class CalculationCancelledError(CalculationTimeoutError):
+    def __init__(self, timeout_delta, *args, **kwargs):
+        TimeoutError.__init__(self, "Calculation was cancelled after " + str(timeout_delta) + " seconds", *args, **kwargs)
+        self.timeout_delta = timeout_delta
+
+
+# The cancelled flag of the deadline of the parallel calculation a pool process works for, see Deadline.share
+_pool_cancelled = None
+
+
+def init_pool_deadline(cancelled):
+    """
+    Called by the initializer of a pool's processes with the flag Deadline.share returned, so that the deadlines they
+    unpickle see it
+    """
+    global _pool_cancelled
+    _pool_cancelled = cancelled
+
+
+class Deadline:
+    """
+    The time limit of a calculation, passed down to the loops that enforce it. It expires timeout seconds after it was
+    created (on a monotonic clock), when the global timeout expires, or once cancel() is called, for example by a
+    signal handler or by the code coordinating a parallel calculation.
+    check() is cheap enough to be called at every node of the permutation tree: it only reads the clock once every
+    check_interval calls. Loops whose iterations are slow call check_now() instead.
+    The processes of a parallel calculation work on copies of the deadline. cancel() reaches them through the flag
+    share() returns, which the pool passes to init_pool_deadline
+    """
+    def __init__(self, timeout=300, check_interval=DEADLINE_CHECK_INTERVAL):
+        self.start = time.monotonic()
+        self.expires_at = min(self.start + timeout, constants.global_start_time + constants.global_time_out)
+        self.check_interval = check_interval
+        self._cancelled = False
+        self._shared_cancelled = None
+        self._countdown = check_interval
+
+    def cancel(self):
+        self._cancelled = True
+        if self._shared_cancelled is not None:
+            self._shared_cancelled.value = True
+        # the next check raises, whatever the interval
+        self._countdown = 0
+
+    @property
+    def cancelled(self):
+        if not self._cancelled and self._shared_cancelled is not None and self._shared_cancelled.value:
+            self._cancelled = True
+        return self._cancelled
+
+    def share(self):
+        """
+        :return: a flag, shared between processes, that cancel() sets. It passes to the processes of a pool through
+        inheritance, as an argument of their initializer
+        """
+        if self._shared_cancelled is None:
+            self._shared_cancelled = multiprocessing.Value('b', self._cancelled)
+        return self._shared_cancelled
+
+    def __getstate__(self):
+        # the shared flag cannot be pickled, the copies take the one their process was initialized with
+        state = dict(self.__dict__)
+        state["_shared_cancelled"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shared_cancelled = _pool_cancelled
+
+    @property
+    def run_time(self):
+        return time.monotonic() - self.start
+
+    @property
+    def expired(self):
+        return self.cancelled or time.monotonic() > self.expires_at
+
+    def check(self):
+        self._countdown -= 1
+        if self._countdown <= 0:
+            self._countdown = self.check_interval
+            self.check_now()
+
+    def check_now(self):
+        if self.cancelled:
+            raise CalculationCancelledError(self.run_time)
+        if time.monotonic() > self.expires_at:
+            raise CalculationTimeoutError(self.run_time)
 
 
 def cart2sph(x, y, z, normalize=True):
@@ -1,13 +1,21 @@
 # Constants used in the various calculations
-from datetime import datetime
+import time
 
 MIN_DOUBLE = 1e-8
 MAX_DOUBLE = 100000000.0
 ZERO_IM_PART_MAX = 1e-3
 CSM_THRESHOLD = 0.0001
+# The memory budget, in bytes, of the products cached by the exact permuters
+CACHE_MAX_MEMORY = 512 * 2 ** 20
+# The number of bins of the histogram of CSMs kept by --keep-best
+HISTOGRAM_BINS = 100
+# How many calls of Deadline.check pass between reads of the clock
+DEADLINE_CHECK_INTERVAL = 64
+# Directions of the approx algorithm closer than this, as unit vectors and up to sign, are the same direction
+DIRECTION_MERGE_TOLERANCE = 1e-4
 
 global global_start_time
-global_start_time = datetime.now()
+global_start_time = time.monotonic()
 
 global global_time_out
 global_time_out = 50000
@@ -16,3 +24,8 @@ global_time_out = 50000
 def set_global_timeout(timeout):
     global global_time_out
     global_time_out = timeout
+
+
+def set_cache_max_memory(max_memory):
+    global CACHE_MAX_MEMORY
+    CACHE_MAX_MEMORY = max_memory
@@ -1,10 +1,12 @@
+import heapq
+import multiprocessing
 from collections import namedtuple
 from datetime import datetime
 import numpy as np
 
 from csm.calculations.basic_calculations import create_rotation_matrix, check_perm_cycles, \
-    check_perm_structure_preservation
-from csm.calculations.constants import MIN_DOUBLE
+    check_perm_structure_preservation, Deadline, init_pool_deadline
+from csm.calculations.constants import MIN_DOUBLE, MAX_DOUBLE, HISTOGRAM_BINS
 from csm.input_output.formatters import silent_print
 from csm.molecule.molecule import Molecule
 from csm.molecule.normalizations import de_normalize_coords
@@ -122,6 +124,74 @@ class Operation:
         return o
 
 
+class BestPermsTracer:
+    """
+    A callback_func that keeps the k permutations with the lowest CSM, and a histogram of the CSMs of all the
+    permutations measured, instead of writing every permutation to a file.
+    The histogram has num_bins bins of equal width between 0 and 100.
+    """
+    # approx traces the CSM and direction measured for each permutation, rather than those of the previous iteration
+    # that it writes to the permutations file
+    traces_measured = True
+
+    def __init__(self, k, num_bins=HISTOGRAM_BINS):
+        self.k = k
+        self.count = 0
+        self.bin_width = 100.0 / num_bins
+        self.histogram = np.zeros(num_bins, dtype=np.int64)
+        # a max-heap by CSM, of (-csm, -count, serial, op, perm, dir), so the worst of the best is at the top
+        self._heap = []
+
+    def _push(self, csm, index, serial, op_name, perm, dir):
+        # index, the permutation's position among all those traced, breaks ties in favor of the earlier permutation
+        item = (-csm, -index, int(serial), op_name, [int(p) for p in perm],
+                None if dir is None else [float(x) for x in dir])
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    @property
+    def threshold(self):
+        """
+        The CSM a permutation must improve on to be kept
+        """
+        if len(self._heap) < self.k:
+            return np.inf
+        return -self._heap[0][0]
+
+    def __call__(self, state):
+        self.count += 1
+        self.histogram[self._bin(state.csm)] += 1
+        if state.csm < self.threshold:
+            self._push(state.csm, self.count, state.serial, state.op_type + str(state.op_order), state.perm, state.dir)
+
+    def write_batch(self, first_serial, op_name, csms, dirs, perms):
+        """
+        Traces consecutive permutations at once, used by the batched exact calculation instead of calling the tracer
+        for each one
+        """
+        bins = np.clip(csms / self.bin_width, 0, len(self.histogram) - 1).astype(int)
+        self.histogram += np.bincount(bins, minlength=len(self.histogram))
+        for i in np.nonzero(csms < self.threshold)[0]:
+            self._push(float(csms[i]), self.count + i + 1, first_serial + i, op_name, perms[i], dirs[i])
+        self.count += len(csms)
+
+    def _bin(self, csm):
+        return min(max(int(csm / self.bin_width), 0), len(self.histogram) - 1)
+
+    @property
+    def best(self):
+        return [{"serial": serial, "op": op_name, "csm": -neg_csm, "dir": dir, "perm": perm}
+                for neg_csm, _, serial, op_name, perm, dir in sorted(self._heap, reverse=True)]
+
+    def to_dict(self):
+        return {"best": self.best,
+                "bin width": self.bin_width,
+                "histogram": self.histogram.tolist(),
+                "perm count": self.count}
+
+
 class Result:
     def __repr__(self):
         return_string = "{} CSM: {} Molecule: {} (chiral: {})".format(self.__class__.__name__, self.csm,
@@ -300,6 +370,11 @@ class CSMResult(Result):
         if self.operation.name == "CHIRALITY":
             silent_print("Minimum chirality was found in", self.overall_statistics["best chirality"])
 
+        if self.overall_statistics.get("optimal") is False:
+            silent_print("The calculation timed out after exploring about %.3g%% of the permutations. "
+                         "This is the best result found so far, and it may not be optimal"
+                         % (100 * self.overall_statistics["explored fraction"]))
+
         if legacy_output:
             silent_print("%s: %.4lf" % (self.operation.name, abs(self.csm)))
             silent_print("CSM by formula: %.4lf" % (self.formula_csm))
@@ -389,38 +464,126 @@ class FailedResult(Result):
     def __repr__(self):
         return super(FailedResult, self).__repr__() + "\tFailure: " + self.failed_reason
 
+class _SubOperationRunner:
+    """
+    Calculates one operation of a chirality calculation, in a process of BaseCalculation's pool
+    """
+    def __init__(self, calculation, deadline):
+        self.calculation = calculation
+        self.deadline = deadline
+
+    def __call__(self, indexed_op):
+        index, op = indexed_op
+        self.calculation.sub_operation_index = index
+        result = self.calculation._calculate_sub_operation(op, self.deadline)
+        return index, result, self.calculation.statistics
+
+
 class BaseCalculation:
     '''
     A base class for calculations that handles some shared logic, particularly chirality
     '''
-    def __init__(self, operation, molecule, **kwargs):
+    def __init__(self, operation, molecule, ops_pool_size=None, deadline=None, **kwargs):
+        """
+        :param ops_pool_size: default None, when given the operations of a chirality calculation are calculated in
+        parallel, in a pool of this many processes
+        :param deadline: default None, the Deadline of the calculation, which can be cancelled from outside. When None,
+        calculate creates one from its timeout
+        """
         self.operation=operation
         self.molecule=molecule
+        self.ops_pool_size = ops_pool_size
+        self.deadline = deadline
+        # set by calculations that return the best result found before their deadline expired
+        self.timed_out = False
+        # the index of the operation calculated by a process of parallel_chirality, in the order chirality tries them
+        self.sub_operation_index = None
+
+    def chirality(self, deadline):
+        if self.ops_pool_size:
+            return self.parallel_chirality(deadline)
+        # First CS, then the SN's
+        ops = [Operation('cs')] + [Operation("S" + str(op_order)) for op_order in range(2, self.operation.order + 1, 2)]
+        best_result = None
+        statistics = []
+        for op in ops:
+            result = self._calculate_sub_operation(op, deadline)
+            statistics.append(self.statistics)
+            if result is not None and (best_result is None or result.csm < best_result.csm):
+                best_result = result
+            if best_result is not None and best_result.csm < MIN_DOUBLE:
+                break
+            if self.timed_out:
+                # there is no time left for the other operations
+                break
+        self._combine_statistics(statistics)
+        return best_result
 
-    def chirality(self, timeout):
-        # First CS
-        op = Operation('cs')
-        best_result = self._calculate(op, timeout)
-        if best_result.csm > MIN_DOUBLE:
-            # Try the SN's
-            for op_order in range(2, self.operation.order + 1, 2):
-                op = Operation("S" + str(op_order))
-                result = self._calculate(op, timeout)
-                if result.csm < best_result.csm:
-                    best_result = result
-                if best_result.csm < MIN_DOUBLE:
+    def parallel_chirality(self, deadline):
+        """
+        Calculates CS and the SN's in a pool of ops_pool_size processes. The processes share the best CSM found so far,
+        and the index of the first operation found to have the symmetry (see _init_shared_best_csm). As in chirality,
+        that operation is the result, so the calculation stops once it and every operation before it have returned,
+        and the operations after it are stopped as soon as it finds the symmetry.
+        """
+        ops = [Operation('cs')] + [Operation("S" + str(op_order)) for op_order in range(2, self.operation.order + 1, 2)]
+        shared_best_csm = multiprocessing.Value('d', MAX_DOUBLE)
+        symmetric_index = multiprocessing.Value('i', len(ops))
+        results = [None] * len(ops)
+        statistics = [None] * len(ops)
+        first_symmetric = len(ops)
+        pool = multiprocessing.Pool(processes=min(self.ops_pool_size, len(ops)),
+                                    initializer=self._init_shared_best_csm,
+                                    initargs=(shared_best_csm, symmetric_index, deadline.share()))
+        try:
+            for index, result, op_statistics in pool.imap_unordered(_SubOperationRunner(self, deadline),
+                                                                     enumerate(ops)):
+                results[index] = result
+                statistics[index] = op_statistics
+                if result is not None and result.csm < MIN_DOUBLE:
+                    first_symmetric = min(first_symmetric, index)
+                if first_symmetric < len(ops) and None not in statistics[:first_symmetric]:
                     break
+        finally:
+            pool.terminate()
+            pool.join()
+        self._combine_statistics([op_statistics for op_statistics in statistics if op_statistics is not None])
+
+        # ties go to the first operation, as in chirality, which stops at the first operation with the symmetry
+        best_result = None
+        for result in results[:first_symmetric + 1]:
+            if result is not None and (best_result is None or result.csm < best_result.csm):
+                best_result = result
         return best_result
+
+    @staticmethod
+    def _init_shared_best_csm(shared_best_csm, symmetric_index, cancelled):
+        # calculations that can prune by the best CSM of the other operations keep shared_best_csm, and those that can
+        # stop once an operation before theirs has the symmetry keep symmetric_index
+        init_pool_deadline(cancelled)
+
+    def _calculate_sub_operation(self, op, deadline):
+        # the result of one operation of chirality, or None if there is nothing better than the shared CSM
+        return self._calculate(op, deadline)
+
+    def _combine_statistics(self, statistics):
+        # sets the statistics of chirality from those of each operation
+        pass
+
     def calculate(self, timeout=300):
         self.start_time = datetime.now()
+        self.timed_out = False
+        deadline = self.deadline
+        if deadline is None:
+            deadline = Deadline(timeout)
         if self.operation.type == 'CH':  # Chirality
             # sn_max = op_order
             # First CS
-            best_result=self.chirality(timeout)
+            best_result=self.chirality(deadline)
         else:
-            best_result = self._calculate(self.operation, timeout=timeout)
+            best_result = self._calculate(self.operation, deadline)
         return best_result
 
-    def _calculate(self, operation, timeout):
+    def _calculate(self, operation, deadline):
         raise NotImplementedError
 
@@ -1,10 +1,17 @@
+import copy
+import json
+import math
+import multiprocessing
+import os
 import sys
+from functools import reduce
 
 import numpy as np
-from csm.fast import CythonPermuter, SinglePermPermuter
-from csm.fast import calc_ref_plane, calc_ref_plane_prochirality
+from csm.fast import CythonStackPermuter, SinglePermPermuter
+from csm.fast import calc_ref_plane, calc_ref_plane_prochirality, calc_ref_plane_prochirality_batch, CalcStateBuffer
 
-from csm.calculations.basic_calculations import check_perm_cycles, now, run_time
+from csm.calculations.basic_calculations import check_perm_cycles, now, run_time, CalculationTimeoutError, Deadline, \
+    init_pool_deadline
 from csm.calculations.constants import MIN_DOUBLE, MAX_DOUBLE
 from csm.calculations.data_classes import CSMState, CSMResult, Operation, BaseCalculation
 from csm.calculations.permuters import ConstraintPermuter
@@ -19,6 +26,27 @@ __author__ = 'Itay, Devora, Yael'
 # This is useful for writing all permutations to file during the calculation
 csm_state_tracer_func = None
 
+# The best CSM found so far by any of the processes of a ParallelExact calculation, set by the pool initializer
+_shared_best_csm = None
+# The index of the first operation found to have the symmetry by the processes of a parallel chirality calculation
+_shared_symmetric_index = None
+# The _ExactWorkUnitRunner of a process of ParallelExact's pool, set by the pool initializer
+_work_unit_runner = None
+# How many permutations a ParallelExact work unit measures between looks at the shared best CSM
+SHARED_CSM_INTERVAL = 1000
+# How many completed permutations are buffered before their reference planes are calculated together
+REF_PLANE_BATCH_SIZE = 256
+# The memory, in bytes, for the permutations a prochirality calculation visits before it finds a zero CSM, and the
+# number of permutations in each of the blocks they are kept in
+PROCHIRALITY_BUFFER_MEMORY = 256 * 2 ** 20
+PROCHIRALITY_BLOCK_SIZE = 4096
+# How often, in seconds, an exact calculation with a checkpoint file saves its progress
+CHECKPOINT_INTERVAL = 60
+# How long, in seconds, choose_calculation runs the exact calculation of each operation to measure its speed
+AUTO_SAMPLE_TIME = 1.0
+# How many random paths estimate the size of a --keep-structure permutation tree
+AUTO_TREE_SAMPLES = 200
+
 
 class CSMValueError(ValueError):
     def __init__(self, arg1, CSMState):
@@ -28,22 +56,39 @@ class CSMValueError(ValueError):
 
 
 class ExactStatistics:
-    def __init__(self, permuter):
+    def __init__(self, permuter, timed_out=False, explored_fraction=1.0):
         self._perm_count = permuter.count
         self._truecount = permuter.truecount
         self._falsecount = permuter.falsecount
+        self._pruned = getattr(permuter, "pruned", 0)
+        self._skipped = getattr(permuter, "skipped", 0)
+        # an anytime calculation that timed out explored only part of the permutation tree
+        self._timed_out = timed_out
+        self._explored_fraction = explored_fraction
+        self._num_trees = 1
+        # the perm count of all the operations of a chirality calculation, see set_totals
+        self._total_perm_count = None
 
     def write(self, f=sys.stderr):
         f.write("Number of permutations: %s" % format_perm_count(self.perm_count))
         f.write("Number of branches in permutation tree: %s" % format_perm_count(self.num_branches))
         f.write("Number of dead ends: %s" % format_perm_count(self.dead_ends))
+        f.write("Number of pruned branches: %s" % format_perm_count(self.pruned))
+        f.write("Number of branches skipped by symmetry: %s" % format_perm_count(self.skipped))
+        if self._total_perm_count is not None:
+            f.write("Number of permutations of all the operations: %s" % format_perm_count(self._total_perm_count))
 
     def to_dict(self):
-        return {
+        statistics = {
             "perm count": self.perm_count,
             "number branches": self.num_branches,
-            "dead ends": self.dead_ends
+            "dead ends": self.dead_ends,
+            "pruned branches": self.pruned,
+            "skipped by symmetry": self.skipped
         }
+        if self._total_perm_count is not None:
+            statistics["total perm count"] = self._total_perm_count
+        return statistics
 
     @property
     def dead_ends(self):
@@ -57,10 +102,124 @@ class ExactStatistics:
     def num_branches(self):
         return self._truecount
 
+    @property
+    def pruned(self):
+        return self._pruned
+
+    @property
+    def skipped(self):
+        return self._skipped
+
+    @property
+    def timed_out(self):
+        return self._timed_out
+
+    @property
+    def explored_fraction(self):
+        return self._explored_fraction
+
+    def set_totals(self, combined):
+        """
+        Used by chirality, whose statistics are those of the last operation it measured, as for a single operation,
+        with the perm count, timeout and explored fraction of all the operations
+        :param combined: the sum of the statistics of the operations
+        """
+        self._total_perm_count = combined.perm_count
+        self._timed_out = combined.timed_out
+        self._explored_fraction = combined.explored_fraction
+
+    def restore(self, saved):
+        # the inverse of to_dict
+        self._perm_count = saved["perm count"]
+        self._truecount = saved["number branches"]
+        self._falsecount = saved["dead ends"]
+        self._pruned = saved["pruned branches"]
+        self._skipped = saved["skipped by symmetry"]
+
+    def __add__(self, other):
+        combined = copy.copy(self)
+        combined._perm_count += other._perm_count
+        combined._truecount += other._truecount
+        combined._falsecount += other._falsecount
+        combined._pruned += other._pruned
+        combined._skipped += other._skipped
+        combined._timed_out = self._timed_out or other._timed_out
+        # the average of the explored fractions of the operations, or of the work units
+        combined._num_trees += other._num_trees
+        combined._explored_fraction = (self._explored_fraction * self._num_trees +
+                                       other._explored_fraction * other._num_trees) / combined._num_trees
+        return combined
+
+
+class ExactCheckpoint:
+    """
+    The progress of an exact calculation, saved to a json file so that a calculation that was stopped can be resumed:
+    the results of the operations that were completed, and for the operation in progress, the position in the
+    constraints permuter's tree, the best result so far and the statistics
+    """
+    def __init__(self, filename, interval=CHECKPOINT_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        self.completed = {}
+        self.current = None
+        self._last_save = now()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            print("No checkpoint found at", self.filename, "- starting from the beginning")
+            return
+        with open(self.filename, 'r') as f:
+            saved = json.load(f)
+        self.completed = saved["completed"]
+        self.current = saved["current"]
+
+    @property
+    def due(self):
+        return run_time(self._last_save) >= self.interval
+
+    @staticmethod
+    def _state_to_dict(state, statistics=None):
+        return {"csm": state.csm,
+                "dir": None if state.dir is None else [float(x) for x in state.dir],
+                "perm": None if state.perm is None else [int(x) for x in state.perm],
+                "is_chiral": state.is_chiral,
+                "statistics": statistics}
+
+    @staticmethod
+    def state_from_dict(saved, molecule, op):
+        return CSMState(molecule=molecule, op_type=op.type, op_order=op.order, csm=saved["csm"],
+                        dir=None if saved["dir"] is None else np.array(saved["dir"]), perm=saved["perm"],
+                        is_chiral=saved["is_chiral"])
+
+    def save_progress(self, op, permuter, best_csm):
+        position, statistics = permuter.progress()
+        self.current = {"operation": op.op_code, "position": position,
+                        "best": self._state_to_dict(best_csm, statistics)}
+        self._write()
+
+    def save_completed(self, op, best_csm, statistics):
+        self.completed[op.op_code] = self._state_to_dict(best_csm, statistics.to_dict())
+        self.current = None
+        self._write()
+
+    def _write(self):
+        # write a new file and replace the old one, so that a checkpoint is never left half written
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, 'w') as f:
+            json.dump({"completed": self.completed, "current": self.current}, f)
+        os.replace(temp_filename, self.filename)
+        self._last_save = now()
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
 
 class ExactCalculation(BaseCalculation):
     def __init__(self, operation, molecule, keep_structure=False, perm=None,
                  no_constraint=False, callback_func=None, prochirality=False,
+                 branch_and_bound=False, use_automorphisms=False, checkpoint_file=None, resume=False,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, ops_pool_size=None, deadline=None, anytime=False,
                  *args, **kwargs):
         """
         A class for running the exact CSM Algorithm
@@ -73,25 +232,68 @@ class ExactCalculation(BaseCalculation):
         when True the old permuter is used
         :param timeout: default 300, the number of seconds the function will run before timing out
         :param callback_func: default None, this function is called for every single permutation calculated with an argument of a single 
-        CSMState, can be used for printing in-progress reports, outputting to an excel, etc.
+        CSMState, can be used for printing in-progress reports, outputting to an excel, etc. If it has a write_batch
+        method (like writers.PermsLogWriter), the batched calculation passes it whole blocks of permutations instead
         :param prochirality: Indicates whether we want a measure of chirality
         or prochirality.
+        :param branch_and_bound: boolean, default False, when True the constraints permuter prunes subtrees whose CSM
+        lower bound can't improve on the best CSM found so far
+        :param use_automorphisms: boolean, default False, when True only one permutation out of each set of
+        permutations related by an automorphism of the molecule is measured
+        :param checkpoint_file: default None, when given the progress of the calculation is saved to this file every
+        checkpoint_interval seconds and when it times out
+        :param resume: boolean, default False, when True the calculation continues from checkpoint_file
+        :param ops_pool_size: default None, when given the operations of a chirality calculation are calculated in a
+        pool of this many processes, which share the best CSM found so far
+        :param deadline: default None, the Deadline of the calculation. When None, calculate creates one from its
+        timeout
+        :param anytime: boolean, default False, when True a calculation that times out returns the best result found
+        so far, and its statistics say it may not be optimal and estimate the fraction of the permutations explored
         """
-        super().__init__(operation, molecule)
+        super().__init__(operation, molecule, ops_pool_size=ops_pool_size, deadline=deadline)
         self.keep_structure = keep_structure
         self.perm = perm
         self.no_constraint = no_constraint
         self.callback_func = callback_func
         self.prochirality = prochirality
+        self.branch_and_bound = branch_and_bound
+        self.anytime = anytime
+        if anytime and prochirality:
+            raise ValueError("Anytime results are not supported with prochirality")
+        self.automorphisms = None
+        if use_automorphisms:
+            self.automorphisms = molecule.find_automorphisms()
+        self.checkpoint = None
+        if checkpoint_file:
+            if no_constraint or prochirality:
+                raise ValueError("Checkpoints are only supported by the constraints permuter, without prochirality")
+            self.checkpoint = ExactCheckpoint(checkpoint_file, checkpoint_interval)
+            if resume:
+                self.checkpoint.load()
+        elif resume:
+            raise ValueError("Cannot resume a calculation without a checkpoint file")
+        if ops_pool_size and (callback_func or checkpoint_file):
+            raise ValueError("Cannot output permutations or save checkpoints when calculating operations in parallel")
+        # the results and statistics of operations that were already calculated in full, by op_code, such as those
+        # of the sample run of choose_calculation. _calculate returns them instead of calculating them again
+        self.completed_ops = {}
 
     def calculate(self, timeout=300, *args, **kwargs):
         best_result=super().calculate(timeout)
+        if best_result is None:
+            # every operation of the chirality timed out before measuring a permutation
+            raise CalculationTimeoutError(run_time(self.start_time))
+        if self.checkpoint and not self.timed_out:
+            self.checkpoint.remove()
         overall_stats = self.statistics.to_dict()
+        if self.anytime:
+            overall_stats["optimal"] = not self.timed_out
+            overall_stats["explored fraction"] = self.statistics.explored_fraction
         overall_stats["runtime"] = run_time(self.start_time)
         self._csm_result = CSMResult(best_result, self.operation, overall_stats=overall_stats)
         return self.result
 
-    def _create_permuter(self, op, timeout):
+    def _create_permuter(self, op, deadline, work_unit=None):
         op_type=op.type
         op_order=op.order
         molecule=self.molecule
@@ -105,12 +307,15 @@ class ExactCalculation(BaseCalculation):
             else:
                 raise ValueError("The permutation in the function '_calculate' contains negative numbers: \n{}".format(perm_arr))
         else:
-            permuter = ConstraintPermuter(molecule, op_order, op_type, keep_structure, timeout=timeout)
+            permuter = ConstraintPermuter(molecule, op_order, op_type, keep_structure, deadline=deadline,
+                                          branch_and_bound=self.branch_and_bound, automorphisms=self.automorphisms,
+                                          work_unit=work_unit)
             if no_constraint:
-                permuter = CythonPermuter(molecule, op_order, op_type, keep_structure, timeout=timeout)
+                permuter = CythonStackPermuter(molecule, op_order, op_type, keep_structure, deadline=deadline,
+                                               automorphisms=self.automorphisms, work_unit=work_unit)
         return permuter
 
-    def _calculate_internal(self, op, timeout, permuter, fixed_vectors):
+    def _calculate_internal(self, op, permuter, fixed_vectors):
         op_type=op.type
         op_order=op.order
         molecule=self.molecule
@@ -119,8 +324,12 @@ class ExactCalculation(BaseCalculation):
         no_constraint=self.no_constraint
         prochirality=self.prochirality
 
+        if not prochirality:
+            return self._calculate_internal_batched(op, permuter)
+
         best_csm = CSMState(molecule=molecule, op_type=op_type, op_order=op_order, csm=MAX_DOUBLE)
         traced_state = CSMState(molecule=molecule, op_type=op_type, op_order=op_order)
+        bounded = getattr(permuter, "branch_and_bound", False)
         permuter.permute()
         for calc_state in permuter.permute():
 
@@ -145,11 +354,203 @@ class ExactCalculation(BaseCalculation):
 
             if csm < best_csm.csm:
                 best_csm = best_csm._replace(csm=csm, dir=dir, perm=list(calc_state.perm))
+                if bounded:
+                    permuter.incumbent = csm
                 if abs(csm) < 1e-9:
                     return best_csm, True, v1, v2
         return best_csm, False, None, None
 
-    def _calculate(self, op, timeout):
+    def _calculate_prochirality(self, op, permuter):
+        """
+        Measures the chirality and, once a permutation with a zero CSM fixes the plane, the prochirality, in a single
+        enumeration. The permutations visited before the zero are kept in blocks of CalcStateBuffers, and their
+        prochirality is calculated in one go from their A matrices, while the enumeration continues with the fixed
+        vectors. If they do not fit in PROCHIRALITY_BUFFER_MEMORY, the blocks are dropped and the prochirality is left
+        to a second enumeration. So is it with branch and bound, which would otherwise have to visit, and keep, every
+        permutation, since the subtrees pruned by their chirality may hold the best prochirality.
+        :return: best_csm, whether the chirality is zero, and the fixed vectors if a second enumeration is needed
+        """
+        best_csm = CSMState(molecule=self.molecule, op_type=op.type, op_order=op.order, csm=MAX_DOUBLE)
+        traced_state = CSMState(molecule=self.molecule, op_type=op.type, op_order=op.order)
+        bounded = getattr(permuter, "branch_and_bound", False)
+        block_memory = PROCHIRALITY_BLOCK_SIZE * (13 + len(self.molecule)) * 8
+        max_blocks = max(1, PROCHIRALITY_BUFFER_MEMORY // block_memory)
+        blocks = None
+        if not bounded:
+            blocks = [CalcStateBuffer(PROCHIRALITY_BLOCK_SIZE, len(self.molecule))]
+        fixed_vectors = None
+        for calc_state in permuter.permute():
+            if permuter.count % 1000000 == 0:
+                print("calculated for", int(permuter.count / 1000000), "million permutations thus far...\t Time:",
+                      run_time(self.start_time))
+            if fixed_vectors is None:
+                csm, dir, v1, v2 = calc_ref_plane(op.order, op.type == 'CS', calc_state, True)
+                if blocks is not None:
+                    if blocks[-1].size == PROCHIRALITY_BLOCK_SIZE:
+                        if len(blocks) == max_blocks:
+                            blocks = None
+                        else:
+                            blocks.append(CalcStateBuffer(PROCHIRALITY_BLOCK_SIZE, len(self.molecule)))
+                    if blocks is not None:
+                        blocks[-1].add(calc_state)
+            else:
+                csm, dir, _, _ = calc_ref_plane_prochirality(op.order, calc_state, fixed_vectors[0],
+                                                             fixed_vectors[1])
+
+            if self.callback_func:
+                traced_state = traced_state._replace(csm=csm, perm=calc_state.perm, dir=dir)
+                traced_state.serial = permuter.count
+                self.callback_func(traced_state)
+
+            if csm < best_csm.csm:
+                best_csm = best_csm._replace(csm=csm, dir=dir, perm=list(calc_state.perm))
+                if bounded:
+                    permuter.incumbent = csm
+                if abs(csm) < 1e-9:
+                    if fixed_vectors is not None:
+                        return best_csm, True, None
+                    if blocks is None:
+                        return best_csm, True, [v1, v2]
+                    print(f"Found symmetry {best_csm.dir}. Computing prochirality.")
+                    fixed_vectors = [v1, v2]
+                    best_csm = self._measure_prochirality_blocks(op, blocks, fixed_vectors)
+                    blocks = None
+                    if abs(best_csm.csm) < 1e-9:
+                        return best_csm, True, None
+        return best_csm, fixed_vectors is not None, None
+
+    def _measure_prochirality_blocks(self, op, blocks, fixed_vectors):
+        """
+        Calculates the prochirality of the permutations kept by _calculate_prochirality, in the order they were visited
+        :return: the best of them
+        """
+        best_csm = CSMState(molecule=self.molecule, op_type=op.type, op_order=op.order, csm=MAX_DOUBLE)
+        traced_state = CSMState(molecule=self.molecule, op_type=op.type, op_order=op.order)
+        serial = 0
+        for block in blocks:
+            csms, dirs = calc_ref_plane_prochirality_batch(op.order, block.A[:block.size], block.CSM[:block.size],
+                                                           fixed_vectors[0], fixed_vectors[1])
+            if self.callback_func:
+                for i in range(block.size):
+                    traced_state = traced_state._replace(csm=float(csms[i]), perm=block.perms[i].tolist(),
+                                                         dir=dirs[i])
+                    traced_state.serial = serial + i + 1
+                    self.callback_func(traced_state)
+            best = np.argmin(csms)
+            if csms[best] < best_csm.csm:
+                best_csm = best_csm._replace(csm=float(csms[best]), dir=dirs[best], perm=block.perms[best].tolist())
+            serial += block.size
+        return best_csm
+
+    def _calculate_internal_batched(self, op, permuter):
+        """
+        Like _calculate_internal, but buffers the completed permutations and calculates their reference planes
+        in blocks of REF_PLANE_BATCH_SIZE
+        """
+        best_csm = CSMState(molecule=self.molecule, op_type=op.type, op_order=op.order, csm=MAX_DOUBLE)
+        checkpoint = self.checkpoint if not self.perm else None
+        if checkpoint and checkpoint.current and checkpoint.current["operation"] == op.op_code:
+            saved = checkpoint.current["best"]
+            permuter.resume(checkpoint.current["position"], saved["statistics"])
+            if saved["perm"] is not None:
+                best_csm = ExactCheckpoint.state_from_dict(saved, self.molecule, op)
+                if permuter.branch_and_bound:
+                    permuter.incumbent = best_csm.csm
+            print("Resuming from permutation", permuter.count)
+        buffer = CalcStateBuffer(REF_PLANE_BATCH_SIZE, len(self.molecule))
+        # With branch and bound, the sooner a better permutation becomes the incumbent, the more branches it prunes.
+        # The blocks then start with a single permutation, go back to one after improving the incumbent, and double
+        # in size, up to REF_PLANE_BATCH_SIZE, while they do not
+        bounded = getattr(permuter, "branch_and_bound", False)
+        flush_size = 1 if bounded else REF_PLANE_BATCH_SIZE
+        if _shared_best_csm is not None and self._exchange_shared_best_csm(best_csm, permuter):
+            return best_csm, False, None, None
+        try:
+            for calc_state in permuter.permute():
+                if permuter.count % 1000000 == 0:
+                    print("calculated for", int(permuter.count / 1000000), "million permutations thus far...\t Time:",
+                          run_time(self.start_time))
+                if buffer.add(calc_state) or buffer.size >= flush_size:
+                    previous_csm = best_csm.csm
+                    best_csm = self._measure_buffer(op, buffer, best_csm, permuter)
+                    if bounded:
+                        flush_size = 1 if best_csm.csm < previous_csm else min(2 * flush_size, REF_PLANE_BATCH_SIZE)
+                    if abs(best_csm.csm) < 1e-9:
+                        return best_csm, True, None, None
+                    if _shared_best_csm is not None and self._exchange_shared_best_csm(best_csm, permuter):
+                        return best_csm, False, None, None
+                    if checkpoint and checkpoint.due:
+                        checkpoint.save_progress(op, permuter, best_csm)
+        except CalculationTimeoutError:
+            if not checkpoint and not self.anytime:
+                raise
+            # the buffered permutations are measured, so that the checkpoint and the best result so far are after
+            # the last one yielded
+            if buffer.size:
+                best_csm = self._measure_buffer(op, buffer, best_csm, permuter)
+            if checkpoint:
+                checkpoint.save_progress(op, permuter, best_csm)
+                print("Saved a checkpoint after permutation", permuter.count, "to", checkpoint.filename)
+            if not self.anytime:
+                raise
+            if abs(best_csm.csm) < 1e-9:
+                return best_csm, True, None, None
+            self.timed_out = True
+            return best_csm, False, None, None
+        if buffer.size:
+            best_csm = self._measure_buffer(op, buffer, best_csm, permuter)
+            if abs(best_csm.csm) < 1e-9:
+                return best_csm, True, None, None
+        return best_csm, False, None, None
+
+    def _exchange_shared_best_csm(self, best_csm, permuter):
+        """
+        In a process of parallel_chirality, shares best_csm with the processes of the other operations, and prunes with
+        theirs when using branch and bound. Pruning keeps the permutations with a zero CSM, so an operation still finds
+        the symmetry after a later operation did
+        :return: True if an operation before this one has already found the symmetry
+        """
+        with _shared_best_csm.get_lock():
+            if best_csm.csm < _shared_best_csm.value:
+                _shared_best_csm.value = best_csm.csm
+            shared_csm = _shared_best_csm.value
+        if getattr(permuter, "branch_and_bound", False):
+            permuter.incumbent = min(permuter.incumbent, shared_csm)
+        return _shared_symmetric_index.value < self.sub_operation_index
+
+    def _measure_buffer(self, op, buffer, best_csm, permuter):
+        """
+        Calculates the CSMs of the permutations in the buffer, and empties it. As in _calculate_internal, the
+        permutations after the first one with a zero CSM are not counted, nor passed to the callback
+        :return: the better of best_csm and the best of the buffered permutations
+        """
+        num_perms = buffer.size
+        csms, dirs = buffer.calculate(op.order, op.type == 'CS')
+        first_serial = permuter.count - num_perms + 1
+        zeros = np.flatnonzero(np.abs(csms) < 1e-9)
+        if zeros.size:
+            permuter.count -= num_perms - zeros[0] - 1
+            num_perms = zeros[0] + 1
+            csms = csms[:num_perms]
+            dirs = dirs[:num_perms]
+        write_batch = getattr(self.callback_func, "write_batch", None)
+        if write_batch:
+            write_batch(first_serial, op.type + str(op.order), csms, dirs, buffer.perms[:num_perms])
+        elif self.callback_func:
+            traced_state = CSMState(molecule=self.molecule, op_type=op.type, op_order=op.order)
+            for i in range(num_perms):
+                traced_state = traced_state._replace(csm=float(csms[i]), perm=buffer.perms[i].tolist(), dir=dirs[i])
+                traced_state.serial = first_serial + i
+                self.callback_func(traced_state)
+
+        best = np.argmin(csms)
+        if csms[best] < best_csm.csm:
+            best_csm = best_csm._replace(csm=float(csms[best]), dir=dirs[best], perm=buffer.perms[best].tolist())
+            if getattr(permuter, "branch_and_bound", False):
+                permuter.incumbent = best_csm.csm
+        return best_csm
+
+    def _calculate(self, op, deadline):
         """
         Calculates minimal csm, directional cosines by applying permutations that keep the similar atoms within the group.
         :param operation: cannot be CH.
@@ -158,7 +559,7 @@ class ExactCalculation(BaseCalculation):
         :param perm:
         :param no_constraint:
         :param suppress_print:
-        :param timeout:
+        :param deadline: the Deadline of the calculation
         :return:
         """
         op_type=op.type
@@ -169,38 +570,83 @@ class ExactCalculation(BaseCalculation):
         no_constraint=self.no_constraint
         prochirality=self.prochirality
 
-        permuter = self._create_permuter(op, timeout)
-
-        fixed_vectors = None
-        best_csm, zero_chirality, v1, v2 = self._calculate_internal(op, timeout,
-                                                                    permuter,
-                                                                    fixed_vectors)
-
-        print(prochirality, zero_chirality)
-        if prochirality and zero_chirality:
-            print(f"Found symmetry {best_csm.dir}. Computing prochirality.")
-            permuter = self._create_permuter(op, timeout)
-            fixed_vectors=[v1, v2]
-            best_csm, _, v1, v2 = self._calculate_internal(op, timeout,
-                                                                        permuter,
-                                                                        fixed_vectors)
+        if not perm and op.op_code in self.completed_ops:
+            best_csm, self.statistics = self.completed_ops[op.op_code]
+            return best_csm
+
+        permuter = self._create_permuter(op, deadline)
+        if self.checkpoint and not perm and op.op_code in self.checkpoint.completed:
+            # completed before the checkpoint was saved
+            saved = self.checkpoint.completed[op.op_code]
+            self.statistics = ExactStatistics(permuter)
+            self.statistics.restore(saved["statistics"])
+            return ExactCheckpoint.state_from_dict(saved, molecule, op)
+
+        if prochirality:
+            best_csm, zero_chirality, fixed_vectors = self._calculate_prochirality(op, permuter)
+            if fixed_vectors is not None:
+                # the visited permutations did not fit in memory, enumerate them again with the fixed vectors
+                print(f"Found symmetry {best_csm.dir}. Computing prochirality.")
+                permuter = self._create_permuter(op, deadline)
+                best_csm, _, v1, v2 = self._calculate_internal(op, permuter, fixed_vectors)
+        else:
+            best_csm, zero_chirality, v1, v2 = self._calculate_internal(op, permuter, None)
 
-        self.statistics = ExactStatistics(permuter)
+        if self.timed_out:
+            self.statistics = ExactStatistics(permuter, timed_out=True,
+                                              explored_fraction=explored_fraction(permuter, molecule, op))
+        else:
+            self.statistics = ExactStatistics(permuter)
 
         if best_csm.csm == MAX_DOUBLE:
+            if self.timed_out:
+                # an anytime calculation that timed out before measuring any permutation
+                raise CalculationTimeoutError(deadline.run_time)
             # failed to find csm value for any permutation
             # best_csm = best_csm._replace(csm=csm, dir=dir, perm=list(calc_state.perm))
             raise CSMValueError("Failed to calculate a csm value for %s %d" % (op_type, op_order), best_csm)
         best_csm = best_csm._replace(is_chiral = not zero_chirality)
+        if self.checkpoint and not perm and not self.timed_out:
+            self.checkpoint.save_completed(op, best_csm, self.statistics)
         return best_csm
 
+    @staticmethod
+    def _init_shared_best_csm(shared_best_csm, symmetric_index, cancelled):
+        _init_shared_best_csm(shared_best_csm, symmetric_index, cancelled)
+
+    def _calculate_sub_operation(self, op, deadline):
+        try:
+            result = self._calculate(op, deadline)
+            if _shared_symmetric_index is not None and result.csm < MIN_DOUBLE:
+                # the operations after this one can stop
+                with _shared_symmetric_index.get_lock():
+                    _shared_symmetric_index.value = min(_shared_symmetric_index.value, self.sub_operation_index)
+            return result
+        except CSMValueError:
+            if _shared_best_csm is None:
+                raise
+            # every permutation was pruned by the best CSM of the other operations, or they found the symmetry first
+            return None
+        except CalculationTimeoutError:
+            if not self.timed_out:
+                raise
+            # an anytime calculation timed out before measuring any permutation of this operation
+            return None
+
+    def _combine_statistics(self, statistics):
+        combined = reduce(lambda a, b: a + b, statistics)
+        self.statistics = copy.copy(statistics[-1])
+        self.statistics.set_totals(combined)
+        self.timed_out = combined.timed_out
+
     @staticmethod
     def exact_calculation_for_approx(operation, molecule, perm, prochirality=False):
         ec = ExactCalculation(operation, molecule, perm=perm, prochirality=prochirality)
         if operation.type == 'CH':  # Chirality
             raise ValueError("How did you get here? Approx should be sending chirality broken down to cs, Sns")
 
-        best_result = ec._calculate(operation, molecule)
+        # a single permutation is measured, so there is nothing to time out
+        best_result = ec._calculate(operation, None)
         falsecount, num_invalid, cycle_counts, bad_indices = check_perm_cycles(perm, operation)
         best_result = best_result._replace(num_invalid=num_invalid)
         return best_result
@@ -208,3 +654,231 @@ class ExactCalculation(BaseCalculation):
     @property
     def result(self):
         return self._csm_result
+
+
+def _init_shared_best_csm(shared_best_csm, symmetric_index=None, cancelled=None):
+    global _shared_best_csm, _shared_symmetric_index
+    _shared_best_csm = shared_best_csm
+    _shared_symmetric_index = symmetric_index
+    init_pool_deadline(cancelled)
+
+
+def _init_work_unit_runner(work_unit_runner, shared_best_csm, cancelled):
+    global _work_unit_runner
+    _init_shared_best_csm(shared_best_csm, cancelled=cancelled)
+    _work_unit_runner = work_unit_runner
+
+
+def _run_work_unit(work_unit):
+    return _work_unit_runner(work_unit)
+
+
+class _ExactWorkUnitRunner:
+    """
+    Measures the permutations of one work unit of the permutation tree, in a process of ParallelExact's pool. It is sent
+    to each process once, when the pool starts, so the tasks are only the paths of the work units
+    """
+    def __init__(self, calculation, op, deadline):
+        self.calculation = calculation
+        self.op = op
+        # the deadline applies to the whole calculation, not to each work unit
+        self.deadline = deadline
+
+    def __call__(self, work_unit):
+        calculation = self.calculation
+        op = self.op
+        permuter = calculation._create_permuter(op, self.deadline, work_unit=work_unit)
+        bounded = getattr(permuter, "branch_and_bound", False)
+        best_csm = CSMState(molecule=calculation.molecule, op_type=op.type, op_order=op.order, csm=MAX_DOUBLE)
+        if abs(_shared_best_csm.value) < 1e-9:
+            # another process already found the symmetry
+            return best_csm, ExactStatistics(permuter)
+        if bounded:
+            permuter.incumbent = _shared_best_csm.value
+
+        try:
+            for calc_state in permuter.permute():
+                if permuter.count % SHARED_CSM_INTERVAL == 0:
+                    shared_csm = _shared_best_csm.value
+                    if abs(shared_csm) < 1e-9:
+                        break
+                    if bounded:
+                        permuter.incumbent = min(permuter.incumbent, shared_csm)
+                csm, dir, v1, v2 = calc_ref_plane(op.order, op.type == 'CS', calc_state, False)
+                if csm < best_csm.csm:
+                    best_csm = best_csm._replace(csm=csm, dir=dir, perm=list(calc_state.perm))
+                    with _shared_best_csm.get_lock():
+                        if csm < _shared_best_csm.value:
+                            _shared_best_csm.value = csm
+                    if bounded:
+                        permuter.incumbent = csm
+                    if abs(csm) < 1e-9:
+                        break
+        except CalculationTimeoutError:
+            if not calculation.anytime:
+                raise
+            return best_csm, ExactStatistics(permuter, timed_out=True,
+                                             explored_fraction=explored_fraction(permuter, calculation.molecule, op))
+        return best_csm, ExactStatistics(permuter)
+
+
+class ParallelExact(ExactCalculation):
+    def __init__(self, operation, molecule, pool_size=0, units_per_process=4, *args, **kwargs):
+        """
+        Runs the exact CSM algorithm across a pool of processes. The branches at the first levels of the permutation
+        tree are listed once, and dealt into work units, and the processes share the best CSM found so far, so that
+        they all stop once one of them finds the symmetry (and prune with it, when using branch and bound)
+        :param pool_size: the number of processes, default 0 means cpu count - 1
+        :param units_per_process: how many work units the tree is split into for each process
+        """
+        if kwargs.get("callback_func") is not None:
+            raise ValueError("Cannot output permutations in a parallel exact calculation")
+        if kwargs.get("prochirality"):
+            raise ValueError("Please don't use parallel calculation for prochirality")
+        if kwargs.get("checkpoint_file") or kwargs.get("resume"):
+            raise ValueError("Checkpoints are not supported in a parallel exact calculation")
+        self.pool_size = pool_size
+        if pool_size == 0:
+            self.pool_size = max(multiprocessing.cpu_count() - 1, 1)
+        self.units_per_process = units_per_process
+        super().__init__(operation, molecule, *args, **kwargs)
+
+    def _calculate(self, op, deadline):
+        if self.perm or op.op_code in self.completed_ops:
+            return super()._calculate(op, deadline)
+
+        branches = self._create_permuter(op, deadline).split()
+        num_units = max(min(self.pool_size * self.units_per_process, len(branches)), 1)
+        # neighbouring branches are often of similar sizes, so they are dealt to different work units
+        work_units = [branches[index::num_units] for index in range(num_units)]
+        runner = _ExactWorkUnitRunner(self, op, deadline)
+        shared_best_csm = multiprocessing.Value('d', MAX_DOUBLE)
+        print("Searching permutations across {} processes in {} work units".format(self.pool_size, num_units))
+        pool = multiprocessing.Pool(processes=self.pool_size, initializer=_init_work_unit_runner,
+                                    initargs=(runner, shared_best_csm, deadline.share()))
+        try:
+            pool_outputs = list(pool.imap_unordered(_run_work_unit, work_units))
+        finally:
+            pool.close()
+            pool.join()
+
+        best_csm = min((result for result, statistics in pool_outputs), key=lambda result: result.csm)
+        self.statistics = reduce(lambda a, b: a + b, (statistics for result, statistics in pool_outputs))
+        self.timed_out = self.statistics.timed_out
+
+        if best_csm.csm == MAX_DOUBLE:
+            raise CSMValueError("Failed to calculate a csm value for %s %d" % (op.type, op.order), best_csm)
+        best_csm = best_csm._replace(is_chiral=not abs(best_csm.csm) < 1e-9)
+        return best_csm
+
+
+def _sub_operations(operation):
+    # the operations BaseCalculation.chirality measures for CH, or the operation itself
+    if operation.type == 'CH':
+        return [Operation('cs')] + [Operation("S" + str(op_order)) for op_order in range(2, operation.order + 1, 2)]
+    return [operation]
+
+
+def count_cycle_perms(group_size, cycle_lengths):
+    """
+    The number of permutations of group_size atoms whose cycles all have lengths in cycle_lengths.
+    The cycle of the first atom has some length l, and there are (group_size-1)!/(group_size-l)! ways to fill it
+    :param group_size: the size of an equivalence class
+    :param cycle_lengths: the legal cycle lengths
+    :return: the number of permutations
+    """
+    counts = [1]
+    for n in range(1, group_size + 1):
+        counts.append(sum(math.perm(n - 1, length - 1) * counts[n - length]
+                          for length in set(cycle_lengths) if length <= n))
+    return counts[group_size]
+
+
+def count_perms(molecule, operation):
+    """
+    The number of permutations the exact calculation enumerates without --keep-structure: the product over the
+    equivalence classes of the number of permutations with legal cycle lengths, summed over the operations of
+    a chirality calculation
+    :param molecule: instance of Molecule class
+    :param operation: instance of Operation class
+    :return: the number of permutations, per operation
+    """
+    counts = []
+    for op in _sub_operations(operation):
+        cycle_lengths = [1, op.order]
+        if op.type == 'SN':
+            cycle_lengths.append(2)
+        count = 1
+        for group in molecule.equivalence_classes:
+            count *= count_cycle_perms(len(group), cycle_lengths)
+        counts.append(count)
+    return counts
+
+
+def explored_fraction(permuter, molecule, op):
+    """
+    An estimate of the fraction of the permutations of op that permuter explored before it timed out: from its position
+    in the tree for the constraints permuter, and from its count and count_perms otherwise
+    """
+    if hasattr(permuter, "explored_fraction"):
+        return permuter.explored_fraction()
+    return min(permuter.count / count_perms(molecule, op)[0], 1.0)
+
+
+def estimate_perm_count(molecule, operation, keep_structure=False, num_samples=AUTO_TREE_SAMPLES, timeout=300):
+    """
+    The number of permutations the exact calculation enumerates, per operation: counted with count_perms, or
+    estimated by sampling the constraints permuter's tree with --keep-structure
+    """
+    if not keep_structure:
+        return count_perms(molecule, operation)
+    return [ConstraintPermuter(molecule, op.order, op.type, True, timeout=timeout).estimate_count(num_samples)
+            for op in _sub_operations(operation)]
+
+
+def choose_calculation(operation, molecule, keep_structure=False, timeout=300, no_constraint=False,
+                       branch_and_bound=False, use_automorphisms=False, *args, **kwargs):
+    """
+    Chooses between the trivial, exact and approx calculations: trivial when the identity is the only permutation,
+    exact when its estimated run time fits in the timeout, and approx otherwise.
+    The run time of the exact calculation is extrapolated from running it for AUTO_SAMPLE_TIME on each operation.
+    The operations whose sample run completes are not calculated again: their results are returned for the
+    completed_ops of the exact calculation.
+    :return: the command ("trivial", "exact" or "approx"), a dictionary of the estimates and a dictionary of the
+    completed operations
+    """
+    # the counts of large molecules don't fit in a float
+    counts = [float(min(count, sys.float_info.max))
+              for count in estimate_perm_count(molecule, operation, keep_structure, timeout=timeout)]
+    estimate = {"estimated perm count": sum(counts)}
+    if sum(counts) <= len(counts):
+        return "trivial", estimate, {}
+
+    # an anytime calculation measures the permutations it buffered when it times out, so that its statistics count
+    # only measured permutations
+    calc = ExactCalculation(operation, molecule, keep_structure=keep_structure, no_constraint=no_constraint,
+                            branch_and_bound=branch_and_bound, use_automorphisms=use_automorphisms, anytime=True)
+    calc.start_time = now()
+    exact_time = 0
+    completed_ops = {}
+    for op, count in zip(_sub_operations(operation), counts):
+        calc.timed_out = False
+        start_time = now()
+        try:
+            result = calc._calculate(op, Deadline(min(AUTO_SAMPLE_TIME, timeout)))
+        except (CSMValueError, CalculationTimeoutError):
+            # there are no permutations, or none was measured before the deadline
+            result = None
+        if not calc.timed_out:
+            exact_time += run_time(start_time)
+            if result is not None:
+                completed_ops[op.op_code] = result, calc.statistics
+            continue
+        if calc.statistics.perm_count == 0:
+            exact_time = MAX_DOUBLE
+            break
+        exact_time += run_time(start_time) * count / calc.statistics.perm_count
+    estimate["estimated exact time"] = exact_time
+    if exact_time <= timeout:
+        return "exact", estimate, completed_ops
+    return "approx", estimate, {}
@@ -1,10 +1,12 @@
 import datetime
+import random
 import sys
 
 import numpy as np
-from csm.fast import PreCalcPIP, PermInProgress
+from csm.fast import PreCalcPIP, PermInProgress, AutomorphismFilter
 
-from csm.calculations.basic_calculations import now, check_timeout
+from csm.calculations.basic_calculations import Deadline
+from csm.calculations.constants import MAX_DOUBLE, MIN_DOUBLE
 from csm.input_output.formatters import csm_log as print
 
 __author__ = 'Devora'
@@ -127,6 +129,10 @@ class ConstraintsBase:
 
 
 class DictionaryConstraints(ConstraintsBase):
+    # The options of each index are kept in sets. choose breaks ties by the smallest index and returns the options in
+    # order, so that the permutation tree is walked in the same order no matter how often indices were removed and
+    # restored (backtracking reinserts them at the end of the dictionary). Checkpoints and parallel work units rely on
+    # branch numbers meaning the same thing on every descent.
     def __init__(self, molecule, for_copy=False):
         self.constraints = {}
         if not for_copy:
@@ -142,13 +148,11 @@ class DictionaryConstraints(ConstraintsBase):
         self.constraints[index] = set(constraints)
 
     def remove_constraint_from_all(self, constraint):
-        removed_indices = set()
-        for index in self.constraints:
-            try:
-                self.constraints[index].remove(constraint)
-                removed_indices.add(index)
-            except KeyError:
-                pass
+        removed_indices = []
+        for index, options in self.constraints.items():
+            if constraint in options:
+                options.remove(constraint)
+                removed_indices.append(index)
         # if removed_indices:
         self.push_undo('remove_constraint_from_all', (removed_indices, constraint))
 
@@ -174,19 +178,21 @@ class DictionaryConstraints(ConstraintsBase):
     def __getitem__(self, item):
         return list(self.constraints[item])
 
+    def _ordered_options(self, index):
+        return sorted(self.constraints[index])
+
     def choose(self):
+        # ties are broken by the smallest index
         min_length = 1e40
         min_key = None
 
-        for key in self.constraints:
-            key_length = len(self.constraints[key])
-            if key_length < min_length:
+        for key, options in self.constraints.items():
+            key_length = len(options)
+            if key_length < min_length or (key_length == min_length and key < min_key):
                 min_key, min_length = key, key_length
-                if key_length == 1:  # can't get shorter than 1, no point searching further
-                    break
 
         if min_key is not None:
-            return min_key, list(self.constraints[min_key])
+            return min_key, self._ordered_options(min_key)
         return None, None
 
     # Checkpoints
@@ -240,31 +246,37 @@ class DictionaryConstraints(ConstraintsBase):
 
 class DistanceConstraints(DictionaryConstraints):
     def __init__(self, molecule, distances_dict):
+        '''
+        :param distances_dict: for each atom, a dictionary from its equivalent atoms to their distances, in order of
+        distance
+        '''
         self.distances_dict = distances_dict
         self.constraints = self._create_constraints(molecule)
+        # only the atoms equivalent to an atom can have it as an option
+        self._equivalents = [atom.equivalency for atom in molecule.atoms]
         self.undo = []
 
     def _create_constraints(self, molecule):
         constraints = {}
-        for index, atom in enumerate(molecule.atoms):
-            def dict_lookup(ind):
-                return self.distances_dict[index][ind]
-
-            constraints[index] = sorted(atom.equivalency, key=dict_lookup)
+        for index in range(len(molecule)):
+            constraints[index] = list(self.distances_dict[index])
         return constraints
 
     def set_constraint(self, index, constraints):
         self.push_undo('set_constraint', (index, self.constraints[index]))
         self.constraints[index] = constraints
 
+    def _ordered_options(self, index):
+        # the options are kept in order of distance
+        return list(self.constraints[index])
+
     def remove_constraint_from_all(self, constraint):
         removed_indices = []
-        for index in self.constraints:
-            try:
-                self.constraints[index].remove(constraint)
+        for index in self._equivalents[constraint]:
+            options = self.constraints.get(index)
+            if options is not None and constraint in options:
+                options.remove(constraint)
                 removed_indices.append(index)
-            except ValueError:
-                pass
         # if removed_indices:
         self.push_undo('remove_constraint_from_all', (removed_indices, constraint))
 
@@ -426,7 +438,8 @@ class ConstraintPropagator:
 
 
 class ConstraintPermuter:
-    def __init__(self, molecule, op_order, op_type, keep_structure, timeout=300, *args, **kwargs):
+    def __init__(self, molecule, op_order, op_type, keep_structure, timeout=300, branch_and_bound=False,
+                 automorphisms=None, work_unit=None, split_depth=2, deadline=None, *args, **kwargs):
         self.molecule = molecule
         self.op_order = op_order
         self.op_type = op_type
@@ -435,14 +448,88 @@ class ConstraintPermuter:
         self.truecount = 0
         self.falsecount = 0
         self.cycle_lengths = [1, op_order]
-        self.timeout = timeout
-        self.start_time = datetime.datetime.now()
+        # the deadline of the calculation, or a new one timing out after timeout seconds
+        if deadline is None:
+            deadline = Deadline(timeout)
+        self.deadline = deadline
         if op_type == 'SN':
             self.cycle_lengths.append(2)
         self.constraints_prop = ConstraintPropagator(self.molecule, self.op_order, self.op_type, keep_structure)
         self.constraints = DictionaryConstraints(self.molecule)
         self.print_branches = False
         self._permute_start = datetime.datetime.now()
+        # When branch_and_bound is set, the caller updates incumbent with the best CSM found so far, and subtrees
+        # whose CSM lower bound can't improve on it are pruned
+        self.branch_and_bound = branch_and_bound
+        self.incumbent = MAX_DOUBLE
+        self.pruned = 0
+        # When automorphisms are given, only one permutation out of each set of permutations conjugate by them
+        # is returned, since they all have the same CSM. The subtrees whose permutations all have a smaller conjugate
+        # are skipped
+        self.automorphism_filter = None
+        if automorphisms:
+            self.automorphism_filter = AutomorphismFilter(automorphisms, len(molecule),
+                                                          [index for group in molecule.equivalence_classes
+                                                           for index in group])
+        # When work_unit is given, it is some of the paths that split() returns, and only the branches on them are
+        # explored, so that permuters given all of the paths together enumerate the whole tree exactly once.
+        # _unit_branches holds those paths and the paths leading to them
+        self.work_unit = work_unit
+        self.split_depth = split_depth
+        self._unit_branches = None
+        if work_unit is not None:
+            self._unit_branches = {tuple(path[:depth]) for path in work_unit for depth in range(len(path) + 1)}
+        # while split() runs, the paths it returns
+        self._split_paths = None
+        self._path = []
+        # the number of branches at each level of _path, for explored_fraction
+        self._widths = []
+        # position is the path of the last permutation yielded. After resume(position), permute() skips the branches
+        # up to and including that permutation
+        self.position = ()
+        self._resume_path = []
+        self._resuming = False
+
+    @property
+    def skipped(self):
+        if self.automorphism_filter is None:
+            return 0
+        return self.automorphism_filter.skipped
+
+    def resume(self, position, statistics):
+        '''
+        continue an enumeration that was stopped: permute() will yield the permutations after position
+        :param position: the position of the last permutation that was measured
+        :param statistics: the count, truecount, falsecount, pruned and skipped of the stopped enumeration
+        '''
+        self._resume_path = list(position)
+        self._resuming = True
+        self.position = tuple(position)
+        self.count = statistics["count"]
+        self.truecount = statistics["truecount"]
+        self.falsecount = statistics["falsecount"]
+        self.pruned = statistics["pruned"]
+        if self.automorphism_filter is not None:
+            self.automorphism_filter.skipped = statistics["skipped"]
+
+    def progress(self):
+        '''
+        :return: the position and statistics that resume() continues from
+        '''
+        return list(self.position), {"count": self.count, "truecount": self.truecount, "falsecount": self.falsecount,
+                                     "pruned": self.pruned, "skipped": self.skipped}
+
+    def explored_fraction(self):
+        '''
+        An estimate of the fraction of the permutation tree that was explored before the branch being explored now,
+        assuming that the subtrees of the branches at each level are all of the same size
+        '''
+        fraction = 0.0
+        weight = 1.0
+        for branch, width in zip(self._path, self._widths):
+            fraction += weight * branch / width
+            weight /= width
+        return fraction
 
     @property
     def run_time(self):
@@ -452,7 +539,7 @@ class ConstraintPermuter:
 
     def check_timeout(self):
         # step zero: check if time out
-        check_timeout(self.start_time, self.timeout)
+        self.deadline.check()
 
     def create_cycle(self, atom, pip):
         group = []
@@ -529,17 +616,105 @@ class ConstraintPermuter:
             print("DEAD END")
         self.falsecount += 1
 
+    def is_dominated(self, pip):
+        '''
+        checks whether no completion of the current pip can have a lower CSM than the incumbent.
+        only meaningful after a cycle has been closed, since the bound only changes then
+        :param pip: a PreCalcPIP
+        :return: True if the subtree can be pruned
+        '''
+        if not self.branch_and_bound or self.incumbent == MAX_DOUBLE:
+            return False
+        if pip.lower_bound() >= self.incumbent + MIN_DOUBLE:
+            if self.print_branches:
+                print("PRUNED")
+            self.pruned += 1
+            return True
+        return False
+
+    def has_smaller_conjugate(self, pip):
+        '''
+        checks whether every completion of the current pip has a conjugate by an automorphism that is lexicographically
+        smaller, and so is measured in another subtree. like is_dominated, it is checked after a cycle has been closed
+        :param pip: a PreCalcPIP
+        :return: True if the subtree can be skipped
+        '''
+        return self.automorphism_filter is not None and not self.automorphism_filter.is_canonical(pip.p)
+
+    def owns_branch(self):
+        '''
+        checks whether the branch at the current path belongs to this permuter's work unit: whether it is on one of
+        the unit's paths, or below one
+        :return: True if the branch should be explored
+        '''
+        if self._unit_branches is None or len(self._path) > self.split_depth:
+            return True
+        return tuple(self._path) in self._unit_branches
+
+    def split(self):
+        '''
+        the paths (the indices of the options chosen along the way) of the branches at split_depth, and of the
+        permutations completed above it. Only the levels above split_depth are explored, and the subtrees of the
+        paths are enumerated separately by permuters given them as their work_unit
+        :return: a list of paths
+        '''
+        self._split_paths = []
+        try:
+            for pip in self._permute(PreCalcPIP(self.molecule, self.op_order, self.op_type)):
+                pass
+            return self._split_paths
+        finally:
+            self._split_paths = None
+
     def placement_generator(self, atom, options):
         for option in options:
             yield atom, option
 
+    def estimate_count(self, num_samples=100, seed=None):
+        '''
+        Knuth's estimate of the number of permutations permute() yields, without enumerating them: a random path from
+        the root to a leaf (or a dead end) is followed, and the product of the numbers of legal options along it is an
+        unbiased estimate of the number of leaves. Branch and bound, automorphisms and work units are ignored.
+        :param num_samples: the number of random paths averaged
+        :param seed: seed for the random choices
+        :return: the estimated number of permutations
+        '''
+        rng = random.Random(seed)
+        pip = PermInProgress(self.molecule, self.op_order, self.op_type)
+        total = 0
+        for i in range(num_samples):
+            self.check_timeout()
+            total += self._sample_path(pip, rng)
+        return total / num_samples
+
+    def _sample_path(self, pip, rng):
+        passed_check_with_len_one, len_one_placements, len_one_old_states, atom, options = self.handle_len_ones(pip)
+        estimate = 0
+        if passed_check_with_len_one:
+            if atom is None:
+                estimate = 1
+            else:
+                legal = []
+                for atom, destination in self.placement_generator(atom, options):
+                    self.constraints.mark_checkpoint()
+                    passed_check, old_state = self.attempt_placement(pip, atom, destination)
+                    if passed_check:
+                        legal.append(destination)
+                        self.undo_placement(pip, atom, destination, old_state)
+                    self.constraints.backtrack_checkpoint()
+                if legal:
+                    destination = rng.choice(legal)
+                    self.constraints.mark_checkpoint()
+                    passed_check, old_state = self.attempt_placement(pip, atom, destination)
+                    estimate = len(legal) * self._sample_path(pip, rng)
+                    self.undo_placement(pip, atom, destination, old_state)
+                    self.constraints.backtrack_checkpoint()
+        self.unhandle_len_ones(pip, len_one_placements, len_one_old_states)
+        return estimate
+
     def permute(self):
         # step 1: create initial empty pip and qip
-        use_cache = True
-        if len(self.molecule) > 1000:
-            print("Molecule size exceeds recommended size for using caching. (Perhaps you meant to use --approx?)")
-            use_cache = False
-        pip = PreCalcPIP(self.molecule, self.op_order, self.op_type, use_cache=use_cache)
+        pip = PreCalcPIP(self.molecule, self.op_order, self.op_type)
         # pip = PythonPIP(self.molecule, self.op_order, self.op_type)
         # step 2: create initial set of constraints
         # constraints=IndexConstraints(self.molecule)
@@ -550,53 +725,78 @@ class ConstraintPermuter:
 
     def _permute(self, pip):
         self.check_timeout()
+        if self._split_paths is not None and len(self._path) == self.split_depth:
+            self._split_paths.append(tuple(self._path))
+            return
 
         # handle len ones
         passed_check_with_len_one, len_one_placements, len_one_old_states, atom, options = self.handle_len_ones(pip)
 
+        if passed_check_with_len_one and len_one_old_states and (self.is_dominated(pip) or
+                                                                 self.has_smaller_conjugate(pip)):
+            # the cycles closed by the len one placements can't lead to a better CSM, or to a new one
+            passed_check_with_len_one = False
+
         if passed_check_with_len_one:  # the len one placements didn't lead to a dead end
             # STOP CONDITION: if there are no atoms left, the permutation has been completed. yield permutation
             # (what if permutation is illegal?)
             if atom is None:
-                yield pip
+                if self._resuming:
+                    # this is the permutation resume() was given, which was already measured
+                    self._resuming = False
+                elif self._split_paths is not None:
+                    self._split_paths.append(tuple(self._path))
+                elif self.owns_branch():
+                    self.position = tuple(self._path)
+                    yield pip
             # step two:
             # for each option (opt)
             else:
-                for atom, destination in self.placement_generator(atom, options):
+                for branch, (atom, destination) in enumerate(self.placement_generator(atom, options)):
+                    if self._resuming:
+                        # skip the branches before the resumed position, and descend into the one on it
+                        if branch < self._resume_path[len(self._path)]:
+                            continue
+                        if branch > self._resume_path[len(self._path)]:
+                            self._resuming = False
                     # Try atom->destination
+                    self._path.append(branch)
+                    if not self.owns_branch():
+                        # the branch belongs to another work unit
+                        self._path.pop()
+                        continue
 
                     # save current constraints
                     self.constraints.mark_checkpoint()
+                    self._widths.append(len(options))
                     # propagate changes in constraints
                     passed_check, old_state = self.attempt_placement(pip, atom, destination)
                     if passed_check:
                         # yield from recursive create on the new pip and new constraints
-                        yield from self._permute(pip)
+                        if old_state is None or not (self.is_dominated(pip) or self.has_smaller_conjugate(pip)):
+                            yield from self._permute(pip)
                         self.undo_placement(pip, atom, destination, old_state)
                     else:
                         self.dead_end()
+                    self._path.pop()
+                    self._widths.pop()
                     self.constraints.backtrack_checkpoint()
+                    # whatever comes after the branch of the resumed position is new
+                    self._resuming = False
 
         # undo the handling of len ones
         self.unhandle_len_ones(pip, len_one_placements, len_one_old_states)
 
 
 class ConstraintsOrderedByDistancePermuter(ConstraintPermuter):
-    def __init__(self, molecule, op_order, op_type, distances_dict, perm_timeout=300, *args, **kwargs):
-        super().__init__(molecule, op_order, op_type, keep_structure=True)
+    def __init__(self, molecule, op_order, op_type, distances_dict, perm_timeout=300, deadline=None, *args, **kwargs):
+        super().__init__(molecule, op_order, op_type, keep_structure=True, timeout=perm_timeout, deadline=deadline)
         if len(molecule) > 10000:
             raise ValueError("Please don't use keep structure on molecules this big yet")
         if len(molecule) > 100:
             sys.setrecursionlimit(len(molecule))
         self.constraints = DistanceConstraints(molecule, distances_dict)
         # self.print_branches = True
-        self._permute_start = now()
-        self._permute_timeout = perm_timeout
-        # print("start time", start_time)
-
-    def check_timeout(self):
-        # step zero: check if time out
-        check_timeout(self._permute_start, self._permute_timeout)
 
     def permute(self):
         # step 1: create initial empty pip and qip
@@ -618,20 +818,14 @@ class ConstraintsSelectedByDistancePermuter(ConstraintsOrderedByDistancePermuter
 
 
 class ConstraintsSelectedFromDistanceListPermuter(ConstraintPermuter):
-    def __init__(self, molecule, op_order, op_type, distances_list, perm_timeout=300, *args, **kwargs):
-        super().__init__(molecule, op_order, op_type, keep_structure=True)
+    def __init__(self, molecule, op_order, op_type, distances_list, perm_timeout=300, deadline=None, *args, **kwargs):
+        super().__init__(molecule, op_order, op_type, keep_structure=True, timeout=perm_timeout, deadline=deadline)
         if len(molecule) > 10000:
             raise ValueError("Please don't use approx keep structure on molecules this big yet")
         if len(molecule) > 100:
             sys.setrecursionlimit(len(molecule))
         self.distances = distances_list
         # self.print_branches=True
-        self._permute_timeout = perm_timeout
-
-    def check_timeout(self):
-        # step zero: check if time out
-        # now = super().check_timeout()
-        check_timeout(self._permute_start, self._permute_timeout)
 
     def placement_generator(self, start_index):
         for distance_index in range(start_index, len(self.distances)):
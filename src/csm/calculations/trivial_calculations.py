@@ -2,7 +2,7 @@ import datetime
 
 from csm.fast import CythonPermuter
 
-from csm.calculations.basic_calculations import run_time, check_timeout
+from csm.calculations.basic_calculations import run_time
 from csm.calculations.constants import MAX_DOUBLE
 from csm.calculations.data_classes import CSMState, CSMResult, BaseCalculation
 from csm.calculations.exact_calculations import ExactCalculation
@@ -20,14 +20,16 @@ class TrivialCalculation(BaseCalculation):
     If use-chains is specified, calculates the identity permutation of every possible chain permutation, returns best.
     """
 
-    def __init__(self, operation, molecule, use_chains=True, timeout=300, chain_perms=None, prochirality=False, *args, **kwargs):
+    def __init__(self, operation, molecule, use_chains=True, timeout=300, chain_perms=None, prochirality=False,
+                 deadline=None, *args, **kwargs):
         """
         :param operation: instance of Operation class or named tuple, with fields for name and order, that describes the symmetry.
         :param molecule: instance of Molecule class on which the described symmetry calculation will be performed.
         :param use_chains: default True. When True, all possible chain permutations with an identity perm on their components are measured.
                 When false, only the pure identity perm is measured.
+        :param deadline: default None, the Deadline of the calculation. When None, one is created from timeout.
         """
-        super().__init__(operation, molecule)
+        super().__init__(operation, molecule, deadline=deadline)
         self.use_chains = use_chains
         self.statistics = {}
         self.start_time = datetime.datetime.now()
@@ -35,7 +37,7 @@ class TrivialCalculation(BaseCalculation):
         self.chain_permutations=chain_perms
         self.prochirality = prochirality
 
-    def get_chain_perms(self, operation):
+    def get_chain_perms(self, operation, deadline):
         if self.chain_permutations:
             return
         molecule=self.molecule
@@ -43,9 +45,9 @@ class TrivialCalculation(BaseCalculation):
             chain_permutations = []
             dummy = MoleculeFactory.dummy_molecule_from_size(len(molecule.chains), molecule.chain_equivalences)
             permuter = CythonPermuter(dummy, operation.order, operation.type, keep_structure=False,
-                                      precalculate=False)
+                                      precalculate=False, deadline=deadline)
             for i, state in enumerate(permuter.permute()):
-                check_timeout(self.start_time, self.timeout)
+                deadline.check()
                 chain_permutations.append(list(state.perm))
             self.chain_permutations=chain_permutations
 
@@ -57,15 +59,15 @@ class TrivialCalculation(BaseCalculation):
         return self.result
 
 
-    def _calculate(self, operation, timeout=300):
-        self.get_chain_perms(operation)
+    def _calculate(self, operation, deadline):
+        self.get_chain_perms(operation, deadline)
         molecule = self.molecule
         self.statistics[operation.op_code]={}
         if molecule.chains and self.use_chains:
             best = CSMState(molecule=molecule, op_type=self.operation.type, op_order=self.operation.order,
                             csm=MAX_DOUBLE)
             for i, chain_perm in enumerate(self.chain_permutations):
-                check_timeout(self.start_time, self.timeout)
+                deadline.check()
                 perm = [-1 for i in range(len(molecule))]
                 for f_index in range(len(chain_perm)):
                     f_chain = molecule.chains[f_index]
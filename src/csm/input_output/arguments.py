@@ -111,6 +111,10 @@ def _create_parser(cmd=''):
                             help="treat this program as a piped program (read from sys.stdin, write to sys.stdout)")
         parser.add_argument("--prochirality", action='store_true', default=False,
                             help="if using cs operation, gives a measure of prochirality.")
+        parser.add_argument('--root-solver', default='numpy', choices=['numpy', 'newton'],
+                            help="The solver for the largest root of the reference plane polynomial: numpy (np.roots) "
+                                 "or newton (bracketed Newton on the secular equation, the faster and more accurate). "
+                                 "Default is numpy")
 
     def shared_normalization_utility_func(
             parser):  # I made this because having normalization stuck in the calc utility func was ugly
@@ -132,6 +136,8 @@ def _create_parser(cmd=''):
     def add_input_output_utility_func(parser):
         parser.add_argument('--parallel', type=int, const=0, nargs='?',
                             help='Run calculation on molecules in parallel. If no number of processors is specified, [cpu count - 1] will be used')
+        parser.add_argument('--threads', action='store_true', default=False,
+                            help='Run --parallel and --parallel-dirs in threads of this process instead of in separate processes. The threads of --parallel-dirs run at the same time in the assignment and distance steps of the approximation, which release the GIL; the threads of --parallel mostly take turns, and only save the copies of the molecules')
         parser_input_args = parser.add_argument_group(
             "Args for input (requires --input)")
         parser_input_args.add_argument("--input", help="molecule file or folder, default is current working directory",
@@ -195,6 +201,14 @@ def _create_parser(cmd=''):
                           help="output file or folder, default is 'csm_results\\timestamp' folder in current working directory, if provided directory exists a new one with timestamp will be created")
     output_utility_func(out_args)
 
+    # PERMS-TO-CSV
+    perms_args = commands.add_parser('perms-to-csv',
+                                     help="Convert a binary permutations log written by --output-perms --perms-format binary to csv",
+                                     usage="csm perms-to-csv LOG [--output filename]")
+    perms_args.add_argument('perms_log', help="the binary permutations log")
+    perms_args.add_argument('--output', default=None,
+                            help="the csv file, default is the log's name with a .csv extension")
+
     # EXACT
     exact_args_ = commands.add_parser('exact', help="Perform an exact CSM calculation", conflict_handler='resolve',
                                       usage='csm exact TYPE [optional args]\n'
@@ -208,6 +222,32 @@ def _create_parser(cmd=''):
                             help="Don't allow permutations that break bonds")
     exact_args.add_argument('--output-perms', action='store_true', default=False,
                             help='Writes all enumerated permutations to files in folder exact in results-- does not work with parallel')
+    exact_args.add_argument('--perms-format', choices=['csv', 'binary'], default='csv',
+                            help="The format of --output-perms: csv, or a compact binary log that can be converted to csv with the perms-to-csv command. Default is csv")
+    exact_args.add_argument('--keep-best', type=int, default=None,
+                            help="Keep the K permutations with the lowest CSM and a histogram of the CSMs of all the permutations, and write them to files in folder best-perms in results. Cannot be used with --output-perms")
+    exact_args.add_argument('--histogram-bins', type=int, default=100,
+                            help="The number of bins, between 0 and 100, of the histogram of --keep-best. Default is 100")
+    exact_args.add_argument('--no-constraint', action='store_true', default=False,
+                            help="Enumerate the permutations directly instead of with the constraints algorithm")
+    exact_args.add_argument('--branch-and-bound', action='store_true', default=False,
+                            help="Prune branches of the permutation tree that can't improve on the best CSM found so far")
+    exact_args.add_argument('--parallel-perms', type=int, const=0, nargs='?',
+                            help='Split the permutations of each calculation across processes. If no number of processors is specified, cpu count - 1 will be used. Cannot be used with --parallel')
+    exact_args.add_argument('--parallel-ops', type=int, const=0, nargs='?',
+                            help='Calculate the operations of a chirality calculation (cs, s2, s4...) in parallel processes, which stop once one of them finds the symmetry. If no number of processors is specified, cpu count - 1 will be used')
+    exact_args.add_argument('--use-automorphisms', action='store_true', default=False,
+                            help="Measure only one permutation out of each set of permutations related by a symmetry of the molecule")
+    exact_args.add_argument('--checkpoint', type=str, default=None, dest='checkpoint_folder',
+                            help="Save the progress of each calculation to a file in this folder every --checkpoint-interval seconds and when it times out, so that it can be resumed with --resume")
+    exact_args.add_argument('--checkpoint-interval', type=int, default=60,
+                            help="How often, in seconds, to save a checkpoint. Default is 60")
+    exact_args.add_argument('--resume', action='store_true', default=False,
+                            help="Continue the calculations from the checkpoints in the --checkpoint folder")
+    exact_args.add_argument('--anytime', action='store_true', default=False,
+                            help="When the calculation times out, return the best permutation found so far instead of failing. The result is marked as not optimal, with an estimate of the fraction of the permutations that were explored")
+    exact_args.add_argument('--cache-memory', type=int, default=512,
+                            help="The memory, in MB, for caching the products of pairs of equivalent atoms. Equivalence classes that do not fit are calculated on the fly. Default is 512")
     shared_normalization_utility_func(exact_args)
     add_input_output_utility_func(exact_args_)
 
@@ -244,6 +284,8 @@ def _create_parser(cmd=''):
                              help='Do a single iteration on many directions (use with --fibonacci), and then a full set of iterations only on the best k (default 10)')
     approx_args.add_argument('--parallel-dirs', type=int, const=0, nargs='?',
                              help='Calculate directions in parallel. Recommended for use with fibonacci. If no number of processors is specified, cpu count - 1 will be used. Cannot be used with --parallel')
+    approx_args.add_argument('--parallel-ops', type=int, const=0, nargs='?',
+                             help='Calculate the operations of a chirality calculation (cs, s2, s4...) in parallel processes, which stop once one of them finds the symmetry. If no number of processors is specified, cpu count - 1 will be used')
     # misc
     approx_args.add_argument('--input-chain-perm', nargs="?", type=str, default=None, dest='chain_perm_file_name',
                              const=os.path.join(os.getcwd(), "chainperm.txt"),
@@ -255,6 +297,12 @@ def _create_parser(cmd=''):
 
     approx_args.add_argument('--output-perms', action='store_true', default=False,
                             help='Writes all enumerated permutations to files in folder approx in results-- does not work with parallel')
+    approx_args.add_argument('--perms-format', choices=['csv', 'binary'], default='csv',
+                            help="The format of --output-perms: csv, or a compact binary log that can be converted to csv with the perms-to-csv command. Default is csv")
+    approx_args.add_argument('--keep-best', type=int, default=None,
+                            help="Keep the K permutations with the lowest CSM and a histogram of the CSMs of all the permutations, and write them to files in folder best-perms in results. Cannot be used with --output-perms")
+    approx_args.add_argument('--histogram-bins', type=int, default=100,
+                            help="The number of bins, between 0 and 100, of the histogram of --keep-best. Default is 100")
     shared_normalization_utility_func(approx_args)
     add_input_output_utility_func(approx_args_)
 
@@ -276,6 +324,18 @@ def _create_parser(cmd=''):
                             help="if using cs operation, gives a measure of prochirality.")
     shared_normalization_utility_func(trivial_args)
     add_input_output_utility_func(trivial_args_)
+
+    # AUTO
+    auto_args_ = commands.add_parser('auto', help="Choose between exact, approx and trivial by the estimated cost of exact",
+                                     conflict_handler='resolve',
+                                     usage='csm auto SYM [optional args]\n'
+                                           'example: csm auto c4 --input --output --timeout 60')
+    auto_args = auto_args_.add_argument_group("Args for auto calculation")
+    shared_calc_utility_func(auto_args)
+    auto_args.add_argument('--keep-structure', action='store_true', default=False,
+                           help="Don't allow permutations that break bonds (estimates the exact calculation by sampling, and uses the keep-structure approx algorithm)")
+    shared_normalization_utility_func(auto_args)
+    add_input_output_utility_func(auto_args_)
     return parser
 
 
@@ -360,6 +420,8 @@ def _process_arguments(parse_res):
         parse_input(dictionary_args)
     elif parse_res.command == "write":
         parse_output(dictionary_args)
+    elif parse_res.command == "perms-to-csv":
+        pass
     else:
         # get input/output if relevant
         parse_input(dictionary_args)
@@ -368,12 +430,15 @@ def _process_arguments(parse_res):
         if parse_res.parallel is not None:
             pool_size = parse_res.parallel
             if pool_size == 0:
-                pool_size = multiprocessing.cpu_count() - 1
+                pool_size = max(multiprocessing.cpu_count() - 1, 1)
             pool_size = min(pool_size,
                             multiprocessing.cpu_count())  # do not allow a pool size greater than the number of cpu
             dictionary_args['pool_size'] = pool_size
             dictionary_args['parallel'] = True
 
+        if parse_res.threads and parse_res.parallel is None and getattr(parse_res, "parallel_dirs", None) is None:
+            raise ValueError("--threads only applies to --parallel and --parallel-dirs")
+
         if parse_res.command == "comfile":
             dictionary_args["command_file"] = parse_res.comfile
             dictionary_args["old_command"] = parse_res.old_cmd
@@ -382,10 +447,52 @@ def _process_arguments(parse_res):
                 parse_res.symmetry, parse_res.sn_max)
             dictionary_args['normalizations'] = parse_res.normalize
 
+            if parse_res.command in ['exact', 'approx'] and parse_res.parallel_ops is not None:
+                if parse_res.parallel:
+                    raise ValueError("Cannot specify --parallel and --parallel-ops at same time")
+                if parse_res.output_perms or parse_res.keep_best is not None:
+                    raise ValueError("Cannot output permutations with --parallel-ops")
+                if parse_res.symmetry.lower() != 'ch':
+                    logger.warning("--parallel-ops only applies to chirality (ch)")
+                pool_size = parse_res.parallel_ops
+                if pool_size == 0:
+                    pool_size = max(multiprocessing.cpu_count() - 1, 1)
+                dictionary_args['ops_pool_size'] = pool_size
+
+            if parse_res.command in ['exact', 'approx'] and parse_res.keep_best is not None:
+                if parse_res.output_perms:
+                    raise ValueError("Cannot specify --output-perms and --keep-best at same time")
+                if parse_res.keep_best < 1:
+                    raise ValueError("--keep-best must be at least 1")
+
             if parse_res.command == 'exact':
                 if parse_res.output_perms and parse_res.parallel:
                     logger.warning(
                         "cannot output perms while running a calculation in parallel")
+                if parse_res.parallel_perms is not None:
+                    if parse_res.parallel:
+                        raise ValueError(
+                            "Cannot specify --parallel and --parallel-perms at same time")
+                    if parse_res.output_perms:
+                        raise ValueError(
+                            "Cannot specify --output-perms and --parallel-perms at same time")
+                    if parse_res.checkpoint_folder:
+                        raise ValueError(
+                            "Cannot specify --checkpoint and --parallel-perms at same time")
+                    if parse_res.keep_best is not None:
+                        raise ValueError(
+                            "Cannot specify --keep-best and --parallel-perms at same time")
+                    if parse_res.parallel_ops is not None:
+                        raise ValueError(
+                            "Cannot specify --parallel-ops and --parallel-perms at same time")
+                    dictionary_args['pool_size'] = parse_res.parallel_perms
+                    dictionary_args['parallel_perms'] = True
+                if parse_res.resume and not parse_res.checkpoint_folder:
+                    raise ValueError("--resume requires --checkpoint")
+                if parse_res.checkpoint_folder and parse_res.parallel_ops is not None:
+                    raise ValueError("Cannot specify --checkpoint and --parallel-ops at same time")
+                if parse_res.anytime and parse_res.prochirality:
+                    raise ValueError("Cannot specify --anytime and --prochirality at same time")
 
             if parse_res.command == 'approx':
                 # choose dir:
@@ -414,10 +521,19 @@ def _process_arguments(parse_res):
                     # doing this before previous line causes weird bug
                     dictionary_args["selective"] = True
 
+                if parse_res.print_approx and parse_res.parallel_ops is not None:
+                    raise ValueError("Cannot specify --print-approx and --parallel-ops at same time")
+
                 if parse_res.parallel_dirs is not None:
                     if parse_res.parallel:
                         raise ValueError(
                             "Cannot specify --parallel and --parallel-dirs at same time")
+                    if parse_res.keep_best is not None:
+                        raise ValueError(
+                            "Cannot specify --keep-best and --parallel-dirs at same time")
+                    if parse_res.parallel_ops is not None:
+                        raise ValueError(
+                            "Cannot specify --parallel-ops and --parallel-dirs at same time")
                     dictionary_args['pool_size'] = parse_res.parallel_dirs
                     # doing this before previous line causes weird bug
                     dictionary_args['parallel_dirs'] = True
@@ -460,7 +576,7 @@ def get_parsed_args(args):
         sys.exit()
     if parsed_args.command is None:
         parser.error(
-            "You must select a command from: read, exact, approx, trivial, write")
+            "You must select a command from: read, exact, approx, trivial, auto, write, perms-to-csv")
     processed_args = _process_arguments(parsed_args)
     return processed_args
 
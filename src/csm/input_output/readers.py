@@ -4,9 +4,12 @@ from pathlib import Path
 
 import os
 
+import numpy as np
+
 from csm.calculations.basic_calculations import check_perm_structure_preservation, check_perm_equivalence, \
     check_perm_cycles
 from csm.input_output.formatters import csm_log as print
+from csm.input_output.writers import PERMS_LOG_MAGIC, PERMS_LOG_VERSION, PERMS_LOG_HEADER, perms_log_dtype
 from csm.molecule.molecule import MoleculeReader, Molecule, select_mols
 
 
@@ -195,6 +198,25 @@ def read_dir_file(filename):
         raise ValueError("Invalid input for use-dir")
 
 
+def read_perms_log(filename):
+    """
+    Memory-maps a binary permutations log written by --output-perms --perms-format binary
+    :param filename: Name of the log file
+    :return: a read only array of records, with the fields serial, op, csm, dir and perm
+    """
+    header = np.fromfile(filename, dtype=PERMS_LOG_HEADER, count=1)
+    if len(header) < 1 or header[0]["magic"] != PERMS_LOG_MAGIC:
+        raise ValueError("%s is not a permutations log" % filename)
+    if header[0]["version"] != PERMS_LOG_VERSION:
+        raise ValueError("Unsupported permutations log version %d" % header[0]["version"])
+    record_dtype = perms_log_dtype(int(header[0]["molecule_size"]))
+    # a log whose calculation was interrupted may end with part of a record
+    num_records = (os.path.getsize(filename) - PERMS_LOG_HEADER.itemsize) // record_dtype.itemsize
+    if num_records == 0:
+        return np.zeros(0, dtype=record_dtype)
+    return np.memmap(filename, dtype=record_dtype, mode='r', offset=PERMS_LOG_HEADER.itemsize, shape=(num_records,))
+
+
 def read_from_sys_std_in():
     '''
     a wrapper around calls to sys.stdin.read: we first check that there's something being piped, and if not, raise an error
@@ -5,6 +5,8 @@ import re
 from pathlib import Path
 import shutil
 
+import numpy as np
+
 import openbabel.openbabel as ob
 from openbabel.openbabel import OBConversion, OBMol
 
@@ -43,6 +45,97 @@ def get_line_header(index, operation):
     return "L" + index_str + "_" + operation.op_code
 
 
+# The binary permutations log is a header followed by fixed width records, one for each permutation
+PERMS_LOG_MAGIC = b"CSMPERMS"
+PERMS_LOG_VERSION = 1
+PERMS_LOG_HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("molecule_size", "<u4")])
+# How many records the log buffers before writing them to the file
+PERMS_LOG_CHUNK_SIZE = 65536
+
+
+def perms_log_dtype(molecule_size):
+    return np.dtype([("serial", "<i8"), ("op", "S8"), ("csm", "<f8"), ("dir", "<f8", (3,)),
+                     ("perm", "<i4", (molecule_size,))])
+
+
+class PermsLogWriter:
+    """
+    Writes the permutations of a calculation to a binary permutations log, in chunks of PERMS_LOG_CHUNK_SIZE records.
+    An instance is used as the calculation's callback_func, and must be closed (or flushed) for the last chunk to be
+    written. The log is read by readers.read_perms_log and converted to csv by perms_log_to_csv
+    """
+    def __init__(self, filename, molecule_size, chunk_size=PERMS_LOG_CHUNK_SIZE):
+        self._file = open(filename, 'ab')
+        self._records = np.zeros(chunk_size, dtype=perms_log_dtype(molecule_size))
+        self._count = 0
+
+    @staticmethod
+    def create(filename, molecule_size):
+        header = np.zeros(1, dtype=PERMS_LOG_HEADER)
+        header[0] = (PERMS_LOG_MAGIC, PERMS_LOG_VERSION, molecule_size)
+        with open(filename, 'wb') as f:
+            f.write(header.tobytes())
+
+    def __call__(self, state):
+        record = self._records[self._count]
+        record["serial"] = state.serial
+        record["op"] = state.op_type + str(state.op_order)
+        record["csm"] = state.csm
+        record["dir"] = np.nan if state.dir is None else state.dir
+        record["perm"] = state.perm
+        self._count += 1
+        if self._count == len(self._records):
+            self.flush()
+
+    def write_batch(self, first_serial, op_name, csms, dirs, perms):
+        """
+        Writes the records of consecutive permutations at once, used instead of calling the writer for each one
+        """
+        num_perms = len(csms)
+        start = 0
+        while start < num_perms:
+            end = min(num_perms, start + len(self._records) - self._count)
+            records = self._records[self._count:self._count + end - start]
+            records["serial"] = np.arange(first_serial + start, first_serial + end)
+            records["op"] = op_name
+            records["csm"] = csms[start:end]
+            records["dir"] = dirs[start:end]
+            records["perm"] = perms[start:end]
+            self._count += end - start
+            if self._count == len(self._records):
+                self.flush()
+            start = end
+
+    def flush(self, *args):
+        if self._count:
+            self._file.write(self._records[:self._count].tobytes())
+            self._count = 0
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def perms_log_to_csv(perms_log, output=None, **kwargs):
+    """
+    Converts a binary permutations log to the csv written by --output-perms --perms-format csv
+    :param perms_log: the name of the log file
+    :param output: the name of the csv file, default is the log's name with a .csv extension
+    """
+    from csm.input_output.readers import read_perms_log
+    if output is None:
+        output = os.path.splitext(perms_log)[0] + ".csv"
+    records = read_perms_log(perms_log)
+    with open(output, 'w') as csv_file:
+        perm_writer = csv.writer(csv_file, lineterminator='\n')
+        perm_writer.writerow(['Serial', 'op', 'Direction', 'CSM', 'Permutation'])
+        for record in records:
+            perm_writer.writerow([int(record["serial"]), record["op"].decode(), record["dir"], float(record["csm"]),
+                                  (record["perm"] + 1).tolist()])
+    return output
+
+
 class LegacyFormatWriter:
     def __init__(self, result, format):
         self.result = result
@@ -626,8 +719,12 @@ class ScriptContextWriter(ContextWriter):
             output_perms_folder = os.path.join(self.folder, args_dict['command'])
             os.makedirs(output_perms_folder, exist_ok=True)
             filename = args_dict["molecule"].metadata.appellation(no_file_format=True) + "_" + get_line_header(
-                        line_index, args_dict["operation"]) + "_perm.csv"
-            perms_csv_name = os.path.join(self.folder, args_dict['command'], filename)
+                        line_index, args_dict["operation"]) + "_perm"
+            if args_dict.get("perms_format") == "binary":
+                perms_csv_name = os.path.join(self.folder, args_dict['command'], filename + ".bin")
+                PermsLogWriter.create(perms_csv_name, len(args_dict["molecule"]))
+                return perms_csv_name
+            perms_csv_name = os.path.join(self.folder, args_dict['command'], filename + ".csv")
             csv_file = open(perms_csv_name, 'w')
             perm_writer = csv.writer(csv_file, lineterminator='\n')
             perm_writer.writerow(['Serial', 'op',  'Direction', 'CSM', 'Permutation'])
@@ -805,6 +902,28 @@ class ScriptContextWriter(ContextWriter):
                                 chain_stats=stats[op][chain_perm]
                                 f.write("\n"+op+"\t"+chain_perm+"\t"+format_CSM(chain_stats["csm"])+"\t"+str(chain_stats["dir"]))
 
+    def write_best_perms_file(self, mol_results):
+        out_folder = os.path.join(self.folder, "best-perms")
+        for line_index, command_result in enumerate(mol_results):
+            if "best perms" not in command_result.ongoing_statistics:
+                continue
+            stats = command_result.ongoing_statistics["best perms"]
+            name = command_result.molecule.metadata.appellation(no_file_format=True) + "_" + get_line_header(
+                line_index,
+                command_result.operation)
+            os.makedirs(out_folder, exist_ok=True)
+            with open(os.path.join(out_folder, name + "_best.tsv"), 'w') as f:
+                f.write("Rank\tSerial\tOp\tCSM\tDirection\tPermutation")
+                for rank, best in enumerate(stats["best"]):
+                    f.write("\n" + str(rank + 1) + "\t" + str(best["serial"]) + "\t" + best["op"] + "\t" +
+                            format_CSM(best["csm"]) + "\t" + str(best["dir"]) + "\t" +
+                            str([p + 1 for p in best["perm"]]))
+            with open(os.path.join(out_folder, name + "_histogram.tsv"), 'w') as f:
+                f.write("CSM from\tCSM to\tCount")
+                for index, count in enumerate(stats["histogram"]):
+                    f.write("\n" + format_CSM(index * stats["bin width"]) + "\t" +
+                            format_CSM((index + 1) * stats["bin width"]) + "\t" + str(count))
+
     def write(self, molecule_results):
         # receives result array for single molecule, and appends to all the relevant files
         #print(self.folder)
@@ -814,6 +933,7 @@ class ScriptContextWriter(ContextWriter):
         self.write_initial_mols(molecule_results)
         self.write_symmetric_mols(molecule_results)
         self.write_extra_txt(molecule_results)
+        self.write_best_perms_file(molecule_results)
         if self.create_legacy_files:
             self.write_legacy_files(molecule_results)
         if self.verbose:
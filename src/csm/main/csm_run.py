@@ -1,8 +1,10 @@
 import csv
 import json
 import multiprocessing
+import multiprocessing.pool
 import os
 import sys
+import threading
 import timeit
 import numpy as np
 
@@ -13,28 +15,82 @@ prepare_openbabel()  # Make sure the OpenBabel DLL can be found. See file for mo
 
 from csm import __version__
 from csm.input_output import formatters
-from csm.calculations import Approx, Trivial, Exact, ParallelApprox
+from csm.calculations import Approx, Trivial, Exact, ParallelApprox, ParallelExact
 from csm.calculations.approx.dirs import get_direction_chooser
-from csm.calculations.data_classes import FailedResult, CSMResult
+from csm.calculations.exact_calculations import choose_calculation
+from csm.calculations import constants
+from csm.calculations.constants import HISTOGRAM_BINS
+from csm.calculations.data_classes import FailedResult, CSMResult, BestPermsTracer
+from csm.fast import get_root_solver, set_root_solver
 from csm.input_output.arguments import get_parsed_args, old_cmd_converter, check_modifies_molecule
 from csm.input_output.formatters import csm_log as print
-from csm.input_output.formatters import silent_print
+from csm.input_output.formatters import silent_print, format_perm_count
 from csm.input_output.readers import read_molecules, read_mols_from_std_in, read
 from csm.input_output.readers import read_perm, read_from_sys_std_in
 from csm.input_output.writers import SimpleContextWriter, ScriptContextWriter, PipeContextWriter, LegacyContextWriter, \
-    get_line_header, MoleculeWriter
+    get_line_header, MoleculeWriter, PermsLogWriter, perms_log_to_csv
 from csm.molecule.molecule import Molecule
 from csm.main.normcsm import norm_calc
 from csm.molecule.molecule import MoleculeReader
 from datetime import datetime
 
 
-def do_calculation(command, perms_csv_name=None, parallel_dirs=False, print_approx=False, **dictionary_args):
+# The cache budget and the root solver are module settings. do_calculation applies those of its arguments and the
+# last calculation to end restores the ones before the first, so that they do not carry over to later calculations.
+# The calculations of a --parallel --threads run overlap, and share the settings of their command
+_settings_lock = threading.Lock()
+_active_calculations = 0
+_saved_settings = None
+
+
+def _apply_settings(cache_memory=None, root_solver=None, **kwargs):
+    global _active_calculations, _saved_settings
+    with _settings_lock:
+        if _active_calculations == 0:
+            _saved_settings = constants.CACHE_MAX_MEMORY, get_root_solver()
+        _active_calculations += 1
+        if cache_memory is not None:
+            constants.set_cache_max_memory(cache_memory * 2 ** 20)
+        if root_solver is not None:
+            set_root_solver(root_solver)
+
+
+def _restore_settings():
+    global _active_calculations
+    with _settings_lock:
+        _active_calculations -= 1
+        if _active_calculations == 0:
+            cache_max_memory, root_solver = _saved_settings
+            constants.set_cache_max_memory(cache_max_memory)
+            set_root_solver(root_solver)
+
+
+def do_calculation(**dictionary_args):
+    _apply_settings(**dictionary_args)
+    try:
+        return _do_calculation(**dictionary_args)
+    finally:
+        _restore_settings()
+
+
+def _do_calculation(command, perms_csv_name=None, parallel_dirs=False, parallel_perms=False, print_approx=False,
+                    keep_best=None, histogram_bins=HISTOGRAM_BINS, **dictionary_args):
     calc_type = command
+    # in threads, the molecule is shared rather than pickled
+    threads = dictionary_args.get("threads")
 
     csm_state_tracer_func = None
     csm_close_perm_file_func = None
-    if perms_csv_name:
+    perms_log = None
+    best_perms_tracer = None
+    if keep_best:
+        best_perms_tracer = BestPermsTracer(keep_best, histogram_bins)
+        csm_state_tracer_func = best_perms_tracer
+    elif perms_csv_name and dictionary_args.get("perms_format") == "binary":
+        perms_log = PermsLogWriter(perms_csv_name, len(dictionary_args["molecule"]))
+        csm_state_tracer_func = perms_log
+        csm_close_perm_file_func = perms_log.flush
+    elif perms_csv_name:
         csv_file = open(perms_csv_name, 'a')
         perm_writer = csv.writer(csv_file, lineterminator='\n')
         csm_state_tracer_func = lambda state: perm_writer.writerow(
@@ -45,18 +101,43 @@ def do_calculation(command, perms_csv_name=None, parallel_dirs=False, print_appr
                 [p + 1 for p in state.perm],])
         csm_close_perm_file_func = lambda x : csv_file.flush()
 
+    auto_estimate = None
+    auto_completed_ops = {}
+    if calc_type == "auto":
+        calc_type, auto_estimate, auto_completed_ops = choose_calculation(**dictionary_args)
+        print("Estimated %s permutations, running %s" %
+              (format_perm_count(auto_estimate["estimated perm count"]), calc_type))
+        if calc_type == "approx" and dictionary_args["keep_structure"]:
+            dictionary_args["approx_algorithm"] = "structured"
+
     if calc_type == "exact":
         # get perm if it exists:
         dictionary_args['perm'] = read_perm(**dictionary_args)
-        calc = Exact(**dictionary_args, callback_func=csm_state_tracer_func)
+        checkpoint_folder = dictionary_args.get("checkpoint_folder")
+        if checkpoint_folder:
+            os.makedirs(checkpoint_folder, exist_ok=True)
+            checkpoint_name = "%s_%s.json" % (dictionary_args["molecule"].metadata.appellation(no_file_format=True),
+                                              dictionary_args["operation"].op_code)
+            dictionary_args["checkpoint_file"] = os.path.join(checkpoint_folder, checkpoint_name)
+        if parallel_perms:
+            parallel_obmol = dictionary_args["molecule"]._obmol
+            dictionary_args["molecule"]._obmol = None
+            calc = ParallelExact(**dictionary_args)
+        else:
+            calc = Exact(**dictionary_args, callback_func=csm_state_tracer_func)
+        if not (csm_state_tracer_func or dictionary_args["perm"] or dictionary_args.get("prochirality")):
+            # the sample run measured the operations it completed like the calculation would, without prochirality
+            # and without passing the permutations to a tracer
+            calc.completed_ops = auto_completed_ops
 
     elif calc_type == "approx":
         dictionary_args['chain_perms'] = read_perm(**dictionary_args)
         dir_chooser = get_direction_chooser(**dictionary_args)
         dictionary_args["direction_chooser"] = dir_chooser
         if parallel_dirs:
-            parallel_obmol = dictionary_args["molecule"]._obmol
-            dictionary_args["molecule"]._obmol = None
+            if not threads:
+                parallel_obmol = dictionary_args["molecule"]._obmol
+                dictionary_args["molecule"]._obmol = None
             calc = ParallelApprox(**dictionary_args)
         else:
             if print_approx:
@@ -70,12 +151,29 @@ def do_calculation(command, perms_csv_name=None, parallel_dirs=False, print_appr
         dictionary_args['chain_perms'] = read_perm(**dictionary_args)
         calc = Trivial(**dictionary_args)
 
+    parallel_ops = dictionary_args.get("ops_pool_size") and dictionary_args["operation"].type == 'CH'
+    if parallel_ops:
+        parallel_obmol = dictionary_args["molecule"]._obmol
+        dictionary_args["molecule"]._obmol = None
+
     # run the calculation
-    calc.calculate(**dictionary_args)
-    if parallel_dirs:
+    try:
+        calc.calculate(**dictionary_args)
+    finally:
+        if perms_log:
+            perms_log.close()
+    if (parallel_dirs and not threads) or parallel_perms or parallel_ops:
         # manage pickling
         dictionary_args["molecule"]._obmol = parallel_obmol
         calc.result.molecule._obmol = parallel_obmol
+    if best_perms_tracer:
+        # ongoing_statistics may be the result's shared default dictionary, so it is replaced rather than updated
+        ongoing_stats = dict(calc.result.ongoing_statistics)
+        ongoing_stats["best perms"] = best_perms_tracer.to_dict()
+        calc.result.ongoing_statistics = ongoing_stats
+    if auto_estimate is not None:
+        calc.result.overall_statistics["auto command"] = calc_type
+        calc.result.overall_statistics.update(auto_estimate)
 
     return calc.result
 
@@ -149,6 +247,9 @@ def csm_run(args=[]):
     elif command == "write":
         return write(**dictionary_args)
 
+    elif command == "perms-to-csv":
+        return perms_log_to_csv(**dictionary_args)
+
     else:
         try:
             return calc(dictionary_args)
@@ -250,20 +351,27 @@ def calc(dictionary_args):
     # run the calculation, in parallel
     if dictionary_args["parallel"]:
         flattened_args = [item for sublist in total_args for item in sublist]
-        # manage pickling
+        threads = dictionary_args.get("threads")
+        # manage pickling, threads share the molecules instead
         flattened_args_obmols = [dic_arg["molecule"].obmol for dic_arg in flattened_args]
-        for dic_arg in flattened_args:
-            dic_arg["molecule"]._obmol = None
+        if not threads:
+            for dic_arg in flattened_args:
+                dic_arg["molecule"]._obmol = None
 
         num_ops = len(operation_array)
         batch_mols = 50  # int(len(molecules)/10)
         batch_size = num_ops * batch_mols  # it needs to be divisible by length of operation array
         total_results = []
         pool_size = dictionary_args["pool_size"]
-        print("Parallelizing {} calculations across {} processes with batch size {}".format(len(flattened_args),
-                                                                                            pool_size, batch_size))
+        print("Parallelizing {} calculations across {} {} with batch size {}".format(len(flattened_args), pool_size,
+                                                                                   "threads" if threads else "processes",
+                                                                                   batch_size))
+        pool = None
         try:
-            pool = multiprocessing.Pool(processes=pool_size)
+            if threads:
+                pool = multiprocessing.pool.ThreadPool(processes=pool_size)
+            else:
+                pool = multiprocessing.Pool(processes=pool_size)
             with context_writer(operation_array, **dictionary_args) as rw:
                 for i in range(0, len(flattened_args), batch_size):
                     end_index = min(i + batch_size, len(flattened_args))
@@ -290,8 +398,9 @@ def calc(dictionary_args):
         except Exception as e:
             print(e)
         finally:
-            pool.close()
-            pool.join()
+            if pool is not None:
+                pool.close()
+                pool.join()
         return total_results  # maybe should unflatten first?
 
     if len(molecules) > 10:
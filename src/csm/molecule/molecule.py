@@ -627,6 +627,69 @@ class Molecule:
                 for equiv_index in group:
                     self._atoms[atom_index].add_equivalence(equiv_index)
 
+    def find_automorphisms(self, tolerance=1e-4):
+        """
+        Finds the automorphisms of the molecule: the permutations of its atoms that keep every atom in its
+        equivalence class, map bonds to bonds and preserve all the interatomic distances.
+        Such a permutation is realized by an orthogonal transformation of the molecule, so permutations that are
+        conjugate by an automorphism have the same CSM.
+        :param tolerance: the largest difference allowed between an interatomic distance and its image
+        :return: a list of automorphisms, each a numpy array mapping an atom index to its image. the identity is first
+        """
+        size = len(self._atoms)
+        if size == 0:
+            return []
+        Q = np.array([np.array(atom.pos) for atom in self._atoms])
+        # search the small equivalence classes first, they have the fewest candidates
+        order = [index for group in sorted(self.equivalence_classes, key=len) for index in group]
+        groups = {}
+        for group in self.equivalence_classes:
+            for index in group:
+                groups[index] = group
+
+        image = np.full(size, -1, dtype=int)
+        used = np.zeros(size, dtype=bool)
+        candidates = [None] * size
+
+        def can_map(depth, atom, target):
+            if used[target]:
+                return False
+            for neighbor in self._atoms[atom].adjacent:
+                if image[neighbor] >= 0 and image[neighbor] not in self._atoms[target].adjacent:
+                    return False
+            if depth == 0:
+                return True
+            mapped = order[:depth]
+            dists = np.linalg.norm(Q[mapped] - Q[atom], axis=1)
+            image_dists = np.linalg.norm(Q[image[mapped]] - Q[target], axis=1)
+            return np.all(np.abs(dists - image_dists) <= tolerance)
+
+        automorphisms = []
+        depth = 0
+        candidates[0] = iter(groups[order[0]])
+        # an iterative depth first search, to avoid the recursion limit on large molecules
+        while depth >= 0:
+            atom = order[depth]
+            if image[atom] >= 0:
+                used[image[atom]] = False
+                image[atom] = -1
+            for target in candidates[depth]:
+                if can_map(depth, atom, target):
+                    break
+            else:
+                depth -= 1
+                continue
+            image[atom] = target
+            used[target] = True
+            if depth == size - 1:
+                automorphisms.append(image.copy())
+            else:
+                depth += 1
+                candidates[depth] = iter(groups[order[depth]])
+
+        automorphisms.sort(key=lambda perm: not np.array_equal(perm, np.arange(size)))
+        return automorphisms
+
     def strip_atoms(self, remove_hy=False, select_atoms=[], ignore_atoms=[], use_backbone=False,
                     select_chains=[], select_res=[]):
         """
@@ -5,6 +5,7 @@ that the code runs successfully and returns A result.
 import csv
 import json
 
+import numpy as np
 import os
 import pytest
 import shutil
@@ -13,6 +14,8 @@ import sys
 from io import StringIO 
 
 from csm.main.csm_run import csm_run, calc, get_parsed_args
+from csm.input_output.readers import read_perms_log
+from csm.calculations.constants import MAX_DOUBLE
 from tests.test_settings import test_dir
 
 test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "files_for_tests")
@@ -29,6 +32,18 @@ class Capturing_stdout(list):
         sys.stdout = self._stdout
 
 
+def _wait_for_cancel(deadline):
+    # runs in a pool process, on a copy of the deadline
+    import time
+    from csm.calculations.basic_calculations import CalculationCancelledError
+    while True:
+        try:
+            deadline.check_now()
+        except CalculationCancelledError:
+            return "cancelled"
+        time.sleep(0.01)
+
+
 class RunThings():
     def _run_args(self, args_str, results_folder):
         args_str += " --output {} --overwrite".format(results_folder)
@@ -657,6 +672,15 @@ $$$$
             exp = file.read()
         assert out == exp
 
+    def test_parallel_mols_in_file_threads(self):
+        cmd = "comfile comfile.txt --input many-mols.xyz --parallel 2 --threads"
+        result1 = self.run_args(cmd)
+        with open(os.path.join(self.results_folder, "csm.txt"), "r") as file:
+            out = file.read()
+        with open(os.path.join("parallel-out", "csm.txt"), "r") as file:
+            exp = file.read()
+        assert out == exp
+
     def test_sn_max(self):
         # --sn-max (relevant only for chirality)
         cmd = "exact ch --input bis(dth)copper(I).mol"
@@ -715,6 +739,222 @@ $$$$
         results = self.run_args(cmd)
         assert results[0][0].csm == pytest.approx(0.793551, abs=1e-5)
 
+    def test_branch_and_bound(self):
+        cmd = "exact cs --input bis(dth)copper(I).mol --branch-and-bound"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+        assert results[0][0].overall_statistics["pruned branches"] > 0
+        # every permutation that improves the incumbent prunes the ones after it, not only after a whole block
+        assert results[0][0].overall_statistics["perm count"] == 8
+
+    def test_no_constraint(self):
+        cmd = "exact cs --input bis(dth)copper(I).mol --no-constraint"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+        assert results[0][0].overall_statistics["perm count"] == 1000
+
+    def test_parallel_perms(self):
+        cmd = "exact cs --input bis(dth)copper(I).mol --parallel-perms 2"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+        assert results[0][0].overall_statistics["perm count"] == 1000
+        # the work units of the stack permuter enumerate every permutation once too
+        results = self.run_args(cmd + " --no-constraint")
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+        assert results[0][0].overall_statistics["perm count"] == 1000
+
+    def test_use_automorphisms(self):
+        cmd = "exact cs --input bis(dth)copper(I).mol --use-automorphisms"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+        assert results[0][0].overall_statistics["skipped by symmetry"] > 0
+        # the subtrees of the skipped branches are not walked, of the 1000 permutations only 308 are measured
+        assert results[0][0].overall_statistics["perm count"] == 308
+        for permuter in ["--no-constraint", "--branch-and-bound"]:
+            results = self.run_args(cmd + " " + permuter)
+            assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+            assert results[0][0].overall_statistics["perm count"] <= 308
+
+    def test_cache_memory(self):
+        from csm.calculations import constants
+        default_memory = constants.CACHE_MAX_MEMORY
+        cmd = "exact cs --input bis(dth)copper(I).mol --cache-memory 0"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+        # the budget holds for the calculation only
+        assert constants.CACHE_MAX_MEMORY == default_memory
+
+    def test_checkpoint(self):
+        checkpoint_folder = os.path.join(self.results_folder, "checkpoints")
+        cmd = "exact cs --input bis(dth)copper(I).mol --checkpoint {} --checkpoint-interval 0".format(checkpoint_folder)
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+        assert results[0][0].overall_statistics["perm count"] == 1000
+        # a finished calculation leaves no checkpoint behind, so resuming starts over
+        assert os.listdir(checkpoint_folder) == []
+        results = self.run_args(cmd + " --resume")
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+
+    def test_checkpoint_resume(self):
+        cmd = "exact c3 --input ferrocene.xyz"
+        results = self.run_args(cmd)
+        csm = results[0][0].csm
+        perm_count = results[0][0].overall_statistics["perm count"]
+        # the calculation takes a few seconds, so it times out midway and is resumed until it completes
+        checkpoint_folder = os.path.join(self.results_folder, "resume-checkpoints")
+        cmd += " --timeout 1 --checkpoint {}".format(checkpoint_folder)
+        results = self.run_args(cmd)
+        assert "timed out" in results[0][0].failed_reason
+        for attempt in range(20):
+            results = self.run_args(cmd + " --resume")
+            if not results[0][0].failed:
+                break
+        assert results[0][0].csm == pytest.approx(csm, abs=1e-5)
+        assert results[0][0].overall_statistics["perm count"] == perm_count
+
+    def test_deadline_cancel_in_pool(self):
+        import multiprocessing
+        from csm.calculations.basic_calculations import Deadline, init_pool_deadline
+        deadline = Deadline(60)
+        pool = multiprocessing.Pool(processes=1, initializer=init_pool_deadline, initargs=(deadline.share(),))
+        try:
+            result = pool.apply_async(_wait_for_cancel, (deadline,))
+            deadline.cancel()
+            assert result.get(timeout=30) == "cancelled"
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_timeout(self):
+        for command in ["exact", "approx"]:
+            results = self.run_args(command + " cs --input bis(dth)copper(I).mol --timeout 0")
+            assert "timed out" in results[0][0].failed_reason
+
+    def test_anytime(self):
+        cmd = "exact c2 --input lig-4kem_short.pdb --timeout 1 --anytime"
+        results = self.run_args(cmd)
+        assert results[0][0].csm < 100
+        assert results[0][0].overall_statistics["perm count"] > 0
+        assert not results[0][0].overall_statistics["optimal"]
+        assert results[0][0].overall_statistics["explored fraction"] < 1
+        # a calculation that completes is optimal
+        results = self.run_args("exact cs --input bis(dth)copper(I).mol --anytime")
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+        assert results[0][0].overall_statistics["optimal"]
+        assert results[0][0].overall_statistics["explored fraction"] == 1
+        # an anytime calculation that times out before measuring any permutation fails as timed out
+        for operation in ["c2", "ch"]:
+            results = self.run_args("exact %s --input lig-4kem_short.pdb --anytime --timeout 0" % operation)
+            assert "timed out" in results[0][0].failed_reason
+
+    def test_perm_memo(self):
+        # directions that converge to the same permutation measure it once
+        cmd = "approx ch --input ferrocene.xyz"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(0.241361, abs=1e-5)
+        assert results[0][0].overall_statistics["perm memo hit rate"] > 0
+
+    def test_merged_starts(self):
+        # starts whose path reaches the path of an earlier, converged start stop there
+        cmd = "approx c3 --input 2RLA-s3.pdb --fibonacci 60"
+        results = self.run_args(cmd)
+        assert round(results[0][0].csm, 6) == 0.009663
+        stop_reasons = [direction["stats"]["stop reason"] for direction in results[0][0].ongoing_statistics["approx"]["c3"]]
+        merged = results[0][0].overall_statistics["merged starts"]
+        assert merged > 0
+        assert stop_reasons.count("Merged with a converged direction") == merged
+
+    def test_prochirality(self):
+        cmd = "exact cs --input mirror-symmetric.xyz --prochirality"
+        results = self.run_args(cmd)
+        assert not results[0][0].is_chiral
+        assert results[0][0].csm == pytest.approx(1.764023, abs=1e-5)
+        assert results[0][0].overall_statistics["perm count"] == 9496
+
+    def test_chirality_statistics(self):
+        # the statistics of a chirality calculation are those of its last operation, S4, and the total perm count adds
+        # up those of CS, S2 and S4
+        cmd = "exact ch --input bis(dth)copper(I).mol"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(0, abs=1e-5)
+        assert results[0][0].overall_statistics["perm count"] == 3004
+        assert results[0][0].overall_statistics["total perm count"] == 5004
+
+    def test_parallel_ops(self):
+        cmd = "exact ch --input bis(dth)copper(I).mol --parallel-ops 2"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(0, abs=1e-5)
+        assert results[0][0].overall_statistics["best chirality"] == "S4"
+
+    def test_parallel_ops_tie(self):
+        # CS and S4 are both zero, whichever process finishes first the result is CS, as without --parallel-ops
+        results = self.run_args("exact s4 --input square-planar.xyz")
+        assert results[0][0].csm == pytest.approx(0, abs=1e-5)
+        cmd = "exact ch --input square-planar.xyz --parallel-ops 3"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(0, abs=1e-5)
+        assert results[0][0].overall_statistics["best chirality"] == "CS"
+
+    def test_auto(self):
+        cmd = "auto cs --input bis(dth)copper(I).mol"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(4.394381, abs=1e-5)
+        assert results[0][0].overall_statistics["auto command"] == "exact"
+        assert results[0][0].overall_statistics["estimated perm count"] == 1000
+        assert results[0][0].overall_statistics["perm count"] == 1000
+        # the sample run completes every operation, and its results are those of the exact calculation
+        expected = self.run_args("exact ch --input bis(dth)copper(I).mol")
+        results = self.run_args("auto ch --input bis(dth)copper(I).mol")
+        assert results[0][0].overall_statistics["auto command"] == "exact"
+        assert results[0][0].csm == pytest.approx(expected[0][0].csm, abs=1e-5)
+        assert results[0][0].overall_statistics["best chirality"] == expected[0][0].overall_statistics["best chirality"]
+        assert results[0][0].overall_statistics["perm count"] == expected[0][0].overall_statistics["perm count"]
+
+    def test_auto_trivial(self):
+        cmd = "auto c3 --input 4-helicene.mol"
+        results = self.run_args(cmd)
+        assert results[0][0].overall_statistics["auto command"] == "trivial"
+
+    def test_root_solver(self):
+        cmd = "exact c4 --input squarate.xyz"
+        expected = self.run_args(cmd)[0][0].csm
+        results = self.run_args(cmd + " --root-solver newton")
+        assert results[0][0].csm == pytest.approx(expected, abs=1e-6)
+        # the solver holds for the calculation only
+        from csm.fast import get_root_solver
+        assert get_root_solver() == "numpy"
+
+    def test_root_solver_accuracy(self):
+        # every root solver finds the lambda_max of np.roots, on random permutations of the molecule
+        from csm.fast import ROOT_SOLVERS, SinglePermPermuter, Vector3D, external_get_eigens, get_lambda_max, \
+            set_root_solver
+        from csm.molecule.molecule import MoleculeReader
+        os.chdir(test_dir)
+        mol = MoleculeReader.from_file("4-helicene.mol", comfile_first_read=False)
+        mol.normalize()
+        rng = np.random.default_rng(0)
+        cases = []
+        for op_type, op_order in [("CN", 3), ("CN", 4), ("SN", 4), ("SN", 6)]:
+            for i in range(500):
+                calc_state = next(SinglePermPermuter(rng.permutation(len(mol)), mol, op_order, op_type).permute())
+                m = np.zeros((3, 3))
+                lambdas = Vector3D.zero()
+                eigenvalues = np.zeros(3)
+                external_get_eigens(calc_state.A.to_numpy(), m, eigenvalues)
+                m_t_B_2 = Vector3D.zero()
+                for j in range(3):
+                    lambdas[j] = eigenvalues[j]
+                    m_t_B_2[j] = (m[j] @ calc_state.B.to_numpy()) ** 2
+                cases.append((lambdas, m_t_B_2))
+        try:
+            expected = [get_lambda_max(lambdas, m_t_B_2) for lambdas, m_t_B_2 in cases]
+            for solver in ROOT_SOLVERS:
+                set_root_solver(solver)
+                lambda_maxes = [get_lambda_max(lambdas, m_t_B_2) for lambdas, m_t_B_2 in cases]
+                assert lambda_maxes == pytest.approx(expected, rel=1e-7)
+        finally:
+            set_root_solver("numpy")
+
     def test_output_perms(self):
         perm_filename = "4-helicene_L01_cs_perm.csv"
         try:
@@ -734,7 +974,52 @@ $$$$
         assert out_rows[1][1]=='CS2'
         assert out_rows[2][4]=='[17, 29, 30, 27, 28, 25, 26, 23, 24, 18, 19, 20, 21, 22, 15, 16, 1, 10, 11, 12, 13, 14, 8, 9, 6, 7, 4, 5, 2, 3]'
 
+    def test_output_perms_binary(self):
+        cmd = "exact cs --input 4-helicene.mol --keep-structure --output-perms --perms-format binary"
+        self.run_args(cmd)
+        perms_log = os.path.join(self.results_folder, "exact", "4-helicene_L01_cs_perm.bin")
+        records = read_perms_log(perms_log)
+        assert records[1]["op"] == b"CS2"
+        assert (records[1]["perm"] + 1).tolist() == [17, 29, 30, 27, 28, 25, 26, 23, 24, 18, 19, 20, 21, 22, 15, 16, 1,
+                                                     10, 11, 12, 13, 14, 8, 9, 6, 7, 4, 5, 2, 3]
+        converted = os.path.join(self.results_folder, "exact", "4-helicene_L01_cs_perm_converted.csv")
+        csm_run(["perms-to-csv", perms_log, "--output", converted])
+        with open(converted, 'r') as file:
+            out_rows = list(csv.reader(file))
+        assert out_rows[0] == ['Serial', 'op', 'Direction', 'CSM', 'Permutation']
+        assert len(out_rows) == len(records) + 1
+        assert out_rows[2][1] == 'CS2'
+        assert out_rows[2][4] == str((records[1]["perm"] + 1).tolist())
+
+    def test_keep_best(self):
+        cmd = "exact cs --input 4-helicene.mol --keep-best 3"
+        results = self.run_args(cmd)
+        best_perms = results[0][0].ongoing_statistics["best perms"]
+        assert len(best_perms["best"]) == 3
+        assert best_perms["best"][0]["csm"] == pytest.approx(results[0][0].csm, abs=1e-6)
+        assert best_perms["best"][0]["perm"] == list(results[0][0].perm)
+        assert best_perms["best"][0]["csm"] <= best_perms["best"][1]["csm"] <= best_perms["best"][2]["csm"]
+        assert sum(best_perms["histogram"]) == best_perms["perm count"] == 16384
+        assert os.path.isfile(os.path.join(self.results_folder, "best-perms", "4-helicene_L01_cs_best.tsv"))
+
     # approx
+    def test_approx_output_perms_and_keep_best(self):
+        # the permutations file reports the CSM and direction each permutation was built from, --keep-best the CSM
+        # and direction measured for it
+        cmd = "approx c2 --input 4-helicene.mol --fibonacci 2 --output-perms"
+        self.run_args(cmd)
+        with open(os.path.join(self.results_folder, "approx", "4-helicene_L01_c2_perm.csv"), 'r') as file:
+            out_rows = list(csv.reader(file))
+        assert out_rows[0] == ['Serial', 'op', 'Direction', 'CSM', 'Permutation']
+        assert float(out_rows[1][3]) == MAX_DOUBLE
+        assert float(out_rows[2][3]) == pytest.approx(39.239513, abs=1e-5)
+
+        cmd = "approx c2 --input 4-helicene.mol --fibonacci 2 --keep-best 2"
+        results = self.run_args(cmd)
+        best_perms = results[0][0].ongoing_statistics["best perms"]
+        assert best_perms["best"][0]["csm"] == pytest.approx(results[0][0].csm, abs=1e-6)
+        assert best_perms["best"][0]["perm"] == list(results[0][0].perm)
+
     def test_parallel_dirs(self):
         """
         This test wil run ONLY on linux.
@@ -751,6 +1036,28 @@ $$$$
         results = self.run_args(cmd)
         assert not results[0][0].failed
 
+    def test_parallel_dirs_cancelled(self):
+        # see test_parallel_dirs
+        if platform.system() == 'Windows':
+            return
+        cmd = "approx c2 --input 4-helicene.mol --fibonacci 30 --parallel-dirs 2"
+        results = self.run_args(cmd)
+        assert results[0][0].csm == pytest.approx(0, abs=1e-4)
+        # the directions that were not started before one found the symmetry are cancelled
+        stop_reasons = [direction["stats"]["stop reason"] for direction in results[0][0].ongoing_statistics["approx"]["c2"]]
+        assert stop_reasons.count("CSM below threshold") >= 1
+        assert stop_reasons.count("was never reached") + stop_reasons.count("Cancelled") > 0
+
+    def test_parallel_dirs_threads(self):
+        cmd = "approx c2 --input lig-4kem_short.pdb --fibonacci 10"
+        serial = self.run_args(cmd)
+        threads = self.run_args(cmd + " --parallel-dirs 2 --threads")
+        assert threads[0][0].csm == serial[0][0].csm
+        assert list(threads[0][0].perm) == list(serial[0][0].perm)
+        # the threads are given their worker, rather than setting the one of this process
+        from csm.calculations.approx import approximators
+        assert approximators._approx_worker is None
+
     def test_input_chain_perm(self):
         # cmd = "approx c2 --input 3alb-gkt4-h.pdb --input-chain-perm --verbose"
         # results = self.run_args(cmd)